@@ -28,6 +28,7 @@ import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 
 import stat_tools_attractor as st
+import time_tools_attractor as ti
 
 def linear_rescaling(value, oldmin, oldmax, newmin, newmax):
     newvalue= (newmax-newmin)/(oldmax-oldmin)*(value-oldmax)+newmax
@@ -491,93 +492,52 @@ def contiguous_regions(condition):
     return idx
     
 def fill_attractor_array_nan(arrayStats, timeStamps_datetime, timeSampMin = 5):
-    
-    isStatsArrayNumpy = False
-    isTimesArrayNumpy = False
-    if type(timeStamps_datetime) == np.ndarray:
-        timeStamps_datetime = timeStamps_datetime.tolist()
-        isTimesArrayNumpy = True
-        
-    if type(arrayStats) == np.ndarray:
-        arrayStats = arrayStats.tolist()
-        isStatsArrayNumpy = True
-    
-    if len(timeStamps_datetime) == len(arrayStats):
-        nrSamples = len(timeStamps_datetime)
-    else:
-        print("arrayStats, timeStamps_datetime in fill_attractor_array_nan should have the same number of rows.")
-        sys.exit(1)
-    
-    # Prepare list of NaNs
-    emptyListNaN = np.empty((len(arrayStats[0])-1)) # without the first column
-    emptyListNaN[:] = np.nan
-    emptyListNaN = emptyListNaN.tolist()
-
-    tend = timeStamps_datetime[nrSamples-1]
-    tstart = timeStamps_datetime[0]
-    t = 0
-    while tstart < tend:
-        diffTimeSecs = (timeStamps_datetime[t+1] - timeStamps_datetime[t]).total_seconds()
-        if diffTimeSecs > timeSampMin*60:
-            missingDateTime = timeStamps_datetime[t] + datetime.timedelta(minutes = timeSampMin)
-            # Insert missing date time
-            timeStamps_datetime.insert(t+1, missingDateTime)
-            # Insert line of NaNs in arrayStats (except date)
-            missingDate = int(missingDateTime.strftime("%Y%m%d%H%M%S"))
-            arrayStats.insert(t+1,[missingDate] + emptyListNaN)
-        t = t+1
-        tstart = tstart + datetime.timedelta(minutes = timeSampMin)
-    
-    if isStatsArrayNumpy:
-        arrayStats = np.asarray(arrayStats)
-    if isTimesArrayNumpy:
-        timeStamps_datetime = np.asarray(timeStamps_datetime)
-    
-    return(arrayStats, timeStamps_datetime)
-    
-def fill_attractor_array_nan2(arrayStats, timeStamps_datetime, timeSampMin = 5):
     '''
-    Attempt to make the previous function faster. Very expensive to convert list of lists to np.ndarray.
-    np.insert even slower...
+    Function to fill the missing time stamps of an attractor array with rows of NaNs (except the time stamp in the first column).
+    Each row is put in its slot of timeSampMin minutes from the first time stamp, all at once.
+    The slots are computed from the time stamps YYYYmmDDHHMMSS of the first column of arrayStats 
+    (much faster than from the datetime objects).
     '''
+    isStatsArrayNumpy = type(arrayStats) == np.ndarray
+    isTimesArrayNumpy = type(timeStamps_datetime) == np.ndarray
+    
     if len(timeStamps_datetime) == len(arrayStats):
         nrSamples = len(timeStamps_datetime)
     else:
         print("arrayStats, timeStamps_datetime in fill_attractor_array_nan should have the same number of rows.")
         sys.exit(1)
     
-    # Prepare list of NaNs
-    emptyListNaN = np.empty((len(arrayStats[0]))) # without the first column
-    emptyListNaN[:] = np.nan
+    arrayStats = np.asarray(arrayStats, dtype=float)
     
-    # df = pd.DataFrame(timeStamps_datetime)
-    # df = pd.to_datetime(df)
-    # df = df.resample('D').fillna(0)
-
-    # print(df)
-    # df = df.resample('5T').sum()
-    # print(df)
-    # # df = df.fillna(np.nan)
-    # print(df)
-    # sys.exit()
-    
-    tend = timeStamps_datetime[nrSamples-1]
-    tstart = timeStamps_datetime[0]
-    t = 0
-    while tstart < tend:
-        diffTimeSecs = (timeStamps_datetime[t+1] - timeStamps_datetime[t]).total_seconds()
-        if diffTimeSecs > timeSampMin*60:
-            missingDateTime = timeStamps_datetime[t] + datetime.timedelta(minutes = timeSampMin)
-            # Insert missing date time
-            np.insert(timeStamps_datetime, t+1, missingDateTime, axis=0)
-            # Insert line of NaNs in arrayStats (except date)
-            missingDate = int(missingDateTime.strftime("%Y%m%d%H%M%S"))
-            np.insert(arrayStats, t+1, emptyListNaN, axis=0)
-
-        t = t+1
-        tstart = tstart + datetime.timedelta(minutes = timeSampMin)
+    # Time stamps YYYYmmDDHHMMSS to datetime64
+    times = ti.timestamp_array2datetime64(arrayStats[:,0])
+    
+    # Slot of each row
+    timeSampSecs = int(timeSampMin*60)
+    slots = np.round((times - times[0]).astype(np.int64)/timeSampSecs).astype(np.int64)
+    nrSlots = slots[-1] + 1
+    
+    # Time stamps of all the slots
+    timesFilled = times[0] + np.arange(nrSlots)*np.timedelta64(timeSampSecs, 's')
+    isMissing = np.ones(nrSlots, dtype=bool)
+    isMissing[slots] = False
+    
+    # Scatter the rows into an array of NaNs
+    arrayFilled = np.empty((nrSlots, arrayStats.shape[1]))
+    arrayFilled[:] = np.nan
+    arrayFilled[slots] = arrayStats
+    
+    # Time stamps YYYYmmDDHHMMSS of the missing rows
+    arrayFilled[isMissing,0] = ti.datetime64_2timestamp_array(timesFilled[isMissing])
+    
+    timeStamps_datetime = timesFilled.astype(datetime.datetime)
+    
+    if not isStatsArrayNumpy:
+        arrayFilled = arrayFilled.tolist()
+    if not isTimesArrayNumpy:
+        timeStamps_datetime = timeStamps_datetime.tolist()
     
-    return(arrayStats, timeStamps_datetime)
+    return(arrayFilled, timeStamps_datetime)
     
 def print_list_vertical(letters):
     for s1,s2 in zip(letters[:len(letters)//2], letters[len(letters)//2:]): #len(letters)/2 will work with every paired length list
@@ -29,19 +29,267 @@ from netCDF4 import Dataset
 import matplotlib.colors as colors
 
 import datetime
+import collections
+import multiprocessing
+import multiprocessing.pool
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 from operator import itemgetter
 
 import time_tools_attractor as ti
 import data_tools_attractor as dt
 import stat_tools_attractor as st
 
+# Z-R relationship used to derive the reflectivity fields
+zrA = 316.0
+zrb = 1.5
+
 # Radar structure
 class Radar_object(object):
+    '''
+    Radar image. The derived fields (dBZ, dBZFourier, dBZNans, rainrate, rainrateNans, mask)
+    are computed from the decoded rain rates (rainrateRaw, with noData outside the radar 
+    composite) on first access and then kept as attributes.
+    Each derived field is computed from rainrateRaw only, so modifying one of them 
+    does not change the others.
+    The GIF images only keep the 8-bit codes (rain8bit) and the lookup table of their 
+    rain rates (lut). All the fields, rainrateRaw included, are then computed on the 256 
+    codes and mapped through rain8bit.
+    '''
     
     # Radar stats
     war = -1
     fileName = ''
+    
+    def __getattr__(self, name):
+        # only called if the attribute is not set yet
+        if (name in radarDerivedFields) and ('rainrateRaw' in self.__dict__):
+            field = radarDerivedFields[name](self)
+            setattr(self, name, field)
+            return field
+        if (name in radarDerivedFields) and ('lut' in self.__dict__):
+            # the derived fields are pixel-wise, so they are computed once per code
+            codes = get_radar_code_fields(self.lut, self.rainThreshold, self.noData, self.dbzThreshold)
+            field = getattr(codes, name)[self.rain8bit]
+            setattr(self, name, field)
+            return field
+        raise AttributeError(name)
+        
+def radar_mask(r):
+    # mask of the radar composite (1 outside, nan inside)
+    mask = np.ones(r.rainrateRaw.shape)
+    mask[r.rainrateRaw != r.noData] = np.nan
+    return mask
+    
+def radar_rainrateNans(r):
+    # fills no-rain with nans (for conditional statistics)
+    rainrateNans = np.copy(r.rainrateRaw)
+    rainrateNans[rainrateNans < r.rainThreshold] = np.nan
+    return rainrateNans
+    
+def radar_rainrate(r):
+    # fills no-rain with zeros and missing data with nans (for unconditional statistics)
+    rainrate = np.copy(r.rainrateRaw)
+    rainrate[rainrate < 0] = np.nan
+    condition = (rainrate < r.rainThreshold) & (rainrate > 0.0)
+    rainrate[condition] = 0.0
+    return rainrate
+    
+def radar_dBZ(r):
+    # Convert rainrate to reflectivity, no-rain are set to zero (for unconditional statistics)
+    dBZ,_,_ = dt.rainrate2reflectivity(radar_rainrate(r), zrA, zrb, 0.0)
+    return dBZ
+    
+def radar_dBZFourier(r):
+    # fills nans with dbzThreshold for Fourier analysis
+    dBZFourier = radar_dBZ(r)
+    dBZFourier[np.isnan(dBZFourier) | (dBZFourier < r.dbzThreshold)] = r.dbzThreshold
+    return dBZFourier
+    
+def radar_dBZNans(r):
+    # fills no-rain and missing data with nans (for conditional statistics)
+    dBZNans = radar_dBZ(r)
+    dBZNans[radar_rainrateNans(r) < r.rainThreshold] = np.nan
+    return dBZNans
+    
+def radar_rainrateRaw(r):
+    # rain rates of the codes (only used for the GIF images)
+    return np.copy(r.rainrateRaw)
+    
+radarDerivedFields = {'rainrateRaw':radar_rainrateRaw, 'mask':radar_mask, 'rainrateNans':radar_rainrateNans, 'rainrate':radar_rainrate, \
+                      'dBZ':radar_dBZ, 'dBZFourier':radar_dBZFourier, 'dBZNans':radar_dBZNans}
+
+def get_radar_code_fields(lut, rainThreshold, noData = -999.0, dbzThreshold = None):
+    '''
+    Radar_object with one pixel per code, whose rainrateRaw are the rain rates lut of the codes. 
+    Its derived fields give the values of the derived fields of each code.
+    '''
+    codes = Radar_object()
+    codes.rainrateRaw = np.asarray(lut, dtype=float)
+    codes.noData = noData
+    codes.rainThreshold = rainThreshold
+    if dbzThreshold is None:
+        dbzThreshold,_,_ = dt.rainrate2reflectivity(rainThreshold, zrA, zrb)
+    codes.dbzThreshold = dbzThreshold
+    return codes
+    
+def compute_radar_statistics(counts, lut, rainThreshold, noData = -999.0):
+    '''
+    WAR, IMF and unconditional/conditional mean and std in rain rate and dBZ (as computed by 
+    np.nanmean/np.nanstd on the rainrate, rainrateNans, dBZ and dBZNans fields) from the histogram 
+    of the codes of one image (nrCodes,) or of a stack of images (n,nrCodes) and the rain rates lut of the codes.
+    '''
+    codes = get_radar_code_fields(lut, rainThreshold, noData)
+    
+    stats = collections.OrderedDict()
+    stats['war'] = st.compute_war_histogram(counts, codes.rainrateRaw, rainThreshold, noData)
+    stats['imf'] = st.compute_imf_histogram(counts, codes.rainrateRaw, rainThreshold, noData)
+    stats['r_mean'], stats['r_std'] = st.compute_histogram_moments(counts, codes.rainrate)
+    stats['r_cmean'], stats['r_cstd'] = st.compute_histogram_moments(counts, codes.rainrateNans)
+    stats['dBZ_mean'], stats['dBZ_std'] = st.compute_histogram_moments(counts, codes.dBZ)
+    stats['dBZ_cmean'], stats['dBZ_cstd'] = st.compute_histogram_moments(counts, codes.dBZNans)
+    return stats
+    
+def compute_radar_image_statistics(r):
+    '''
+    compute_radar_statistics of the Radar_object r, from the histogram of its codes 
+    (or of its distinct rain rates for RZC).
+    '''
+    if 'lut' in r.__dict__:
+        lut = r.lut
+        counts = st.compute_code_histogram(r.rain8bit, len(lut))
+    else:
+        lut, counts = np.unique(r.rainrateRaw, return_counts=True)
+    return compute_radar_statistics(counts, lut, r.rainThreshold, r.noData)
+    
+# colormaps and coordinates shared by all the radar images
+radarColormapsCache = {}
+radarCoordsCache = {}
+
+def get_radar_colormaps(cmaptype = 'MeteoSwiss'):
+    '''
+    Colormap, norm, levels and mask colormap of the radar images (built once per cmaptype).
+    '''
+    if cmaptype not in radarColormapsCache:
+        color_list, clevs, clevsStr = dt.get_colorlist(cmaptype) 
+
+        cmap = colors.ListedColormap(color_list)
+        norm = colors.BoundaryNorm(clevs, cmap.N)
+        cmap.set_over('black',1)
+        cmapMask = colors.ListedColormap(['black'])
+        radarColormapsCache[cmaptype] = (cmap, norm, clevs, clevsStr, cmapMask)
+    return radarColormapsCache[cmaptype]
+    
+def get_radar_coords(Xmin, Xmax, Ymin, Ymax, resKm = 1):
+    '''
+    Read-only coordinate vectors from (Xmin,Ymin) to (Xmax,Ymax) excluded (built once per extent). 
+    '''
+    key = (Xmin, Xmax, Ymin, Ymax, resKm)
+    if key not in radarCoordsCache:
+        Xcoords = np.arange(Xmin,Xmax,resKm*1000)
+        Ycoords = np.arange(Ymin,Ymax,resKm*1000)
+        Xcoords.flags.writeable = False
+        Ycoords.flags.writeable = False
+        radarCoordsCache[key] = (Xcoords, Ycoords)
+    return radarCoordsCache[key]
 
+class Radar_stack(object):
+    '''
+    Ring buffer of the last nmax radar images, keyed by timestamp, for one product and 
+    one set of reading arguments (readArgs of read_bin_image/read_gif_image).
+    Each image is read only once, get_n_last and get_n_next only read the timestamps 
+    that are not in the stack yet. 
+    The field (default dBZFourier) of the images is stored in a (nmax, ny, nx) array 
+    and the attribute of the Radar_object is a read-only view on its slot. When the 
+    slot is reused by a newer image, the old Radar_object goes back to a lazily computed 
+    field, but the views taken before are overwritten.
+    stack[k] is the view of the field of the k-th last image added (0 being the last 
+    one), as for a stack of fields moved down at each new image.
+    '''
+    
+    def __init__(self, nmax = 12, product = 'RZC', field = 'dBZFourier', **readArgs):
+        self.nmax = int(nmax)
+        self.product = product
+        self.field = field
+        self.readArgs = readArgs
+        self.images = collections.OrderedDict() # timestamp -> (slot, Radar_object), in order of insertion
+        self.fields = None
+        
+    def __len__(self):
+        return len(self.images)
+        
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        timeStamps = list(self.images.keys())
+        if (key[0] < 0) or (key[0] >= len(timeStamps)):
+            raise IndexError('Only %i images in the radar stack.' % len(timeStamps))
+        slot = self.images[timeStamps[-1 - key[0]]][0]
+        view = self.fields[slot][key[1:]]
+        if isinstance(view, np.ndarray):
+            view.flags.writeable = False
+        return view
+        
+    def read(self, timeStr, push = True):
+        '''
+        Returns the Radar_object of timeStr, read only if not in the stack and 
+        added to the stack if push.
+        '''
+        if timeStr in self.images:
+            return self.images[timeStr][1]
+        r = read_radar_image(timeStr, self.product, **self.readArgs)
+        if push:
+            self.push(r)
+        return r
+        
+    def push(self, r):
+        '''
+        Adds the Radar_object r on top of the stack (missing images are not added).
+        '''
+        if (r.war == -1) or (r.datetimeStr in self.images):
+            return
+        field = getattr(r, self.field)
+        if (self.fields is None) or (self.fields.shape[1:] != field.shape):
+            self.fields = np.zeros((self.nmax,) + field.shape)
+            self.clear()
+            
+        # take the slot of the oldest image if the stack is full
+        if len(self.images) == self.nmax:
+            _,(slot,oldest) = self.images.popitem(last=False)
+            oldest.__dict__.pop(self.field, None)
+        else:
+            usedSlots = [slot for slot,_ in self.images.values()]
+            slot = [n for n in range(self.nmax) if n not in usedSlots][0]
+        
+        self.fields[slot] = field
+        view = self.fields[slot]
+        view.flags.writeable = False
+        setattr(r, self.field, view)
+        self.images[r.datetimeStr] = (slot, r)
+        
+    def clear(self):
+        for _,r in self.images.values():
+            r.__dict__.pop(self.field, None)
+        self.images.clear()
+        
+    def get_n_last(self, timeStr, nimages, timeStepMin = 5):
+        '''
+        Radar_objects of the nimages images up to timeStr (oldest first).
+        '''
+        timeStamp = ti.timestring2datetime(timeStr)
+        timeStamps = [timeStamp - datetime.timedelta(minutes=n*timeStepMin) for n in range(nimages-1,-1,-1)]
+        return [self.read(ti.datetime2timestring(t)) for t in timeStamps]
+        
+    def get_n_next(self, timeStr, nimages, timeStepMin = 5):
+        '''
+        Radar_objects of the nimages images from timeStr (oldest first).
+        '''
+        timeStamp = ti.timestring2datetime(timeStr)
+        timeStamps = [timeStamp + datetime.timedelta(minutes=n*timeStepMin) for n in range(nimages)]
+        return [self.read(ti.datetime2timestring(t)) for t in timeStamps]
+        
 def get_filename_radar(timeStr, inBaseDir='/scratch/lforesti/data/', product='AQC', timeAccumMin=5):
     '''
     Get name of radar file given a time string, product and temporal resolution
@@ -136,16 +384,10 @@ def read_bin_image(timeStr, product='RZC', minR = 0.08, fftDomainSize = 512, res
     else:
         print('Domain not found.')
         sys.exit(1)
-    allXcoords = np.arange(Xmin,Xmax+resKm*1000,resKm*1000)
-    allYcoords = np.arange(Ymin,Ymax+resKm*1000,resKm*1000)
+    allXcoords, allYcoords = get_radar_coords(Xmin, Xmax+resKm*1000, Ymin, Ymax+resKm*1000, resKm)
 
     # colormap
-    color_list, clevs, clevsStr = dt.get_colorlist(cmaptype) 
-
-    cmap = colors.ListedColormap(color_list)
-    norm = colors.BoundaryNorm(clevs, cmap.N)
-    cmap.set_over('black',1)
-    cmapMask = colors.ListedColormap(['black'])
+    cmap, norm, clevs, clevsStr, cmapMask = get_radar_colormaps(cmaptype)
     
     # Get filename
     fileName, yearStr, julianDayStr, hourminStr = get_filename_radar(timeStr, inBaseDir, product)
@@ -171,18 +413,12 @@ def read_bin_image(timeStr, product='RZC', minR = 0.08, fftDomainSize = 512, res
                 Xmax = allXcoords[extent[2]]
                 Ymax = allYcoords[extent[3]]
         
-            subXcoords = np.arange(Xmin,Xmax,resKm*1000)
-            subYcoords = np.arange(Ymin,Ymax,resKm*1000)
+            subXcoords, subYcoords = get_radar_coords(Xmin, Xmax, Ymin, Ymax, resKm)
             
             # Select 512x512 domain in the middle
             if fftDomainSize>0:
                 rainrate = dt.extract_middle_domain(rainrate, fftDomainSize, fftDomainSize)
           
-            # Create mask radar composite
-            mask = np.ones(rainrate.shape)
-            mask[rainrate != noData] = np.nan
-            mask[rainrate == noData] = 1
-
             # Set lowest rain thresholds
             if (minR > 0.0) and (minR < 500.0):
                 rainThreshold = minR
@@ -192,49 +428,16 @@ def read_bin_image(timeStr, product='RZC', minR = 0.08, fftDomainSize = 512, res
             # Compute WAR
             war = st.compute_war(rainrate,rainThreshold, noData)
             
-            # fills no-rain with nans (for conditional statistics)
-            rainrateNans = np.copy(rainrate)
-            condition = rainrateNans < rainThreshold
-            rainrateNans[condition] = np.nan
-            
-            # fills no-rain with zeros and missing data with nans (for unconditional statistics)
-            condition = rainrate < 0
-            rainrate[condition] = np.nan
-            condition = (rainrate < rainThreshold) & (rainrate > 0.0)
-            rainrate[condition] = 0.0
-            
-            # Compute corresponding reflectivity
-            A = 316.0
-            b = 1.5
-            
             # Take reflectivity value corresponding to minimum rainfall threshold as zero(0.08 mm/hr)
-            dbzThreshold,_,_ = dt.rainrate2reflectivity(rainThreshold, A, b)
-            
-            # Convert rainrate to reflectivity, no-rain are set to zero (for unconditional statistics)
-            dBZ, minDBZ, minRainRate = dt.rainrate2reflectivity(rainrate, A, b, 0.0)
-           
-            # fills nans with dbzThreshold for Fourier analysis
-            condition1 = np.isnan(dBZ) 
-            condition2 = dBZ < dbzThreshold
-            dBZFourier = np.copy(dBZ)
-            dBZFourier[(condition1 == True) | (condition2 == True)] = dbzThreshold
-            
-            # fills no-rain and missing data with nans (for conditional statistics)
-            condition = rainrateNans < rainThreshold
-            dBZNans = np.copy(dBZ)
-            dBZNans[condition] = np.nan
+            dbzThreshold,_,_ = dt.rainrate2reflectivity(rainThreshold, zrA, zrb)
             
             ## Creates radar object
             radar_object = Radar_object()
 
-            # fields
-            radar_object.dBZ = dBZ
-            radar_object.dBZFourier = dBZFourier
-            radar_object.dBZNans = dBZNans
+            # fields (the derived fields are computed on first access)
+            radar_object.rainrateRaw = rainrate
+            radar_object.noData = noData
             radar_object.rain8bit = []
-            radar_object.rainrate = rainrate
-            radar_object.rainrateNans = rainrateNans
-            radar_object.mask = mask
             
             # statistics
             radar_object.war = war
@@ -261,10 +464,10 @@ def read_bin_image(timeStr, product='RZC', minR = 0.08, fftDomainSize = 512, res
             radar_object.extent = (Xmin, Xmax, Ymin, Ymax)
             radar_object.subXcoords = subXcoords
             radar_object.subYcoords = subYcoords
-            if dBZ.shape[0] == dBZ.shape[1]:
-                radar_object.fftDomainSize = dBZ.shape[0]
+            if rainrate.shape[0] == rainrate.shape[1]:
+                radar_object.fftDomainSize = rainrate.shape[0]
             else:
-                radar_object.fftDomainSize = dBZ.shape
+                radar_object.fftDomainSize = rainrate.shape
             
             # colormaps
             radar_object.cmap = cmap
@@ -291,16 +494,10 @@ def read_gif_image(timeStr, product='AQC', minR = 0.08, fftDomainSize = 512, res
     else:
         print('Domain not found.')
         sys.exit(1)
-    allXcoords = np.arange(Xmin,Xmax+resKm*1000,resKm*1000)
-    allYcoords = np.arange(Ymin,Ymax+resKm*1000,resKm*1000)
+    allXcoords, allYcoords = get_radar_coords(Xmin, Xmax+resKm*1000, Ymin, Ymax+resKm*1000, resKm)
     
     # colormap
-    color_list, clevs, clevsStr = dt.get_colorlist(cmaptype) 
-
-    cmap = colors.ListedColormap(color_list)
-    norm = colors.BoundaryNorm(clevs, cmap.N)
-    cmap.set_over('black',1)
-    cmapMask = colors.ListedColormap(['black'])
+    cmap, norm, clevs, clevsStr, cmapMask = get_radar_colormaps(cmaptype)
     
     # Get filename
     fileName, yearStr, julianDayStr, hourminStr = get_filename_radar(timeStr, inBaseDir, product, timeAccumMin)
@@ -329,92 +526,48 @@ def read_gif_image(timeStr, product='AQC', minR = 0.08, fftDomainSize = 512, res
             # if (alb == -1) & (dol == -1) & (lem == -1) & (ppm == -1) & (wei == -1):
                 # alb, dol, lem = get_radaroperation_from_quality(dataQuality)
 
-            # Generate lookup table
+            # Generate lookup table (the rain rates are only computed from the codes when needed)
             lut = dt.get_rainfall_lookuptable(noData)
-
-            # Replace 8bit values with rain rates 
-            rainrate = lut[rain8bit]
             
             if (product == 'AQC'): # AQC is given in millimiters!!!
-                rainrate[rainrate != noData] = rainrate[rainrate != noData]*(60/timeAccumMin)
+                lut[lut != noData] = lut[lut != noData]*(60/timeAccumMin)
 
             # Get coordinates of reduced domain
             if fftDomainSize > 0:
-                extent = dt.get_reduced_extent(rainrate.shape[1], rainrate.shape[0], fftDomainSize, fftDomainSize)
+                extent = dt.get_reduced_extent(rain8bit.shape[1], rain8bit.shape[0], fftDomainSize, fftDomainSize)
                 Xmin = allXcoords[extent[0]]
                 Ymin = allYcoords[extent[1]]
                 Xmax = allXcoords[extent[2]]
                 Ymax = allYcoords[extent[3]]
 
-            subXcoords = np.arange(Xmin,Xmax,resKm*1000)
-            subYcoords = np.arange(Ymin,Ymax,resKm*1000)
+            subXcoords, subYcoords = get_radar_coords(Xmin, Xmax, Ymin, Ymax, resKm)
             
             # Select 512x512 domain in the middle
             if fftDomainSize>0:
-                rainrate = dt.extract_middle_domain(rainrate, fftDomainSize, fftDomainSize)
                 rain8bit = dt.extract_middle_domain(rain8bit, fftDomainSize, fftDomainSize)
           
-            # Create mask radar composite
-            mask = np.ones(rainrate.shape)
-            isNaN = (rainrate == noData)
-            mask[~isNaN] = np.nan
-            mask[isNaN] = 1
-
             # Set lowest rain thresholds
             if (minR > 0.0) and (minR < 500.0):
                 rainThreshold = minR
             else: # default minimum rainfall rate
                 rainThreshold = 0.08
                 
-            # Compute WAR
-            war = st.compute_war(rainrate,rainThreshold, noData)
-            
-            # fills no-rain with nans (for conditional statistics)
-            rainrateNans = np.copy(rainrate)
-            condition = rainrateNans < rainThreshold
-            rainrateNans[condition] = np.nan
+            # Compute WAR from the histogram of the codes
+            war = st.compute_war_histogram(st.compute_code_histogram(rain8bit), lut, rainThreshold, noData)
             
             import warnings
             warnings.filterwarnings("ignore", category=RuntimeWarning) 
 
-            # fills no-rain with zeros and missing data with nans (for unconditional statistics)
-            condition = rainrate < 0
-            rainrate[condition] = np.nan
-            condition = (rainrate < rainThreshold) & (rainrate > 0.0)
-            rainrate[condition] = 0.0
-            
-            # Compute corresponding reflectivity
-            A = 316.0
-            b = 1.5
-            
             # Take reflectivity value corresponding to minimum rainfall threshold as zero(0.08 mm/hr)
-            dbzThreshold,_,_ = dt.rainrate2reflectivity(rainThreshold, A, b)
-            
-            # Convert rainrate to reflectivity, no-rain are set to zero (for unconditional statistics)
-            dBZ, minDBZ, minRainRate = dt.rainrate2reflectivity(rainrate, A, b, 0.0)
-           
-            # fills nans with dbzThreshold for Fourier analysis
-            condition1 = np.isnan(dBZ) 
-            condition2 = dBZ < dbzThreshold
-            dBZFourier = np.copy(dBZ)
-            dBZFourier[(condition1 == True) | (condition2 == True)] = dbzThreshold
-            
-            # fills no-rain and missing data with nans (for conditional statistics)
-            condition = rainrateNans < rainThreshold
-            dBZNans = np.copy(dBZ)
-            dBZNans[condition] = np.nan
+            dbzThreshold,_,_ = dt.rainrate2reflectivity(rainThreshold, zrA, zrb)
             
             ## Creates radar object
             radar_object = Radar_object()
 
-            # fields
-            radar_object.dBZ = dBZ
-            radar_object.dBZFourier = dBZFourier
-            radar_object.dBZNans = dBZNans
+            # fields (the rain rates and the derived fields are computed from the codes on first access)
             radar_object.rain8bit = rain8bit
-            radar_object.rainrate = rainrate
-            radar_object.rainrateNans = rainrateNans
-            radar_object.mask = mask
+            radar_object.lut = lut
+            radar_object.noData = noData
             
             # statistics
             radar_object.war = war
@@ -441,10 +594,10 @@ def read_gif_image(timeStr, product='AQC', minR = 0.08, fftDomainSize = 512, res
             radar_object.extent = (Xmin, Xmax, Ymin, Ymax)
             radar_object.subXcoords = subXcoords
             radar_object.subYcoords = subYcoords
-            if dBZ.shape[0] == dBZ.shape[1]:
-                radar_object.fftDomainSize = dBZ.shape[0]
+            if rain8bit.shape[0] == rain8bit.shape[1]:
+                radar_object.fftDomainSize = rain8bit.shape[0]
             else:
-                radar_object.fftDomainSize = dBZ.shape
+                radar_object.fftDomainSize = rain8bit.shape
             
             # colormaps
             radar_object.cmap = cmap
@@ -459,6 +612,263 @@ def read_gif_image(timeStr, product='AQC', minR = 0.08, fftDomainSize = 512, res
             
     return(radar_object)    
     
+def read_radar_image(timeStr, product = 'AQC', **readArgs):
+    '''
+    Reads the radar image of timeStr with read_bin_image (RZC) or read_gif_image (other products).
+    Missing or unreadable images are returned as empty Radar_objects (war = -1) with 
+    the time stamps and the name of the expected file.
+    '''
+    if product == 'RZC':
+        r = read_bin_image(timeStr, product=product, **readArgs)
+    else:
+        r = read_gif_image(timeStr, product=product, **readArgs)
+    
+    if r.war == -1:
+        inBaseDir = readArgs.get('inBaseDir', '/scratch/lforesti/data/')
+        if product == 'RZC':
+            r.fileName = get_filename_radar(timeStr, inBaseDir, product)[0]
+        else:
+            r.fileName = get_filename_radar(timeStr, inBaseDir, product, readArgs.get('timeAccumMin', 5))[0]
+        r.datetime = ti.timestring2datetime(timeStr)
+        r.datetimeStr = timeStr
+    return(r)
+    
+def read_radar_images(startTimeStr, endTimeStr, timeStepMin = 5, product = 'AQC', nworkers = 2, nprefetch = 8, \
+    processes = False, missingFiles = None, **readArgs):
+    '''
+    Generator of the Radar_objects from startTimeStr to endTimeStr (included) every timeStepMin minutes, in time order.
+    The images are read and decoded ahead by a pool of nworkers threads (or processes if processes=True), 
+    with at most nprefetch images waiting to be consumed. With nworkers=0 the images are read when requested.
+    Missing images are yielded as empty Radar_objects (see read_radar_image) and their 
+    file names are appended to missingFiles (if a list is given).
+    '''
+    startTime = ti.timestring2datetime(startTimeStr)
+    endTime = ti.timestring2datetime(endTimeStr)
+    nimages = int((endTime - startTime).total_seconds()/60/timeStepMin) + 1
+    if missingFiles is None:
+        missingFiles = []
+    nrMissing = len(missingFiles)
+    
+    if nworkers > 0:
+        if processes:
+            pool = multiprocessing.Pool(nworkers)
+        else:
+            pool = multiprocessing.pool.ThreadPool(nworkers)
+    nprefetch = max(int(nprefetch), 1)
+    
+    def next_image(queue):
+        item = queue.popleft()
+        if nworkers > 0:
+            r = item.get()
+        else:
+            r = read_radar_image(item, product, **readArgs)
+        if r.war == -1:
+            missingFiles.append(r.fileName)
+        return(r)
+    
+    try:
+        # bounded queue of the images being read, in time order
+        queue = collections.deque()
+        for n in range(nimages):
+            timeStr = ti.datetime2timestring(startTime + datetime.timedelta(minutes=n*timeStepMin))
+            if nworkers > 0:
+                queue.append(pool.apply_async(read_radar_image, (timeStr, product), readArgs))
+            else:
+                queue.append(timeStr)
+            if len(queue) == nprefetch:
+                yield next_image(queue)
+        while len(queue) > 0:
+            yield next_image(queue)
+    finally:
+        if nworkers > 0:
+            pool.terminate()
+        nrMissing = len(missingFiles) - nrMissing
+        if nrMissing > 0:
+            print(nrMissing, 'of', nimages, 'radar images missing between', startTimeStr, 'and', endTimeStr)
+    
+def get_filename_radar_cube(outBaseDir, timeDate, product='AQC', timeAccumMin=5):
+    '''
+    Get name of the monthly radar cube file (see write_radar_cube) given a datetime, product and temporal resolution
+    '''
+    timeAccumMinStr = '%05i' % timeAccumMin
+    fileName = outBaseDir + str(timeDate.year) + '/' + product + timeDate.strftime('%Y%m') + '_' + timeAccumMinStr + '.nc'
+    return(fileName)
+    
+def write_radar_cube(fileName, startTimeStr, endTimeStr, product = 'AQC', timeStepMin = 5, timeAccumMin = 5, \
+    inBaseDir = '/scratch/lforesti/data/', noData = -999.0, chunkSizes = (12, 128, 128), nworkers = 2):
+    '''
+    Function to pack the radar images from startTimeStr to endTimeStr (every timeStepMin minutes) into one netCDF file. 
+    The (time, y, x) cube of 8-bit codes of the whole CCS4 domain is stored in compressed chunks of chunkSizes, 
+    with the lookup table of the rain rates [mm/h] of the codes alongside (rainrate = lut[rain8bit]).
+    The codes of the GIF products are stored as they are, for RZC the codes are assigned to the rain rates 
+    found in the images. Missing images are stored with the noData code (255) and flagged in 'valid'.
+    Returns the list of missing files.
+    '''
+    startTime = ti.timestring2datetime(startTimeStr)
+    endTime = ti.timestring2datetime(endTimeStr)
+    nimages = int((endTime - startTime).total_seconds()/60/timeStepMin) + 1
+    
+    # CCS4 domain at 1 km
+    Xmin = 255000
+    Xmax = 965000
+    Ymin = -160000
+    Ymax = 480000
+    nrRows = int((Ymax - Ymin)/1000)
+    nrCols = int((Xmax - Xmin)/1000)
+    chunkSizes = (min(chunkSizes[0], nimages), min(chunkSizes[1], nrRows), min(chunkSizes[2], nrCols))
+    
+    noDataCode = 255
+    if product == 'RZC':
+        readArgs = {'inBaseDir': inBaseDir, 'noData': noData, 'fftDomainSize': 0}
+        lut = np.zeros(256)
+        lut[noDataCode] = noData
+        rzcCodes = {noData: noDataCode}
+    else:
+        readArgs = {'inBaseDir': inBaseDir, 'noData': noData, 'fftDomainSize': 0, 'timeAccumMin': timeAccumMin}
+        lut = dt.get_rainfall_lookuptable(noData)
+        if (product == 'AQC'): # AQC is given in millimiters!!!
+            lut[lut != noData] = lut[lut != noData]*(60/timeAccumMin)
+    
+    # Create netCDF Dataset
+    nc_fid = Dataset(fileName, 'w', format='NETCDF4')
+    nc_fid.title = 'Radar rainfall images (8-bit codes)'
+    nc_fid.institution = 'MeteoSwiss, Locarno-Monti'
+    nc_fid.description = 'Radar rainfall images packed by write_radar_cube, rainrate = lut[rain8bit]'
+    nc_fid.comment = 'File generated the ' + str(datetime.datetime.now()) + '.'
+    nc_fid.noData = noData
+    nc_fid.product = product
+    nc_fid.timeAccumMin = timeAccumMin
+    nc_fid.timeStepMin = timeStepMin
+    nc_fid.extent = (Xmin, Xmax, Ymin, Ymax)
+    
+    # Dimensions
+    nc_fid.createDimension('time', nimages)
+    nc_fid.createDimension('y', nrRows)
+    nc_fid.createDimension('x', nrCols)
+    nc_fid.createDimension('code', 256)
+    
+    nc_time = nc_fid.createVariable('time', 'i8', dimensions=('time'))
+    nc_time.description = "Timestamp (UTC)"
+    nc_time.units = "%YYYY%MM%DD%HH%mm%SS"
+    nc_time[:] = [int(ti.datetime2timestring(startTime + datetime.timedelta(minutes=n*timeStepMin))) for n in range(nimages)]
+    
+    nc_valid = nc_fid.createVariable('valid', 'u1', dimensions=('time'))
+    nc_valid.description = "Whether the radar image was available"
+    
+    nc_lut = nc_fid.createVariable('lut', 'f8', dimensions=('code'))
+    nc_lut.description = "Rain rate of the 8-bit codes"
+    nc_lut.units = "mm/h"
+    
+    nc_rain8bit = nc_fid.createVariable('rain8bit', 'u1', dimensions=('time', 'y', 'x'), zlib=True, chunksizes=chunkSizes)
+    nc_rain8bit.description = "8-bit codes of the radar rainfall images (North on top)"
+    
+    # Read the images ahead and write them by blocks of chunks in time
+    missingFiles = []
+    radarImages = read_radar_images(startTimeStr, endTimeStr, timeStepMin, product, nworkers=nworkers, \
+        missingFiles=missingFiles, **readArgs)
+    
+    valid = np.zeros(nimages, dtype=np.uint8)
+    block = np.zeros((chunkSizes[0], nrRows, nrCols), dtype=np.uint8)
+    for n,r in enumerate(radarImages):
+        b = n % chunkSizes[0]
+        if r.war == -1:
+            block[b] = noDataCode
+        else:
+            if np.shape(r.rain8bit if product != 'RZC' else r.rainrateRaw) != (nrRows, nrCols):
+                nc_fid.close()
+                raise ValueError('Radar image ' + r.fileName + ' does not cover the CCS4 domain.')
+            if product == 'RZC':
+                # codes of the rain rates, new ones added to the lookup table
+                values, codes = np.unique(r.rainrateRaw, return_inverse=True)
+                for value in values:
+                    if value not in rzcCodes:
+                        if len(rzcCodes) == 256:
+                            nc_fid.close()
+                            raise ValueError('More than 256 different rain rates in ' + product + ' images.')
+                        rzcCodes[value] = len(rzcCodes) - 1
+                        lut[rzcCodes[value]] = value
+                block[b] = np.array([rzcCodes[value] for value in values], dtype=np.uint8)[codes].reshape(nrRows, nrCols)
+            else:
+                block[b] = r.rain8bit
+            valid[n] = 1
+        
+        if (b == chunkSizes[0]-1) or (n == nimages-1):
+            nc_rain8bit[n-b:n+1] = block[:b+1]
+            
+    nc_valid[:] = valid
+    nc_lut[:] = lut
+    nc_fid.close()
+    
+    return(missingFiles)
+    
+class Radar_cube(object):
+    '''
+    Reader of a radar cube written by write_radar_cube. Only the chunks covering the 
+    requested time window and subdomain are read and decompressed.
+    '''
+    
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.nc_fid = Dataset(fileName, 'r')
+        self.nc_fid.set_auto_mask(False)
+        self.rain8bit = self.nc_fid.variables['rain8bit']
+        self.lut = self.nc_fid.variables['lut'][:]
+        self.valid = self.nc_fid.variables['valid'][:] == 1
+        self.noData = self.nc_fid.noData
+        self.product = self.nc_fid.product
+        self.timeStepMin = int(self.nc_fid.timeStepMin)
+        self.extent = tuple(self.nc_fid.extent)
+        self.shape = self.rain8bit.shape
+        self.startTime = ti.timestring2datetime(str(self.nc_fid.variables['time'][0]))
+        
+    def __len__(self):
+        return self.shape[0]
+        
+    def close(self):
+        self.nc_fid.close()
+        
+    def get_time_index(self, timeStr):
+        timeDiff = (ti.timestring2datetime(timeStr) - self.startTime).total_seconds()/60
+        if (timeDiff % self.timeStepMin) != 0:
+            raise ValueError(timeStr + ' is not a time stamp of ' + self.fileName)
+        idx = int(timeDiff/self.timeStepMin)
+        if (idx < 0) or (idx >= self.shape[0]):
+            raise IndexError(timeStr + ' is not in ' + self.fileName)
+        return idx
+        
+    def get_timestamps(self, startTimeStr, endTimeStr = None):
+        if endTimeStr is None:
+            endTimeStr = startTimeStr
+        t0 = self.get_time_index(startTimeStr)
+        t1 = self.get_time_index(endTimeStr)
+        return [self.startTime + datetime.timedelta(minutes=t*self.timeStepMin) for t in range(t0, t1+1)]
+        
+    def read_codes(self, startTimeStr, endTimeStr = None, fftDomainSize = 0, rows = None, cols = None):
+        '''
+        8-bit codes (time, y, x) from startTimeStr to endTimeStr (included) of the middle domain of 
+        fftDomainSize (as extract_middle_domain) or of the rows and cols slices (whole domain by default).
+        '''
+        if endTimeStr is None:
+            endTimeStr = startTimeStr
+        t0 = self.get_time_index(startTimeStr)
+        t1 = self.get_time_index(endTimeStr)
+        if fftDomainSize > 0:
+            borderSizeX = int((self.shape[2] - fftDomainSize)/2)
+            borderSizeY = int((self.shape[1] - fftDomainSize)/2)
+            rows = slice(borderSizeY, borderSizeY + fftDomainSize)
+            cols = slice(borderSizeX, borderSizeX + fftDomainSize)
+        if rows is None:
+            rows = slice(None)
+        if cols is None:
+            cols = slice(None)
+        return self.rain8bit[t0:t1+1, rows, cols]
+        
+    def read_rainrate(self, startTimeStr, endTimeStr = None, fftDomainSize = 0, rows = None, cols = None):
+        '''
+        Rain rates [mm/h] (time, y, x) of read_codes, with noData outside the radar composite and for the missing images.
+        '''
+        return self.lut[self.read_codes(startTimeStr, endTimeStr, fftDomainSize, rows, cols)]
+        
 def get_filename_wavelets(inBaseDir, analysisType, timeDate, product='AQC', timeAccumMin=5, scaleKM=None, minR=0.08, format='netcdf'):
     if format == 'netcdf':
         extension = '.nc'
@@ -564,6 +974,41 @@ def get_filename_HZT(dataDirHZT, dateTime):
     fileNameHZT = dirName + fileName
     return(fileNameHZT, dirName)
 
+def fill_hzt_column(HZT_MAPLE_array, col, dataHZT, sortedIdxAll, timeStampSorted, task='add', boxType='Destination'):
+    '''
+    Fill the column col of HZT_MAPLE_array with the HZT values of one daily file (last column of dataHZT), 
+    matching the time stamps of the boxes (first column of dataHZT) with the sorted Julian time stamps of the archive.
+    The boxes of a given time stamp are assumed to be in the same order in the archive and in the daily file.
+    '''
+    # Stable sort to keep the order of the boxes within each time stamp
+    sortedIdxDay = np.argsort(dataHZT[:,0], kind='mergesort')
+    dayTimes, startsDay, nrMatchingBoxes_day = np.unique(dataHZT[sortedIdxDay,0], return_index=True, return_counts=True)
+    
+    startsAll = np.searchsorted(timeStampSorted, dayTimes, side='left')
+    nrMatchingBoxes_all = np.searchsorted(timeStampSorted, dayTimes, side='right') - startsAll
+    
+    wrongTimes = np.where(nrMatchingBoxes_all != nrMatchingBoxes_day)[0]
+    if len(wrongTimes) > 0:
+        print('You should use the same dataset to extract and match the HZT values.')
+        print('Expecing: ', nrMatchingBoxes_all[wrongTimes[0]], 'values. Received:', nrMatchingBoxes_day[wrongTimes[0]], 'values.')
+        sys.exit()
+    
+    # Rows of the archive corresponding to the sorted rows of the daily file
+    rowsAll = sortedIdxAll[np.arange(len(sortedIdxDay)) + np.repeat(startsAll - startsDay, nrMatchingBoxes_day)]
+    valuesDay = dataHZT[sortedIdxDay,-1]
+    
+    if (task == 'complete'):
+        # Only fill the time stamps with missing values
+        nrNaNs = np.add.reduceat(np.isnan(HZT_MAPLE_array[rowsAll,col]).astype(int), startsDay)
+        boolFill = np.repeat(nrNaNs > 0, nrMatchingBoxes_day)
+        HZT_MAPLE_array[rowsAll[boolFill],col] = valuesDay[boolFill]
+        if (nrNaNs[-1] == 0):
+            print(boxType + ' already in archive.')
+    else:
+        HZT_MAPLE_array[rowsAll,col] = valuesDay
+    
+    return(HZT_MAPLE_array)
+    
 def read_hzt_match_maple_archive(data, startTimeStr = '', endTimeStr = '', dict_colnames=[], task='add', dataDirHZT_base='/scratch/lforesti/data/', boxSize=64):
     '''
     Script to read in the daily .npy files containing the boxes with freezing level height data (t,x,y,HZT) at origin and destination.
@@ -616,6 +1061,10 @@ def read_hzt_match_maple_archive(data, startTimeStr = '', endTimeStr = '', dict_
         print('Wrong task in read_hzt_match_maple_archive')
         sys.exit(1)
     
+    # Sort the time stamps once to find the boxes of each time with binary search
+    sortedIdxAll = np.argsort(timeStampJulian, kind='mergesort')
+    timeStampSorted = timeStampJulian[sortedIdxAll]
+    
     timeDate = startDateTimeDt
     while timeDate <= endDateTimeDt:
         # Print elapsed time
@@ -638,27 +1087,7 @@ def read_hzt_match_maple_archive(data, startTimeStr = '', endTimeStr = '', dict_
             print(fileNameHZT_dest, 'read.')
             
             # Fill in large MAPLE array at the right rows
-            dayTimes = np.unique(dataDest[:,0])
-            for t in dayTimes:
-                boolTime_dest_all = (timeStampJulian == t)
-                boolTime_dest_day = (dataDest[:,0] == t)
-                
-                nrMatchingBoxes_all = np.sum(boolTime_dest_all)
-                nrMatchingBoxes_day = np.sum(boolTime_dest_day)
-                # print(t, np.sum(boolTime_dest_all), np.sum(boolTime_dest_day))
-                if nrMatchingBoxes_all != nrMatchingBoxes_day:
-                    print('You should use the same dataset to extract and match the HZT values.')
-                    print('Expecing: ', nrMatchingBoxes_all, 'values. Received:', nrMatchingBoxes_day, 'values.')
-                    sys.exit()
-                
-                if (task == 'complete'):
-                    nrNaNs = np.sum(np.isnan(HZT_MAPLE_array[boolTime_dest_all,0]))
-                    if (nrNaNs > 0):
-                       HZT_MAPLE_array[boolTime_dest_all,0] = dataDest[boolTime_dest_day,-1]
-                    if (nrNaNs == 0) & (t == dayTimes[-1]):
-                       print('Destination already in archive.')
-                else:
-                    HZT_MAPLE_array[boolTime_dest_all,0] = dataDest[boolTime_dest_day,-1]
+            HZT_MAPLE_array = fill_hzt_column(HZT_MAPLE_array, 0, dataDest, sortedIdxAll, timeStampSorted, task, 'Destination')
                 
         #### Read-in origin box file
         if os.path.isfile(fileNameHZT_orig):
@@ -666,27 +1095,7 @@ def read_hzt_match_maple_archive(data, startTimeStr = '', endTimeStr = '', dict_
             print(fileNameHZT_orig, 'read.')
             
             # Fill in large MAPLE array at the right rows
-            dayTimes = np.unique(dataOrig[:,0])
-            for t in dayTimes:
-                boolTime_orig_all = (timeStampJulian == t)
-                boolTime_orig_day = (dataOrig[:,0] == t)
-                
-                nrMatchingBoxes_all = np.sum(boolTime_orig_all)
-                nrMatchingBoxes_day = np.sum(boolTime_orig_day)
-                #print(t, np.sum(boolTime_orig_all), np.sum(boolTime_orig_day))
-                if nrMatchingBoxes_all != nrMatchingBoxes_day:
-                    print('You should use the same dataset to extract and match the HZT values.')
-                    print('Expecing: ', nrMatchingBoxes_all, 'values. Received:', nrMatchingBoxes_day, 'values.')
-                    sys.exit()
-                
-                if (task == 'complete'):
-                    nrNaNs = np.sum(np.isnan(HZT_MAPLE_array[boolTime_orig_all,1]))
-                    if (nrNaNs > 0):
-                       HZT_MAPLE_array[boolTime_orig_all,1] = dataOrig[boolTime_orig_day,-1]
-                    if (nrNaNs == 0) & (t == dayTimes[-1]):
-                        print('Origin already in archive.')
-                else:
-                    HZT_MAPLE_array[boolTime_orig_all,1] = dataOrig[boolTime_orig_day,-1]
+            HZT_MAPLE_array = fill_hzt_column(HZT_MAPLE_array, 1, dataOrig, sortedIdxAll, timeStampSorted, task, 'Origin')
 
         # ti.toc('to process one day.')
         timeDate = timeDate + datetime.timedelta(days=1)
@@ -810,10 +1219,8 @@ def csv_list2array(timeStart, timeEnd, inBaseDir, analysisType='STATS', product=
             
             # to np array
             arrayStats = df.as_matrix() 
-            # to list
-            listStatsLocal = arrayStats.tolist()
             # Concatenate lists
-            listStats = listStats + listStatsLocal 
+            listStats.extend(arrayStats.tolist())
         except:
             print(fileName, ' empty.')
             
@@ -829,10 +1236,8 @@ def csv_list2array(timeStart, timeEnd, inBaseDir, analysisType='STATS', product=
     # Sort list of lists by first variable (time) 
     listStats.sort(key=itemgetter(0))
     
-    # Remove duplicates
-    df = pd.DataFrame(listStats)
-    df = df.drop_duplicates(0)
-    listStats = df.values.tolist()
+    # Remove duplicates (keep the first row of each time stamp)
+    listStats = [listStats[i] for i in range(len(listStats)) if (i == 0) or (listStats[i][0] != listStats[i-1][0])]
     
     return(listStats, variableNames)
 
@@ -854,10 +1259,10 @@ def netcdf_list2array(timeStart,timeEnd, inBaseDir, variableNames = [], analysis
             if len(variableNames) > 0:
                 arrayStats,_ = read_netcdf_globalstats(fileName, variableNames)
             else:
-                arrayStats, variableNames = read_netcdf(fileName)
+                arrayStats, variableNames = read_netcdf_globalstats(fileName)
 
             # Concatenate lists
-            listStats = listStats + arrayStats 
+            listStats.extend([list(row) for row in arrayStats])
         except:
             print(fileName, ' empty.')
             
@@ -873,13 +1278,237 @@ def netcdf_list2array(timeStart,timeEnd, inBaseDir, variableNames = [], analysis
     # Sort list of lists by first variable (time) 
     listStats.sort(key=itemgetter(0))
     
-    # Remove duplicates
-    df = pd.DataFrame(listStats)
-    df = df.drop_duplicates(0)
-    listStats = df.values.tolist()
+    # Remove duplicates (keep the first row of each time stamp)
+    listStats = [listStats[i] for i in range(len(listStats)) if (i == 0) or (listStats[i][0] != listStats[i-1][0])]
 
     return(listStats, variableNames)
     
+def save_atomic(fileName, saveFunc):
+    '''
+    Calls saveFunc(fileNameTmp) on a temporary file (same extension as fileName) renamed 
+    to fileName at the end, so that concurrent runs never read a partial file.
+    '''
+    dirName = os.path.dirname(fileName)
+    if (dirName != '') and (not os.path.isdir(dirName)):
+        os.makedirs(dirName)
+    fileRoot, fileExt = os.path.splitext(fileName)
+    fileNameTmp = fileRoot + '_%i.tmp' % os.getpid() + fileExt
+    saveFunc(fileNameTmp)
+    os.rename(fileNameTmp, fileName)
+    
+def get_dirname_stats_store(inBaseDir, analysisType, product='AQC', timeAccumMin=5, quality=0, minR=0.08, wols=0, variableBreak=0):
+    '''
+    Get name of the directory of the statistics store (see Stats_store), named as the daily files of get_filename_stats.
+    '''
+    timeAccumMinStr = '%05i' % (timeAccumMin)
+    dirName = inBaseDir + product + '_' + analysisType + '_' + str(quality) + '_Rgt' + str(minR) + '_WOLS' + str(wols) + \
+        '_varBreak' + str(variableBreak) + '_' + timeAccumMinStr + '_store/'
+    return(dirName)
+    
+class Stats_store(object):
+    '''
+    Columnar store of statistics indexed by time stamp, in the directory dirName.
+    Each variable is a binary file of float64 values (time is int64 YYYYmmDDHHMMSS) with one 
+    value per row, and new rows are only appended to the files. If a time stamp is appended 
+    several times, the last row wins (upsert), so the daily files can be (re)written in any order.
+    The number of rows is given by the time file, which is written last, so an interrupted 
+    append leaves the store unchanged.
+    The files are memory-mapped when reading, only the requested variables and time range are read.
+    The variable names are listed in the file variables.txt in the order of the daily files 
+    (new variables at the end), which is the order of the columns returned by read.
+    The days (YYYYmmDD of the daily files) already loaded are listed in the file days.i8, 
+    so that only the missing days of a period are read from the daily files.
+    '''
+    
+    def __init__(self, dirName):
+        self.dirName = dirName
+        if not os.path.isdir(dirName):
+            os.makedirs(dirName)
+        
+    def get_filename(self, varName):
+        if varName == 'time':
+            return self.dirName + 'time.i8'
+        if varName == 'days':
+            return self.dirName + 'days.i8'
+        if varName == 'variables':
+            return self.dirName + 'variables.txt'
+        return self.dirName + varName + '.f8'
+        
+    def get_variable_names(self):
+        fileName = self.get_filename('variables')
+        if os.path.isfile(fileName):
+            with open(fileName, 'r') as fid:
+                variableNames = [line.strip() for line in fid if line.strip() != '']
+        else:
+            fileNames = sorted(os.listdir(self.dirName))
+            variableNames = [fileName[:-3] for fileName in fileNames if fileName.endswith('.f8')]
+        return ['time'] + variableNames
+        
+    def __len__(self):
+        fileName = self.get_filename('time')
+        if not os.path.isfile(fileName):
+            return 0
+        return int(os.path.getsize(fileName)/8)
+        
+    def get_column(self, varName, nrRows = None):
+        if nrRows is None:
+            nrRows = len(self)
+        if nrRows == 0:
+            return np.zeros(0, dtype=np.int64 if varName == 'time' else np.float64)
+        if varName == 'time':
+            return np.memmap(self.get_filename(varName), dtype=np.int64, mode='r', shape=(nrRows,))
+        return np.memmap(self.get_filename(varName), dtype=np.float64, mode='r', shape=(nrRows,))
+    
+    def append(self, headers, dataArray):
+        '''
+        Appends (or updates) the rows of dataArray (first column with the time stamps, as written 
+        by write_netcdf_globalstats) with the variable names headers.
+        '''
+        headers = list(headers)
+        dataArray = np.asarray(dataArray)
+        if (dataArray.ndim != 2) or (dataArray.shape[0] == 0):
+            return
+        timeStamps = dataArray[:,0].astype(np.int64)
+        
+        lockFile = open(self.dirName + '.lock', 'w')
+        if fcntl is not None:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            nrRows = len(self)
+            variableNames = self.get_variable_names()
+            newVariableNames = [varName for varName in headers[1:] if varName not in variableNames]
+            for varName in variableNames[1:] + newVariableNames:
+                if varName in headers:
+                    values = dataArray[:,headers.index(varName)].astype(np.float64)
+                else:
+                    values = np.nan*np.ones(len(timeStamps))
+                with open(self.get_filename(varName), 'ab') as fid:
+                    # drop a previous interrupted append, pad new variables
+                    fid.truncate(min(os.path.getsize(self.get_filename(varName)), 8*nrRows))
+                    fid.seek(0, os.SEEK_END)
+                    nrMissing = nrRows - int(fid.tell()/8)
+                    if nrMissing > 0:
+                        (np.nan*np.ones(nrMissing)).tofile(fid)
+                    values.tofile(fid)
+            if (len(newVariableNames) > 0) or (not os.path.isfile(self.get_filename('variables'))):
+                with open(self.get_filename('variables'), 'w') as fid:
+                    fid.write('\n'.join(variableNames[1:] + newVariableNames) + '\n')
+            with open(self.get_filename('time'), 'ab') as fid:
+                timeStamps.tofile(fid)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+            lockFile.close()
+        
+    def clear(self):
+        lockFile = open(self.dirName + '.lock', 'w')
+        if fcntl is not None:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            # time first, so that the store is empty even if interrupted
+            for varName in self.get_variable_names() + ['variables', 'days']:
+                if os.path.isfile(self.get_filename(varName)):
+                    os.remove(self.get_filename(varName))
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+            lockFile.close()
+        
+    def add_days(self, days):
+        '''
+        Records the days (datetimes of the daily files) as loaded in the store.
+        '''
+        days = np.array([int(timeDay.strftime('%Y%m%d')) for timeDay in days], dtype=np.int64)
+        lockFile = open(self.dirName + '.lock', 'w')
+        if fcntl is not None:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            with open(self.get_filename('days'), 'ab') as fid:
+                days.tofile(fid)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+            lockFile.close()
+        
+    def get_days(self, timeStart, timeEnd):
+        '''
+        Days (datetimes of the daily files, whose time stamps go from 00:05 to 00:00 of the next day) 
+        covering timeStart to timeEnd.
+        '''
+        # a time stamp at midnight belongs to the file of the previous day
+        timeDay = timeStart - datetime.timedelta(seconds = 1)
+        timeDay = datetime.datetime(timeDay.year, timeDay.month, timeDay.day)
+        days = []
+        while timeDay < timeEnd:
+            days.append(timeDay)
+            timeDay = timeDay + datetime.timedelta(days = 1)
+        return days
+        
+    def get_missing_days(self, timeStart, timeEnd):
+        '''
+        Days covering timeStart to timeEnd that are not loaded in the store yet.
+        '''
+        if os.path.isfile(self.get_filename('days')):
+            loadedDays = set(np.fromfile(self.get_filename('days'), dtype=np.int64).tolist())
+        else:
+            loadedDays = set()
+        return [timeDay for timeDay in self.get_days(timeStart, timeEnd) if int(timeDay.strftime('%Y%m%d')) not in loadedDays]
+        
+    def load_daily_files(self, timeStart, timeEnd, inBaseDir, format = 'netcdf', refresh = False, **fileArgs):
+        '''
+        Appends the statistics of the daily files (csv or netcdf) covering timeStart to timeEnd that are 
+        not in the store yet (all of them with refresh). fileArgs are passed to netcdf_list2array/csv_list2array.
+        Returns the number of days read.
+        '''
+        if refresh:
+            # all the days of the period (the rows already in the store are updated)
+            missingDays = self.get_days(timeStart, timeEnd)
+        else:
+            missingDays = self.get_missing_days(timeStart, timeEnd)
+        
+        for timeDay in missingDays:
+            if format == 'csv':
+                arrayStats, variableNames = csv_list2array(timeDay, timeDay, inBaseDir, **fileArgs)
+            elif format == 'netcdf':
+                arrayStats, variableNames = netcdf_list2array(timeDay, timeDay, inBaseDir, **fileArgs)
+            else:
+                print('Please provide a valid file format.')
+                sys.exit(1)
+            self.append(variableNames, arrayStats)
+        self.add_days(missingDays)
+        return len(missingDays)
+        
+    def get_rows(self, timeStart = None, timeEnd = None):
+        '''
+        Indices of the last rows of each time stamp between timeStart and timeEnd (datetimes), in time order.
+        '''
+        timeStamps = np.array(self.get_column('time'))
+        # last occurrence of each time stamp
+        uniqueTimes, idxLast = np.unique(timeStamps[::-1], return_index=True)
+        rows = len(timeStamps) - 1 - idxLast
+        
+        selection = np.ones(len(uniqueTimes), dtype=bool)
+        if timeStart is not None:
+            selection &= uniqueTimes >= int(ti.datetime2timestring(timeStart))
+        if timeEnd is not None:
+            selection &= uniqueTimes <= int(ti.datetime2timestring(timeEnd))
+        return rows[selection]
+        
+    def read(self, timeStart = None, timeEnd = None, variableNames = None):
+        '''
+        Reads the variables variableNames (all by default) between timeStart and timeEnd (datetimes). 
+        Returns the (nrSamples, nrVariables) array and the variable names, as netcdf_list2array.
+        '''
+        if (variableNames is None) or (len(variableNames) == 0):
+            variableNames = self.get_variable_names()
+        nrRows = len(self)
+        rows = self.get_rows(timeStart, timeEnd)
+        
+        arrayStats = np.zeros((len(rows), len(variableNames)))
+        for var in range(len(variableNames)):
+            arrayStats[:,var] = self.get_column(variableNames[var], nrRows)[rows]
+        return(arrayStats, variableNames)
+        
 def write_netcdf_globalstats(fileName, headers, dataArray, lowRainThreshold, boolWOLS, spectralSlopeLims):
     nrSamples = dataArray.shape[0]
     if boolWOLS == 1:
@@ -1328,7 +1957,7 @@ def open_gif_image(fileName):
     
     Returns
     -------
-    rain8bit: int
+    rain8bit: uint8
         2d numpy array containing the radar rainfall field values using 8-bit coding
     nrRows: int
         Number of rows of the radar field
@@ -1340,7 +1969,7 @@ def open_gif_image(fileName):
     nrCols = rainImg.size[0]
     nrRows = rainImg.size[1]
     
-    rain8bit = np.array(rainImg,dtype=int)
+    rain8bit = np.array(rainImg,dtype=np.uint8)
     
     del rainImg
     
@@ -13,6 +13,7 @@ import time_tools_attractor as ti
 import io_tools_attractor as io
 import data_tools_attractor as dt
 import nowcasting as nw
+import ssft
 
 import run_fieldextra_c1 as rf1
 import run_fieldextra as rfe
@@ -965,33 +966,7 @@ def produce_forecast(timeStartStr,leadTimeMin):
 
 def probability_matching(initialarray,targetarray):
 
-    # zeros in initial image
-    idxZeros = initialarray == 0
-
-    # flatten the arrays
-    arrayshape = initialarray.shape
-    target = targetarray.flatten()
-    array = initialarray.flatten()
-    
-    # rank target values
-    order = target.argsort()
-    ranked = target[order]
-
-    # rank initial values order
-    orderin = array.argsort()
-    ranks = np.empty(len(array), int)
-    ranks[orderin] = np.arange(len(array))
-
-    # get ranked values from target and rearrange with inital order
-    outputarray = ranked[ranks]
-
-    # reshape as 2D array
-    outputarray = outputarray.reshape(arrayshape)
-    
-    # reassing original zeros
-    outputarray[idxZeros] = 0
-
-    return outputarray
+    return ssft.quantile_transformation(initialarray,targetarray)
 
 # Probability matched mean
 def build_PMM(ensemble):
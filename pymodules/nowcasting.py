@@ -21,9 +21,18 @@ import numpy as np
 import sys
 import time
 import warnings
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.sharedctypes
 import os
+import collections
+import hashlib
 import gis_base as gis
 import pywt
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
 
 from scipy.stats import spearmanr, pearsonr
 
@@ -36,7 +45,7 @@ import time_tools_attractor as ti
 import ssft
 import run_fieldextra_c1 as rf
 
-def get_radar_observations(timeStartStr, leadTimeMin, domainSize = 512, product = 'RZC', rainThreshold = 0.08):
+def get_radar_observations(timeStartStr, leadTimeMin, domainSize = 512, product = 'RZC', rainThreshold = 0.08, nworkers = 2):
 
     # Get datetime format
     startTime = ti.timestring2datetime(timeStartStr)
@@ -46,28 +55,29 @@ def get_radar_observations(timeStartStr, leadTimeMin, domainSize = 512, product
     dt = 5 # minutes
     nimages = int((endTime - startTime).total_seconds()/60/dt) + 1
     
-    # Retrieve images
-    radarStack = get_n_next_radar_image(timeStartStr, nimages, domainSize, product, rainThreshold )
+    # Retrieve images (read ahead by nworkers threads while filling the arrays)
+    radarImages = io.read_radar_images(timeStartStr, ti.datetime2timestring(endTime), dt, product=product, nworkers=nworkers, \
+        fftDomainSize=domainSize, minR=rainThreshold)
 
     # Store in Numpy array
     radar_observations = np.zeros((domainSize,domainSize,nimages))
     radar_mask = np.zeros((domainSize,domainSize,nimages))
     timestamps = []
     currentTime = startTime
-    for t in xrange(len(radarStack)):
-        # radar_observations[:,:,t] = radarStack[t].rainrateNans.copy()
-        if radarStack[t].war>-1:
-            radar_observations[:,:,t] = radarStack[t].rainrate.copy()
-            radar_mask[:,:,t] = radarStack[t].mask.copy()
-            timestamps.append(radarStack[t].datetime)
+    for t,r in enumerate(radarImages):
+        # radar_observations[:,:,t] = r.rainrateNans.copy()
+        if r.war>-1:
+            radar_observations[:,:,t] = r.rainrate
+            radar_mask[:,:,t] = r.mask
+            timestamps.append(r.datetime)
         else:
             radar_observations[:,:,t] = np.zeros((domainSize,domainSize))*np.nan
             radar_mask[:,:,t] = np.ones((domainSize,domainSize))
             timestamps.append(currentTime)
+        if t == 0:
+            robject = r
         
         currentTime = currentTime + datetime.timedelta(minutes=5)
-
-    robject = radarStack[0]
     
     return radar_observations, radar_mask, timestamps, robject
     
@@ -100,7 +110,7 @@ def radar_extrapolation(timeStartStr, leadTimeMin, domainSize = 640, finalDomain
     # (3) compute the motion field
     print('Computing the motion field...')
     tic = time.time()
-    U,V = get_motion_field(dbzStack, doplot=0, verbose=0)
+    U,V = get_motion_field(dbzStack, doplot=0, verbose=0, timeStamps=[r.datetime for r in radarStack], product=product, threshold=radarStack[-1].dbzThreshold)
     toc = time.time()
     print('\t Elapsed time: ', toc - tic, ' seconds.')
 
@@ -124,7 +134,7 @@ def radar_extrapolation(timeStartStr, leadTimeMin, domainSize = 640, finalDomain
     return deterministicForecastFinal, timestamps
     
 def probabilistic_radar_extrapolation(timeStartStr, leadTimeMin, domainSize = 640, finalDomainSize = 512, product = 'RZC', \
-        NumberMembers = 2, NumberLevels = 8, dbzStack=[], timeAccumMin = 5, buffer = 1, rainThreshold = 0.08, local_level = 0, seed = 42):
+        NumberMembers = 2, NumberLevels = 8, dbzStack=[], timeAccumMin = 5, buffer = 1, rainThreshold = 0.08, local_level = 0, seed = 42, nthreads = 1, nworkers = 1, parallel = 'process', nquantiles = None):
         
     ######## preamble
     np.random.seed(seed)
@@ -151,6 +161,10 @@ def probabilistic_radar_extrapolation(timeStartStr, leadTimeMin, domainSize = 64
     # (2) extract dBZ fields and buffer them
     if not dbzStack:
         dbzStack = extract_dBZ_and_buffer(radarStack, fftDomainSize, buffer = buffer)
+        motionTimeStamps = [r.datetime for r in radarStack]
+    else:
+        # unknown origin of the fields, do not use the motion vectors cache
+        motionTimeStamps = None
     cascadeShape = dbzStack[0].shape
     nrOfFields = len(dbzStack)
     target = dbzStack[-1].copy() + radarStack[-1].dbzThreshold
@@ -165,7 +179,7 @@ def probabilistic_radar_extrapolation(timeStartStr, leadTimeMin, domainSize = 64
     # (3) compute the motion field
     print('Computing the motion field...')
     tic = time.time()
-    U,V = get_motion_field(dbzStack, doplot=0, verbose=0)
+    U,V = get_motion_field(dbzStack, doplot=0, verbose=0, timeStamps=motionTimeStamps, product=product, threshold=radarStack[-1].dbzThreshold)
     toc = time.time()
     print('\t Elapsed time: ', toc - tic, ' seconds.')
     # prepare perturbations for motion field
@@ -183,8 +197,9 @@ def probabilistic_radar_extrapolation(timeStartStr, leadTimeMin, domainSize = 64
     tic = time.time()
     # first compute the bandpass filter
     BandpassFilter2D,CentreWaveLengths = calculate_bandpass_filter(cascadeShape,NumberLevels, Width = Width, doplot = 0)
+    cascadeEngine = CascadeEngine(BandpassFilter2D, nthreads = nthreads)
     cascadeStack, cascadeMeanStack, cascadeStdStack = get_cascade_from_stack(dbzStack_at_t0, NumberLevels, BandpassFilter2D, CentreWaveLengths, \
-                                verbose=0, doplot=0)
+                                verbose=0, doplot=0, engine=cascadeEngine)
     toc = time.time()
     print('\t Elapsed time: ', toc - tic, ' seconds.')
 
@@ -203,142 +218,226 @@ def probabilistic_radar_extrapolation(timeStartStr, leadTimeMin, domainSize = 64
     toc = time.time()
     print('\t Elapsed time: ', toc - tic, ' seconds.')
 
-    # (7) generation of all the perturbation fields
+    # (7) generation of all the perturbation fields, chunk by chunk into a single array.
+    # (8) their cascade decomposition is done member by member in forecast_member, 
+    # so that only the cascades of the members being forecast are kept in memory
     print('Generating the perturbation fields...')
     tic = time.time()
-    noiseStack = get_perturbation_fields(dbzStack[-1], NumberMembers, NumberLeadtimes, \
-                local_level=local_level, seed=seed)
-    toc = time.time()
-    print('\t Elapsed time: ', toc - tic, ' seconds.')
-    
-    # r0 = io.read_gif_image('201601010000')
-    # for iii in xrange(10):
-        # plt.imshow(noiseStack[iii],interpolation='nearest',cmap=r0.cmap,vmin=-3,vmax=3)
-        # plt.show()
-        
-    # (8) cascade decomposition of all the perturbation fields
-    print('Cascade decomposition of the perturbation fields...')
-    tic = time.time()
-    noiseCascadeStack, noiseCascadeMeanStack, noiseCascadeStdStack = get_cascade_from_stack(noiseStack, NumberLevels, BandpassFilter2D, CentreWaveLengths, \
-                verbose=0, doplot=0)
+    NumberNoiseFields = int(NumberMembers*(NumberLeadtimes + 2))
+    noiseFields = np.zeros((NumberNoiseFields,) + dbzStack[-1].shape)
+    n0 = 0
+    for perturbationFields in get_perturbation_fields_chunks(dbzStack[-1], NumberMembers, NumberLeadtimes, \
+                local_level=local_level, seed=seed, nthreads=nthreads):
+        n1 = n0 + perturbationFields.shape[2]
+        noiseFields[n0:n1] = np.rollaxis(perturbationFields,2)
+        n0 = n1
     toc = time.time()
     print('\t Elapsed time: ', toc - tic, ' seconds.')
 
     # (9) perform the stochastic forecast
-    stochasticForecast = np.zeros((finalDomainSize,finalDomainSize,NumberLeadtimes,NumberMembers))
-    deterministicForecast = np.zeros((finalDomainSize,finalDomainSize,NumberLeadtimes))
     target = compute_advection(target,U,V,net=NumberLeadtimes);print(target.shape)
     radarMask = compute_advection(radarMask,U,V,net=NumberLeadtimes)
     radarMask = np.array(radarMask>0,dtype=int)
+    
+    # deterministic forecast, radar mask and timestamps are the same for all members
+    deterministicForecast = np.zeros((finalDomainSize,finalDomainSize,NumberLeadtimes))
     radarMask_final = np.zeros((finalDomainSize,finalDomainSize,NumberLeadtimes))
+    timestamps=[]
+    for t in range(NumberLeadtimes):
+        timestamps.append(radarStack[-1].datetime + datetime.timedelta(minutes=(t+1)*5))
+        # target[:,:,t] = ssft.quantile_transformation(target[:,:,t],dbzStack[-1].copy() + radarStack[-1].dbzThreshold)
+        target_sub = dt.extract_middle_domain(target[:,:,t].copy(),finalDomainSize,finalDomainSize)
+        target_sub[target_sub<=radarStack[-1].dbzThreshold] = np.nan 
+        deterministicForecast[:,:,t] = dt.reflectivity2rainrate(target_sub.copy())
+        radarMask_final[:,:,t] = dt.extract_middle_domain(radarMask[:,:,t], finalDomainSize, finalDomainSize) 
+    
+    # rank the probability matching targets once per lead time for all members
+    rankedTarget = ssft.rank_target(np.rollaxis(target,2), nquantiles, perfield=True)
+    
+    # everything a member needs. All the random terms (motion perturbations and noise 
+    # fields) were already drawn from seed and are indexed by member, so that each 
+    # member is reproducible whatever the order or the worker it runs on.
+    memberState = {'cascadeStack':cascadeStack, 'cascadeMeanStack':cascadeMeanStack, 'cascadeStdStack':cascadeStdStack, \
+                   'noiseFields':noiseFields, 'BandpassFilter2D':BandpassFilter2D, 'nthreads':nthreads, 'phi':phi, 'U':U, 'V':V, 'perturbations_mf':perturbations_mf, \
+                   'rankedTarget':rankedTarget, 'dbzThreshold':radarStack[-1].dbzThreshold, 'NumberLevels':NumberLevels, \
+                   'NumberLeadtimes':NumberLeadtimes, 'finalDomainSize':finalDomainSize, 'timeAccumMin':timeAccumMin}
+    
+    if nworkers > 1:
+        print('Running %i members on %i %s workers...' % (NumberMembers, nworkers, parallel))
+        stochasticForecast = forecast_members_parallel(memberState, NumberMembers, nworkers = nworkers, parallel = parallel)
+    else:
+        stochasticForecast = np.zeros((finalDomainSize,finalDomainSize,NumberLeadtimes,NumberMembers))
+        for m in range(NumberMembers):  
+            forecast_member(m, memberState, stochasticForecast)
     
-    Forecast = []
-    countnoise = -1
-    for m in range(NumberMembers):  
-        print('member %i' % m)
-        countnoise+=2
+    # final runnning time
+    tocTotal = time.time()
+    print('Total elapsed time: ', tocTotal - ticTotal, ' seconds.')
+    
+    return stochasticForecast,timestamps,radarMask_final
+
+def forecast_member(m, memberState, stochasticForecast):
+    '''
+    Stochastic forecast of member m of probabilistic_radar_extrapolation, written in 
+    stochasticForecast[:,:,:,m].
+    '''
+    cascadeStack = memberState['cascadeStack']
+    cascadeMeanStack = memberState['cascadeMeanStack']
+    cascadeStdStack = memberState['cascadeStdStack']
+    noiseFields = memberState['noiseFields']
+    phi = memberState['phi']
+    U = memberState['U']
+    V = memberState['V']
+    perturbations_mf = memberState['perturbations_mf']
+    rankedTarget = memberState['rankedTarget']
+    dbzThreshold = memberState['dbzThreshold']
+    NumberLevels = memberState['NumberLevels']
+    NumberLeadtimes = memberState['NumberLeadtimes']
+    finalDomainSize = memberState['finalDomainSize']
+    timeAccumMin = memberState['timeAccumMin']
+    cascadeShape = cascadeStack[-1].shape[:2]
+    
+    print('member %i' % m)
+    # cascade decomposition of the noise fields of member m, which start at m*(NumberLeadtimes + 2). 
+    # One engine per member, the FFTW plans are not shared between the threads
+    cascadeEngine = CascadeEngine(memberState['BandpassFilter2D'], nthreads = memberState['nthreads'])
+    nrMemberFields = NumberLeadtimes + 2
+    noiseCascadeStack,_,_ = cascadeEngine.decompose(noiseFields[m*nrMemberFields:(m+1)*nrMemberFields])
+    countnoise = 1
+    
+    # noise cascade
+    noiseCascadeLag1 = noiseCascadeStack[countnoise].copy()
+    noiseCascadeLag2 = noiseCascadeStack[countnoise-1].copy()
+    
+    # radar cascade
+    extrapolationCascadeLag1 = cascadeStack[-1].copy()
+    extrapolationCascadeLag2 = cascadeStack[-2].copy()
+    
+    noiseCascade = np.zeros_like(extrapolationCascadeLag1)
+    forecastCascade = np.zeros_like(extrapolationCascadeLag1)
+    
+    # both lags are advected together with a single call: levels [0,NumberLevels)
+    # are lag 1, levels [NumberLevels,2*NumberLevels) are lag 2
+    extrapolationCascades = np.concatenate((extrapolationCascadeLag1,extrapolationCascadeLag2),axis=2)
+    extrapolationCascadeLag1 = extrapolationCascades[:,:,:NumberLevels]
+    extrapolationCascadeLag2 = extrapolationCascades[:,:,NumberLevels:]
+    advectedCascades = np.zeros(extrapolationCascades.shape, dtype=np.float32, order='F')
+    
+    # the perturbed motion field is resized only once per member
+    Ures,Vres = resize_motion_field(perturbations_mf[m]*U,perturbations_mf[m]*V)
+    for t in range(NumberLeadtimes):
+        print('\t +%i min' % int((t+1)*timeAccumMin))
+        
+        countnoise +=1
+        memberForecast = np.zeros(cascadeShape)
         
-        # noise cascade
-        noiseCascadeLag1 = noiseCascadeStack[countnoise].copy()
-        noiseCascadeLag2 = noiseCascadeStack[countnoise-1].copy()
+        # advect radar extrapolation cascade           
+        compute_advection_levels(extrapolationCascades,Ures,Vres,net=1,out=advectedCascades)
+        extrapolationCascades[:,:,:] = advectedCascades
         
-        # radar cascade
-        extrapolationCascadeLag1 = cascadeStack[-1].copy()
-        extrapolationCascadeMeanLag1 = cascadeMeanStack[-1].copy()
-        extrapolationCascadeStdLag1 = cascadeStdStack[-1].copy()
-        extrapolationCascadeLag2 = cascadeStack[-2].copy()
-        extrapolationCascadeMeanLag2 = cascadeMeanStack[-2].copy()
-        extrapolationCascadeStdLag2 = cascadeStdStack[-2].copy()
+        for l in range(NumberLevels):
         
-        noiseCascade = np.zeros_like(extrapolationCascadeLag1)
-        forecastCascade = np.zeros_like(extrapolationCascadeLag1)
-        timestamps=[]
-        for t in range(NumberLeadtimes):
-            print('\t +%i min' % int((t+1)*timeAccumMin))
-            timestamps.append(radarStack[-1].datetime + datetime.timedelta(minutes=(t+1)*5))
+            noiseShockTerm = noiseCascadeStack[countnoise][:,:,l].copy()
+            noiseVariance = ( (1 + phi[l,1]) * (1 + phi[l,0] - phi[l,1])*(1 - phi[l,0] - phi[l,1]) ) / ( 1 - phi[l,1])
+            if (t==0) and (m==0):
+                print('v_n = %.3f' % np.sqrt(noiseVariance))
             
-            if m==0:
-                # target[:,:,t] = ssft.quantile_transformation(target[:,:,t],dbzStack[-1].copy() + radarStack[-1].dbzThreshold)
-                target_sub = dt.extract_middle_domain(target[:,:,t].copy(),finalDomainSize,finalDomainSize)
-                target_sub[target_sub<=radarStack[-1].dbzThreshold] = np.nan 
-                deterministicForecast[:,:,t] = dt.reflectivity2rainrate(target_sub.copy())
-            countnoise +=1
-            memberForecast = np.zeros(cascadeShape)
-            for l in range(NumberLevels):
+            # advect noise cascade levels
+            #noiseCascadeLag1[:,:,l] = np.squeeze(compute_advection(noiseCascadeLag1[:,:,l],U,V,net=1))
+            #noiseCascadeLag2[:,:,l] = np.squeeze(compute_advection(noiseCascadeLag2[:,:,l],U,V,net=1))
+     
+            # AR() for noise cascade
+            #noiseCascade[:,:,l] =  phin[l,0] * noiseCascadeLag1[:,:,l] \
+            #                       + phin[l,1] * noiseCascadeLag2[:,:,l] \
+            #                       + np.sqrt(noiseVariance)*noiseShockTerm # the shock term
+            # renormalize the level N(0,1)
+            #noiseCascade[:,:,l] = (noiseCascade[:,:,l] - noiseCascade[:,:,l].mean())/noiseCascade[:,:,l].std()                  
             
-                noiseShockTerm = noiseCascadeStack[countnoise][:,:,l].copy()
-                noiseVariance = ( (1 + phi[l,1]) * (1 + phi[l,0] - phi[l,1])*(1 - phi[l,0] - phi[l,1]) ) / ( 1 - phi[l,1])
-                if (t==0) and (m==0):
-                    print('v_n = %.3f' % np.sqrt(noiseVariance))
-                
-                # advect noise cascade levels
-                #noiseCascadeLag1[:,:,l] = np.squeeze(compute_advection(noiseCascadeLag1[:,:,l],U,V,net=1))
-                #noiseCascadeLag2[:,:,l] = np.squeeze(compute_advection(noiseCascadeLag2[:,:,l],U,V,net=1))
-                noiseShockTerm = noiseCascadeStack[countnoise][:,:,l].copy()
-         
-                # AR() for noise cascade
-                #noiseCascade[:,:,l] =  phin[l,0] * noiseCascadeLag1[:,:,l] \
-                #                       + phin[l,1] * noiseCascadeLag2[:,:,l] \
-                #                       + np.sqrt(noiseVariance)*noiseShockTerm # the shock term
-                # renormalize the level N(0,1)
-                #noiseCascade[:,:,l] = (noiseCascade[:,:,l] - noiseCascade[:,:,l].mean())/noiseCascade[:,:,l].std()                  
-                
-                # advect radar extrapolation cascade           
-                extrapolationCascadeLag1[:,:,l] = ( compute_advection(extrapolationCascadeLag1[:,:,l],perturbations_mf[m]*U,perturbations_mf[m]*V,net=1) ).squeeze()
-                extrapolationCascadeLag2[:,:,l] = ( compute_advection(extrapolationCascadeLag2[:,:,l],perturbations_mf[m]*U,perturbations_mf[m]*V,net=1) ).squeeze()
-                
-                # AR() process
-                forecastCascade[:,:,l] =  phi[l,0] * extrapolationCascadeLag1[:,:,l] \
-                                               + phi[l,1] * extrapolationCascadeLag2[:,:,l] \
-                                               + np.sqrt(noiseVariance)*noiseShockTerm#noiseCascade[:,:,l]
+            # AR() process
+            forecastCascade[:,:,l] =  phi[l,0] * extrapolationCascadeLag1[:,:,l] \
+                                           + phi[l,1] * extrapolationCascadeLag2[:,:,l] \
+                                           + np.sqrt(noiseVariance)*noiseShockTerm#noiseCascade[:,:,l]
 
-                #forecastCascade[:,:,l] = (forecastCascade[:,:,l] - forecastCascade[:,:,l].mean())/forecastCascade[:,:,l].std()   
-                
-                # recompose the cascade 
-                memberForecast += forecastCascade[:,:,l] * cascadeStdStack[-1][l] + cascadeMeanStack[-1][l]
-                
-            # update the stacks
-            # noiseCascadeLag2 = noiseCascadeLag1.copy()
-            # noiseCascadeLag1 = noiseCascade.copy()
-            extrapolationCascadeLag2 = extrapolationCascadeLag1.copy()
-            extrapolationCascadeLag1 = forecastCascade.copy()
-                    
-            # add back the dBZ threshold 
-            memberForecast += radarStack[-1].dbzThreshold  
-                
-            # probability matching
-            # memberForecast = ssft.quantile_transformation(memberForecast,dbzStack[-1].copy() + radarStack[-1].dbzThreshold)    
-            memberForecast = ssft.quantile_transformation(memberForecast,target[:,:,t])    
+            #forecastCascade[:,:,l] = (forecastCascade[:,:,l] - forecastCascade[:,:,l].mean())/forecastCascade[:,:,l].std()   
             
-            # Apply the zeros and convert to rainrates
-            memberForecast[memberForecast<=radarStack[-1].dbzThreshold] = 0
-            memberForecast = dt.reflectivity2rainrate(memberForecast)
-            # memberForecast[memberForecast<=radarStack[-1].rainThreshold] = np.nan 
+            # recompose the cascade 
+            memberForecast += forecastCascade[:,:,l] * cascadeStdStack[-1][l] + cascadeMeanStack[-1][l]
             
-            # Apply radar mask
-            # memberForecast *= radarMask[:,:,t]       
-            # memberForecast[radarMask[:,:,t]==0] = np.nan   
-
-            # extract middle domain and renormalize the field        
-            memberForecast = dt.extract_middle_domain(memberForecast, finalDomainSize, finalDomainSize) 
-            
-            # plt.clf()
-            # plt.imshow(memberForecast,interpolation='none')
-            # plt.colorbar()
-            # plt.pause(.1) 
+        # update the stacks
+        # noiseCascadeLag2 = noiseCascadeLag1.copy()
+        # noiseCascadeLag1 = noiseCascade.copy()
+        extrapolationCascadeLag2[:,:,:] = extrapolationCascadeLag1
+        extrapolationCascadeLag1[:,:,:] = forecastCascade
+                
+        # add back the dBZ threshold 
+        memberForecast += dbzThreshold  
             
-            stochasticForecast[:,:,t,m] = memberForecast.copy()
-    
-            if m==0:
-                radarMask_final[:,:,t] = dt.extract_middle_domain(radarMask[:,:,t], finalDomainSize, finalDomainSize) 
-    
-    # final runnning time
-    tocTotal = time.time()
-    print('Total elapsed time: ', tocTotal - ticTotal, ' seconds.')
+        # probability matching
+        # memberForecast = ssft.quantile_transformation(memberForecast,dbzStack[-1].copy() + radarStack[-1].dbzThreshold)    
+        memberForecast = ssft.quantile_transformation_batch(memberForecast[None,:,:],rankedTarget[t])[0]
+        
+        # Apply the zeros and convert to rainrates
+        memberForecast[memberForecast<=dbzThreshold] = 0
+        memberForecast = dt.reflectivity2rainrate(memberForecast)
+        # memberForecast[memberForecast<=radarStack[-1].rainThreshold] = np.nan 
+        
+        # Apply radar mask
+        # memberForecast *= radarMask[:,:,t]       
+        # memberForecast[radarMask[:,:,t]==0] = np.nan   
+
+        # extract middle domain and renormalize the field        
+        memberForecast = dt.extract_middle_domain(memberForecast, finalDomainSize, finalDomainSize) 
+        
+        stochasticForecast[:,:,t,m] = memberForecast.copy()
+
+# state of the members forecast, inherited by the forked worker processes
+memberForecastState = {}
+
+def forecast_member_worker(m):
+    forecast_member(m, memberForecastState['memberState'], memberForecastState['stochasticForecast'])
+    
+def forecast_members_parallel(memberState, NumberMembers, nworkers = 2, parallel = 'process'):
+    '''
+    Runs forecast_member for all members on a pool of nworkers, gives the same 
+    result as the serial loop.
+    parallel = 'process' forks worker processes that inherit memberState and write 
+    into a shared-memory stochasticForecast, parallel = 'thread' uses a thread pool 
+    (only useful if the advection routine releases the GIL).
+    '''
+    finalDomainSize = memberState['finalDomainSize']
+    forecastShape = (finalDomainSize,finalDomainSize,memberState['NumberLeadtimes'],NumberMembers)
+    
+    if parallel == 'thread':
+        stochasticForecast = np.zeros(forecastShape)
+        pool = multiprocessing.pool.ThreadPool(nworkers)
+        pool.map(lambda m: forecast_member(m, memberState, stochasticForecast), range(NumberMembers))
+        pool.close()
+        pool.join()
+    elif parallel == 'process':
+        # the worker processes must be forked to inherit the state
+        if hasattr(multiprocessing,'get_context'):
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing
+        sharedArray = multiprocessing.sharedctypes.RawArray('d', int(np.prod(forecastShape)))
+        stochasticForecast = np.frombuffer(sharedArray).reshape(forecastShape)
+        memberForecastState['memberState'] = memberState
+        memberForecastState['stochasticForecast'] = stochasticForecast
+        try:
+            pool = context.Pool(nworkers)
+            pool.map(forecast_member_worker, range(NumberMembers))
+            pool.close()
+            pool.join()
+        finally:
+            memberForecastState.clear()
+        stochasticForecast = stochasticForecast.copy()
+    else:
+        print('Error: unknown parallel mode', parallel);sys.exit()
+        
+    return stochasticForecast
     
-    return stochasticForecast,timestamps,radarMask_final
     
-def move_field1_to_field2(field1,field2):
+def move_field1_to_field2(field1,field2,timeStamps=None,product=''):
 
     # to dBZ
     field1dBZ, _, _ = dt.rainrate2reflectivity(field1)
@@ -351,7 +450,7 @@ def move_field1_to_field2(field1,field2):
     fieldStack.append(field2dBZ)
     
     # generate vectors field1 -> field2
-    U,V = get_motion_field(fieldStack,verbose=0)
+    U,V = get_motion_field(fieldStack,verbose=0,timeStamps=timeStamps,product=product)
     
     # translate field1 -> field2
     field1moved = compute_advection(field1,U,V)[:,:,0]
@@ -359,45 +458,59 @@ def move_field1_to_field2(field1,field2):
 
     return field1moved,U,V
     
-# retrieve n last radar images 
+# radar images kept between calls, one stack per (product, domain size, rain threshold).
+# Only the maxRadarStacks most recently used stacks are kept.
+radarStacks = collections.OrderedDict()
+maxRadarStack = 12
+maxRadarStacks = 2
+
+def get_radar_stack(domainSize, product = 'RZC', rainThreshold = 0.08):
+    key = (product, domainSize, rainThreshold)
+    if key in radarStacks:
+        # move it to the end (most recently used)
+        radarStacks[key] = radarStacks.pop(key)
+    else:
+        radarStacks[key] = io.Radar_stack(maxRadarStack, product=product, fftDomainSize=domainSize, minR=rainThreshold)
+        while len(radarStacks) > maxRadarStacks:
+            _,oldest = radarStacks.popitem(last=False)
+            oldest.clear()
+    return radarStacks[key]
+    
+def clear_radar_stacks(product = None):
+    '''
+    Drops the radar images kept between calls (of all products if product is None), 
+    so that the next calls read new Radar_objects.
+    '''
+    for key in list(radarStacks.keys()):
+        if (product is None) or (key[0] == product):
+            radarStacks.pop(key).clear()
+
+# retrieve n last radar images (only the ones not read yet)
 def get_n_last_radar_image(timeStampStr, nimages, domainSize, product = 'RZC', rainThreshold = 0.08):
-    timeStamp = ti.timestring2datetime(timeStampStr)
-    radarStack = []
-    nextTimeStamp = timeStamp
-    for n in xrange(nimages):
-        nextTimeStampStr = ti.datetime2timestring(nextTimeStamp)
-        if product == 'RZC':
-            r = io.read_bin_image(nextTimeStampStr,fftDomainSize=domainSize,product=product, minR = rainThreshold) # get full extent of the radar image
-        else:
-            r = io.read_gif_image(nextTimeStampStr,fftDomainSize=domainSize,product=product, minR = rainThreshold) # get full extent of the radar image
-        radarStack.insert(0,r)
-        nextTimeStamp = nextTimeStamp - datetime.timedelta(minutes=5)
-    return radarStack
+    '''
+    The returned Radar_objects are shared with the other callers and the next calls 
+    (they stay in the radar stack), they must be used read-only: copy the fields 
+    before modifying them and do not set attributes on the objects. 
+    Use clear_radar_stacks to get new objects.
+    '''
+    radarStack = get_radar_stack(domainSize, product, rainThreshold)
+    return radarStack.get_n_last(timeStampStr, nimages)
 
-# retrieve n next radar images 
+# retrieve n next radar images (only the ones not read yet)
 def get_n_next_radar_image(timeStampStr, nimages, domainSize, product = 'RZC', rainThreshold = 0.08):
-    timeStamp = ti.timestring2datetime(timeStampStr)
-    radarStack = []
-    nextTimeStamp = timeStamp
-    for n in xrange(nimages):
-        nextTimeStampStr = ti.datetime2timestring(nextTimeStamp)
-        if product=='RZC':
-            r = io.read_bin_image(nextTimeStampStr,fftDomainSize=domainSize,product=product, minR = rainThreshold)
-        else:
-            r = io.read_gif_image(nextTimeStampStr,fftDomainSize=domainSize,product=product, minR = rainThreshold)
-        radarStack.append(r)
-        nextTimeStamp = nextTimeStamp + datetime.timedelta(minutes=5)
-    return radarStack
+    '''
+    Same as get_n_last_radar_image, the returned Radar_objects are shared and read-only.
+    '''
+    radarStack = get_radar_stack(domainSize, product, rainThreshold)
+    return radarStack.get_n_next(timeStampStr, nimages)
     
 # crop image at the largest possible square size and fill with zeros to achieve desired buffer of zeros
 def extract_dBZ_and_buffer(radarStack, domainSize, buffer):
     dbzStack = []
     buffer = int(buffer)
     for n in xrange(len(radarStack)):
-        # extract full dBZ field
-        dbzTmp = radarStack[n].dBZFourier.copy()
-        # remove the dbZ threshold
-        dbzTmp = dbzTmp - radarStack[n].dbzThreshold
+        # extract full dBZ field and remove the dbZ threshold
+        dbzTmp = radarStack[n].dBZFourier - radarStack[n].dbzThreshold
         # crop
         if n==0:
             min_size = np.min(dbzTmp.shape)
@@ -410,8 +523,21 @@ def extract_dBZ_and_buffer(radarStack, domainSize, buffer):
         dbzStack.append(dbzTmp_buffered)
     return dbzStack
 
+# cache of the sparse motion vectors (row, col, u, v) of each pair of consecutive images, 
+# keyed by (timestamp pair, product, domain size, threshold, digest of the pair, optical flow parameters)
+motionVectorsCache = collections.OrderedDict()
+maxMotionVectorsCache = 100
+
 # compute the motion field using all available images    
-def get_motion_field(dbzStack, verbose=1, doplot=0, resKm=1, resMin = 5):
+def get_motion_field(dbzStack, verbose=1, doplot=0, resKm=1, resMin = 5, timeStamps=None, product='', cacheDir=None, threshold=None):
+    '''
+    Computes the motion field from the optical flow of all the consecutive pairs of 
+    images in dbzStack. If the timeStamps of the images are given, the sparse motion 
+    vectors of each pair are cached in memory (and in cacheDir if given) so that the 
+    next nowcast cycle only needs to track the newest pair. The cache key also holds 
+    the rain/dBZ threshold of the fields and a digest of the contents of the pair, so 
+    that different fields with the same time stamps never share their vectors.
+    '''
 
     if verbose:
         print('________start of OF routine___________')
@@ -430,6 +556,7 @@ def get_motion_field(dbzStack, verbose=1, doplot=0, resKm=1, resMin = 5):
     maxSpeedKMHR = 120 # Maximum allowed speed [km/hr]
     nrIQRoutlier = 3 # Nr of IQR above median to consider the vector as outlier (if < 100 km/hr)
     
+    ofParams = (maxCornersST, qualityLevelST, minDistanceST, blockSizeST, winsizeLK, nrLevelsLK, maxSpeedKMHR, nrIQRoutlier, resKm, resMin)
     #+++++++++++ 
     
     nrOfFields = len(dbzStack)
@@ -443,6 +570,21 @@ def get_motion_field(dbzStack, verbose=1, doplot=0, resKm=1, resMin = 5):
         if verbose:
             print('(%i) -------------' % n)
         
+        # look for the vectors of this pair in the cache
+        if timeStamps is not None:
+            key = (timestamp2str(timeStamps[n]), timestamp2str(timeStamps[n+1]), product, dbzStack[n].shape, threshold, \
+                get_fields_digest(dbzStack[n], dbzStack[n+1])) + ofParams
+            vectors = get_cached_motion_vectors(key, cacheDir)
+            if vectors is not None:
+                row, col, u, v = vectors
+                if verbose:
+                    print('Nr of cached vectors              =', len(row))
+                rowStack.append(row)
+                colStack.append(col)
+                uStack.append(u)
+                vStack.append(v)
+                continue
+        
         # extract consecutive images
         prvs = dbzStack[n].copy()
         next = dbzStack[n+1].copy()
@@ -486,6 +628,9 @@ def get_motion_field(dbzStack, verbose=1, doplot=0, resKm=1, resMin = 5):
         row = row[keep].reshape(np.sum(keep),1)
         col = col[keep].reshape(np.sum(keep),1)
         
+        if timeStamps is not None:
+            set_cached_motion_vectors(key, (row, col, u, v), cacheDir)
+        
         # (4) stack vectors within time window
         rowStack.append(row)
         colStack.append(col)
@@ -506,7 +651,7 @@ def get_motion_field(dbzStack, verbose=1, doplot=0, resKm=1, resMin = 5):
         print("Nr of points OF after declustering (R=%i) = %i" % (Rsize,len(row)))
         
     # (7) kernel interpolation
-    domainSize = [next.shape[0], next.shape[1]]
+    domainSize = [dbzStack[-1].shape[0], dbzStack[-1].shape[1]]
     colgrid, rowgrid, U, V, b = of.interpolate_sparse_vectors_kernel(col, row, u, v, domainSize)#, b = kernelBandwidth/resKm)
     if verbose:
         print('Kernel bandwith = %.2f' % b)
@@ -519,27 +664,85 @@ def get_motion_field(dbzStack, verbose=1, doplot=0, resKm=1, resMin = 5):
         xs, ys, Us, Vs = of.reduce_field_density_for_plotting(colgrid, rowgrid, U, V, 30)
 
         # Plot vectors to check if correct
-        plt.imshow(next, interpolation='none')
+        plt.imshow(dbzStack[-1], interpolation='none')
         plt.quiver(xs, ys, Us, Vs,angles = 'xy', scale_units='xy')
         plt.show()
         
     return U,V
 
-def compute_advection(field,U,V,net=1):
+def timestamp2str(timeStamp):
+    if isinstance(timeStamp, datetime.datetime):
+        return ti.datetime2timestring(timeStamp)
+    return str(timeStamp)
+    
+def get_fields_digest(*fields):
+    # cheap digest of the contents of the fields (to identify a pair of images in the cache)
+    digest = hashlib.md5()
+    for field in fields:
+        digest.update(np.ascontiguousarray(field).view(np.uint8))
+    return digest.hexdigest()[:16]
+    
+def get_filename_motion_vectors(cacheDir, key):
+    # readable prefix and a hash of the full key (domain size and optical flow parameters)
+    keyHash = hashlib.md5(repr(key).encode('utf-8')).hexdigest()[:10]
+    fileName = 'motion_vectors_%s_%s_%s_%s.npz' % (key[2], key[0], key[1], keyHash)
+    return os.path.join(cacheDir, fileName)
+    
+def get_cached_motion_vectors(key, cacheDir=None):
+    if key in motionVectorsCache:
+        return motionVectorsCache[key]
+    if cacheDir is not None:
+        fileName = get_filename_motion_vectors(cacheDir, key)
+        if os.path.isfile(fileName):
+            data = np.load(fileName)
+            vectors = (data['row'], data['col'], data['u'], data['v'])
+            set_cached_motion_vectors(key, vectors)
+            return vectors
+    return None
+    
+def set_cached_motion_vectors(key, vectors, cacheDir=None):
+    motionVectorsCache[key] = vectors
+    while len(motionVectorsCache) > maxMotionVectorsCache:
+        motionVectorsCache.popitem(last=False)
+    if cacheDir is not None:
+        row, col, u, v = vectors
+        io.save_atomic(get_filename_motion_vectors(cacheDir, key), lambda fileNameTmp: np.savez(fileNameTmp, row=row, col=col, u=u, v=v))
+
+def resize_motion_field(U,V,f=0.3):
     # resize motion fields by factor f (for advection)
-    f = 0.3
     if (f<1):
         Ures = cv2.resize(U, (0,0), fx=f, fy=f)
         Vres = cv2.resize(V, (0,0), fx=f, fy=f) 
     else:
         Ures = U
         Vres = V
+    return Ures,Vres
+
+def compute_advection(field,U,V,net=1):
+    # resize motion fields by factor f (for advection)
+    Ures,Vres = resize_motion_field(U,V)
 
     # Call MAPLE routine for advection
     field_lag = maple_ree.ree_epol_slio(field, Vres, Ures, net)
     # field_lag = np.squeeze(field_lag)
     return field_lag
     
+def compute_advection_levels(fields,Ures,Vres,net=1,out=None):
+    '''
+    Advects a block of fields (rows, cols, levels) by net time steps with a single 
+    call to the MAPLE routine. Ures and Vres are the already resized motion fields 
+    (see resize_motion_field). The result is written in out if it is a float32 
+    Fortran-ordered array of the same shape, otherwise a new array is returned.
+    '''
+    if out is None:
+        out = np.zeros(fields.shape, dtype=np.float32, order='F')
+    
+    # Call MAPLE routine for advection
+    fields_lag = maple_ree.ree_epol_slio_levels(fields, out, Vres, Ures, net)
+    if fields_lag is not out:
+        out[...] = fields_lag
+    return out
+    
 def advect_radar_to_t0(dbzStack,U,V):
     nrOfFields = len(dbzStack)
     
@@ -550,367 +753,400 @@ def advect_radar_to_t0(dbzStack,U,V):
         
     dbzStack_at_t0.append(dbzStack[-1].copy())    
     
-def calculate_bandpass_filter(FFTShape, NumberLevels, Width = 2.0, resKm=1, doplot=False):
+# in-memory cache of the band pass filters, keyed by (FFTShape, NumberLevels, Width, resKm)
+bandpassFilterCache = {}
+
+def calculate_bandpass_filter(FFTShape, NumberLevels, Width = 2.0, resKm=1, doplot=False, cacheDir=None):
     """
     Method to construct the band pass filters needed for each level in the cascade.
+    The filters are kept in memory and, if cacheDir is given, also stored on disk,
+    so that repeated calls with the same (FFTShape, NumberLevels, Width, resKm) 
+    do not rebuild them. The returned filters are read-only.
     
     """
-    if NumberLevels>1:
-        FFTSize = FFTShape[0]
-        NumberRows, NumberCols = FFTShape
-        CascadeSize = np.max((NumberRows, NumberCols))
-        ScaleRatio = ( 2.0/CascadeSize )**( 1.0/(NumberLevels - 1) )
-        # while ( ScaleRatio < 0.42 ):
-                # NumberLevels+=1
-                # ScaleRatio = ( 2.0/CascadeSize )**( 1.0/(NumberLevels - 1) )
-        # ScaleRatio = 0.5
-        
-        Nyquest = int(FFTSize/2)
-        FFTStride = Nyquest + 1
-        CentreWaveLength = CascadeSize
-        
-        # Initialiaze variables
-        BandpassFilter = np.zeros((NumberLevels,Nyquest**2))
-        BandpassFilter1D = np.zeros(NumberLevels*Nyquest)
-        BandpassFilter1D[0] = 1.0
-        FilterSum = np.zeros(Nyquest) # Sum of the filters
-        NormFactor = np.zeros(Nyquest) # Normalisation to sum  = 1
-        
-        # Start the loop over the levels in the cascade
-        CentreWaveLengths = np.zeros(NumberLevels)
-        for Level in xrange(NumberLevels):
-            CentreFreq = 1.0/CentreWaveLength
-            CentreWaveLengths[Level] = CentreWaveLength.copy()
-            for WaveNumber in xrange(1,Nyquest):
-                Freq = WaveNumber/FFTSize
-                if ( Freq > CentreFreq ):
-                    RelFrequency = Freq/CentreFreq 
-                else:
-                    RelFrequency = CentreFreq/Freq
-                Filter = np.exp(-Width*RelFrequency)
-                BandpassFilter1D[WaveNumber+Level*Nyquest] = Filter
-                FilterSum[WaveNumber] += Filter 
-                
-            CentreWaveLength *= ScaleRatio
-        
-        # loop over the wave numbers and calculate the normalisation factor
-        for WaveNumber in xrange(1,Nyquest):
-            NormFactor[WaveNumber] = 1.0/FilterSum[WaveNumber] 
-        
-        # Normalise the filters so that each wave number sums to one    
-        for Level in xrange(NumberLevels):
-            for WaveNumber in xrange(1,Nyquest):
-                Filter =  BandpassFilter1D[WaveNumber+Level*Nyquest]*NormFactor[WaveNumber]
-                if ( Filter < 0.001 ):
-                    Filter = 0.0
-                BandpassFilter1D[WaveNumber+Level*Nyquest] = Filter 
-        
-        # Okay, we've generated a 1D filter, now predetermine the 2D filter radarMask for each level
-        BandpassFilter2D = np.zeros((NumberLevels,FFTShape[0],FFTShape[1]))
-        for Level in xrange(NumberLevels):
-            FilterOffset = Level * Nyquest
-            for Row in np.arange(0,Nyquest):
-                RowIdx = Row * Nyquest
-                RowSqr = Row * Row
-                
-                for Col in xrange(Nyquest):
-                    CurrentWaveNumber = np.sqrt(RowSqr + Col*Col)
-                    if (CurrentWaveNumber <= Nyquest):
-                        BandpassFilter[Level,RowIdx + Col] += BandpassFilter1D[int(FilterOffset + CurrentWaveNumber)]
-            # Finally, construct the full 2D filter
-            count=0
-            idxi = np.zeros(2,dtype=int)
-            idxj = np.zeros(2,dtype=int)
-            for r in xrange(2):
-                for c in xrange(2):
-                    subFilter2d = BandpassFilter[Level,:].copy().reshape((Nyquest,Nyquest))
-                    subFilter2d = np.rot90(subFilter2d[0:Nyquest,0:Nyquest],-1*count)
-                    if r>0:
-                        subFilter2d = np.fliplr(subFilter2d)
-                    idxi[0] = r*Nyquest
-                    idxi[1] = ((r+1)*Nyquest)
-                    idxj[0] = c*Nyquest
-                    idxj[1] = ((c+1)*Nyquest)
-                    BandpassFilter2D[Level,idxi[0]:idxi[1],idxj[0]:idxj[1]] += subFilter2d
-                    count+=1
-             
-        # shift the filter 
-        FilterSum = np.sum(BandpassFilter2D,0)    
-        lastFilter = BandpassFilter2D[-1,:,:]
-        lastFilter[FilterSum==0] = 1
-        BandpassFilter2D[-1,:,:] = lastFilter
-        
-        if doplot:
-            plt.close()
-            print('ScaleRatio = ', ScaleRatio,', n levels = ',NumberLevels)
-            # Plot the filters
-            # create ticks in km
-            ticksList = []
-            tickLocal = FFTSize*resKm
-            for i in xrange(0,20):
-                ticksList.append(tickLocal)
-                tickLocal = tickLocal/2
-                if tickLocal < resKm:
-                    break
-            ticks = np.array(ticksList)
-            ticks_loc = 10.0*np.log10(1/ticks)
-            ticksStr = ["%1.0f" % tick for tick in ticks]
-            fig = plt.figure()
-            ax = fig.add_subplot(111)
-            ax.set_prop_cycle('color',plt.cm.tab10(np.linspace(0,1,NumberLevels)))
-            for Level in xrange(NumberLevels):
-                filter2d = BandpassFilter2D[Level,:,:]
-                filter1d = filter2d[0,0:FFTStride+1]
-                freq = np.linspace(1/(FFTSize*resKm),1/(2*resKm),filter1d.size)
-                ax.plot(10*np.log10(freq),filter1d)
-                ax.set_aspect('auto')
-                ax.set_ylim([0,1.1])
-                ax.set_xticks(ticks_loc)
-                ax.set_xticklabels(ticksStr)
-                ha='center'
-                if Level==0 :
-                    ha='left'
-                elif Level==NumberLevels-1:
-                    ha='right'   
-                xpeak = freq[np.argmax(filter1d)]       
-                ax.text(10*np.log10(xpeak),1.02,'Level %i' % Level,va='bottom',ha=ha,fontsize=14)
-            plt.xlim([10*np.log10(freq[1/freq==512]),10*np.log10(freq[1/freq==resKm*2])])
-            # plt.title('Band-pass filters for cascade levels')
-            plt.ylabel('Filter value []',fontsize=14)
-            plt.xlabel('Wavelength [km]',fontsize=14)
-            # plt.show()
-            plt.tight_layout()
-            plt.savefig('fig_bandpass_filter_1d_%ilevels.pdf' % NumberLevels)
-            print('Saved: fig_bandpass_filter_1d_%ilevels.pdf' % NumberLevels)
+    key = (tuple(FFTShape), NumberLevels, float(Width), resKm)
+    if key in bandpassFilterCache:
+        BandpassFilter2D, CentreWaveLengths = bandpassFilterCache[key]
     else:
-        BandpassFilter2D = np.ones((1,FFTShape[0],FFTShape[1]))
-        CentreWaveLengths = np.zeros(NumberLevels)
+        if cacheDir is not None:
+            fileName = get_filename_bandpass_filter(cacheDir, FFTShape, NumberLevels, Width, resKm)
+        if (cacheDir is not None) and os.path.isfile(fileName):
+            data = np.load(fileName)
+            BandpassFilter2D = data['BandpassFilter2D']
+            CentreWaveLengths = data['CentreWaveLengths']
+        else:
+            BandpassFilter2D, CentreWaveLengths = build_bandpass_filter(FFTShape, NumberLevels, Width)
+            if cacheDir is not None:
+                io.save_atomic(fileName, lambda fileNameTmp: np.savez(fileNameTmp, \
+                                BandpassFilter2D=BandpassFilter2D, CentreWaveLengths=CentreWaveLengths))
+        BandpassFilter2D.setflags(write=False)
+        bandpassFilterCache[key] = (BandpassFilter2D, CentreWaveLengths)
+    
+    if doplot and (NumberLevels>1):
+        plot_bandpass_filter(BandpassFilter2D, resKm)
         
     return BandpassFilter2D,CentreWaveLengths*resKm  
- 
-def get_cascade_from_stack(dbzStack, NumberLevels, BandpassFilter2D, CentreWaveLengths, zerothr = None, zeroPadding = 0, verbose=0, doplot=0):
+
+def get_filename_bandpass_filter(cacheDir, FFTShape, NumberLevels, Width = 2.0, resKm=1):
+    fileName = 'bandpass_filter_%ix%i_%ilevels_w%.2f_res%s.npz' % (FFTShape[0], FFTShape[1], NumberLevels, Width, str(resKm))
+    return os.path.join(cacheDir, fileName)
     
-    nrOfFields = len(dbzStack)
-    cascadeStack = []
-    cascadeMeanStack = []
-    cascadeStdStack = []
-    for n in xrange(nrOfFields):
+def build_bandpass_filter(FFTShape, NumberLevels, Width = 2.0):
+    """
+    Vectorized construction of the 2D band pass filters (no caching). 
+    Each 2D filter is obtained by looking up the normalised 1D filter at the radial 
+    wavenumber of every pixel of one quadrant, which is then rotated/flipped into the 
+    four quadrants of the (unshifted) FFT.
+    
+    """
+    if NumberLevels<=1:
+        BandpassFilter2D = np.ones((1,FFTShape[0],FFTShape[1]))
+        CentreWaveLengths = np.zeros(NumberLevels)
+        return BandpassFilter2D,CentreWaveLengths
+        
+    FFTSize = FFTShape[0]
+    NumberRows, NumberCols = FFTShape
+    CascadeSize = np.max((NumberRows, NumberCols))
+    ScaleRatio = ( 2.0/CascadeSize )**( 1.0/(NumberLevels - 1) )
+    Nyquest = int(FFTSize/2)
+    
+    # centre wavelength of each level
+    CentreWaveLengths = np.zeros(NumberLevels)
+    CentreWaveLength = CascadeSize
+    for Level in xrange(NumberLevels):
+        CentreWaveLengths[Level] = CentreWaveLength
+        CentreWaveLength *= ScaleRatio
+    
+    # 1D filters (levels x wave numbers)
+    Freq = np.arange(1,Nyquest)/FFTSize
+    CentreFreq = 1.0/CentreWaveLengths[:,None]
+    RelFrequency = np.where(Freq > CentreFreq, Freq/CentreFreq, CentreFreq/Freq)
+    Filter = np.exp(-Width*RelFrequency)
+    
+    # normalise the filters so that each wave number sums to one
+    NormFactor = 1.0/np.sum(Filter,axis=0)
+    Filter = Filter*NormFactor
+    Filter[Filter < 0.001] = 0.0
+    
+    # wave number 0 belongs to the first level, wave numbers >= Nyquest are filtered out
+    BandpassFilter1D = np.zeros((NumberLevels,Nyquest+1))
+    BandpassFilter1D[0,0] = 1.0
+    BandpassFilter1D[:,1:Nyquest] = Filter
+    
+    # radial wave number of each pixel in one quadrant
+    Rows,Cols = np.ogrid[0:Nyquest,0:Nyquest]
+    CurrentWaveNumber = np.sqrt(Rows*Rows + Cols*Cols)
+    WaveNumberIdx = np.minimum(CurrentWaveNumber,Nyquest).astype(int)
+    BandpassFilter = BandpassFilter1D[:,WaveNumberIdx]
+    BandpassFilter[:,CurrentWaveNumber > Nyquest] = 0.0
+    
+    # construct the full 2D filter from the four quadrants
+    BandpassFilter2D = np.zeros((NumberLevels,FFTShape[0],FFTShape[1]))
+    count=0
+    for r in xrange(2):
+        for c in xrange(2):
+            subFilter2d = np.rot90(BandpassFilter,-1*count,axes=(1,2))
+            if r>0:
+                subFilter2d = subFilter2d[:,:,::-1]
+            BandpassFilter2D[:,r*Nyquest:(r+1)*Nyquest,c*Nyquest:(c+1)*Nyquest] += subFilter2d
+            count+=1
+            
+    # assign the remaining wave numbers to the last level
+    FilterSum = np.sum(BandpassFilter2D,0)
+    BandpassFilter2D[-1,FilterSum==0] = 1
     
-        InputMap = dbzStack[n].copy()
+    return BandpassFilter2D,CentreWaveLengths
 
-        FFTSize = InputMap.shape[0]
-        Nyquest = FFTSize/2
+def plot_bandpass_filter(BandpassFilter2D, resKm=1):
+    
+    NumberLevels = BandpassFilter2D.shape[0]
+    FFTSize = BandpassFilter2D.shape[1]
+    CascadeSize = np.max(BandpassFilter2D.shape[1:])
+    ScaleRatio = ( 2.0/CascadeSize )**( 1.0/(NumberLevels - 1) )
+    FFTStride = int(FFTSize/2) + 1
+    
+    plt.close()
+    print('ScaleRatio = ', ScaleRatio,', n levels = ',NumberLevels)
+    # Plot the filters
+    # create ticks in km
+    ticksList = []
+    tickLocal = FFTSize*resKm
+    for i in xrange(0,20):
+        ticksList.append(tickLocal)
+        tickLocal = tickLocal/2
+        if tickLocal < resKm:
+            break
+    ticks = np.array(ticksList)
+    ticks_loc = 10.0*np.log10(1/ticks)
+    ticksStr = ["%1.0f" % tick for tick in ticks]
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    ax.set_prop_cycle('color',plt.cm.tab10(np.linspace(0,1,NumberLevels)))
+    for Level in xrange(NumberLevels):
+        filter2d = BandpassFilter2D[Level,:,:]
+        filter1d = filter2d[0,0:FFTStride+1]
+        freq = np.linspace(1/(FFTSize*resKm),1/(2*resKm),filter1d.size)
+        ax.plot(10*np.log10(freq),filter1d)
+        ax.set_aspect('auto')
+        ax.set_ylim([0,1.1])
+        ax.set_xticks(ticks_loc)
+        ax.set_xticklabels(ticksStr)
+        ha='center'
+        if Level==0 :
+            ha='left'
+        elif Level==NumberLevels-1:
+            ha='right'   
+        xpeak = freq[np.argmax(filter1d)]       
+        ax.text(10*np.log10(xpeak),1.02,'Level %i' % Level,va='bottom',ha=ha,fontsize=14)
+    plt.xlim([10*np.log10(freq[1/freq==512]),10*np.log10(freq[1/freq==resKm*2])])
+    # plt.title('Band-pass filters for cascade levels')
+    plt.ylabel('Filter value []',fontsize=14)
+    plt.xlabel('Wavelength [km]',fontsize=14)
+    # plt.show()
+    plt.tight_layout()
+    plt.savefig('fig_bandpass_filter_1d_%ilevels.pdf' % NumberLevels)
+    print('Saved: fig_bandpass_filter_1d_%ilevels.pdf' % NumberLevels)
+ 
+class CascadeEngine(object):
+    """
+    Batched FFT cascade decomposition of a stack of fields (nfields, ny, nx).
+    One real-to-complex FFT is computed per field, all levels are filtered with a 
+    single broadcasted multiplication and transformed back with one batched inverse 
+    FFT. The last level holds the residuals, as in get_cascade_from_stack.
+    If pyfftw is available, the FFTW plans are built once per batch shape and reused.
+    
+    Parameters
+    ----------
+    BandpassFilter2D : np.array(NumberLevels, ny, nx)
+        band pass filters from calculate_bandpass_filter (for the zero padded shape).
+    zeroPadding : int
+        number of pixels of zeros added on each side before the FFT.
+    nthreads : int
+        number of threads used by FFTW.
+    chunkSize : int
+        maximum number of fields transformed together (bounds the memory of the 
+        (chunkSize, NumberLevels, ny, nx) spectra).
+    usefftw : bool
+        use pyfftw if available, numpy.fft otherwise.
+    """
+    
+    def __init__(self, BandpassFilter2D, zeroPadding = 0, nthreads = 1, chunkSize = 4, usefftw = True):
         
-        Cascade = np.zeros((FFTSize,FFTSize,NumberLevels))
-        CascadeMean = np.zeros(NumberLevels)
-        CascadeStd = np.zeros(NumberLevels)
+        self.NumberLevels = BandpassFilter2D.shape[0]
+        self.FFTShape = BandpassFilter2D.shape[1:]
+        self.zeroPadding = int(zeroPadding)
+        self.nthreads = nthreads
+        self.chunkSize = int(chunkSize)
+        self.usefftw = usefftw and (pyfftw is not None)
+        self.plans = {}
         
-        # Zero padding
-        if zeroPadding > 0:
-            InputMap = cv2.copyMakeBorder(InputMap,zeroPadding,zeroPadding,zeroPadding,zeroPadding,cv2.BORDER_CONSTANT,0)
-                
-        # Calculate the FFT
-        fftNoShift = np.fft.fft2(InputMap)
+        # keep only the half spectrum of the filters of the non-residual levels.
+        # The filters are symmetrized, F(k) -> (F(k) + F(-k))/2, so that the inverse 
+        # real FFT gives the same result as np.real(np.fft.ifft2(fft*F))
+        Filters = BandpassFilter2D[:-1,:,:]
+        FiltersMirror = np.roll(np.roll(Filters[:,::-1,::-1],1,axis=1),1,axis=2)
+        nxHalf = int(self.FFTShape[1]/2) + 1
+        self.halfFilters = 0.5*(Filters + FiltersMirror)[:,:,:nxHalf]
         
-        # For each level, filter the transform and place the data into the cascade
-        if (verbose==1) and (n==0):
-            print('Applying the filters',end="")
-            stdout.flush()
+    def rfft2(self, fields):
+        if not self.usefftw:
+            return np.fft.rfft2(fields)
+        key = ('rfft2',) + fields.shape
+        if key not in self.plans:
+            self.plans[key] = pyfftw.builders.rfft2(pyfftw.empty_aligned(fields.shape, dtype='float64'), \
+                                threads=self.nthreads, planner_effort='FFTW_ESTIMATE')
+        return self.plans[key](fields)
         
-        for Level in xrange(NumberLevels):
-            if verbose==1:
-                print('.',end="")
-                stdout.flush()
-                       
-            FFTPassedOut = np.zeros_like(fftNoShift)
-            
-            # Extract the filter for the given level
-            Filter = BandpassFilter2D[Level,:,:].copy()
-
-            # Apply the filter        
-            FFTPassedOut =  fftNoShift * Filter
-                    
-            # Calculate the inverse ff
-            new_image = np.real(np.fft.ifft2(FFTPassedOut)) 
-            
-            # Crop the zero edges
-            if zeroPadding > 0:
-                new_image = new_image[zeroPadding:-zeroPadding,zeroPadding:-zeroPadding]
-            
-            if zerothr is None:
-                CascadeMean[Level] = new_image.mean()
-                CascadeStd[Level] = new_image.std()
-                Cascade[:,:,Level] = (new_image - CascadeMean[Level]) / CascadeStd[Level]
-            else:
-                wet_pixels = new_image > zerothr
-                
-                CascadeMean[Level] = new_image[wet_pixels].mean()
-                CascadeStd[Level] = new_image[wet_pixels].std()
-                new_image = (new_image - CascadeMean[Level]) / CascadeStd[Level]
-                # new_image[~wet_pixels] = new_image[wet_pixels].min()
-                Cascade[:,:,Level] = new_image
-        
-        if zeroPadding > 0:
-                InputMap = InputMap[zeroPadding:-zeroPadding,zeroPadding:-zeroPadding]
+    def irfft2(self, spectra):
+        if not self.usefftw:
+            return np.fft.irfft2(spectra, s=self.FFTShape)
+        key = ('irfft2',) + spectra.shape
+        if key not in self.plans:
+            self.plans[key] = pyfftw.builders.irfft2(pyfftw.empty_aligned(spectra.shape, dtype='complex128'), \
+                                s=self.FFTShape, threads=self.nthreads, planner_effort='FFTW_ESTIMATE')
+        return self.plans[key](spectra)
         
-        # The k level is the residuals
-        k = NumberLevels-1
-        CascadeSum = np.zeros((FFTSize,FFTSize))
-        for LevelA in xrange(NumberLevels):
-            if LevelA!=k:
-                CascadeSum += Cascade[:,:,LevelA]*CascadeStd[LevelA] + CascadeMean[LevelA]
-        Residual = InputMap - CascadeSum
-        CascadeMean[k] = Residual.mean()
-        CascadeStd[k] = Residual.std()
-        Cascade[:,:,k] = (Residual - CascadeMean[k]) / CascadeStd[k]
+    def decompose(self, fields, zerothr = None, out = None, outMean = None, outStd = None):
+        """
+        Returns the normalized cascade (nfields, ny, nx, NumberLevels) and its mean and 
+        standard deviation (nfields, NumberLevels). The results are written in out, 
+        outMean and outStd if these are given.
+        """
+        fields = np.asarray(fields, dtype=float)
+        if fields.ndim == 2:
+            fields = fields[None,:,:]
+        nrOfFields = fields.shape[0]
+        NumberLevels = self.NumberLevels
+        zp = self.zeroPadding
         
-        if (doplot==1) and (n==(nrOfFields-1)):
+        if out is None:
+            out = np.zeros((nrOfFields,fields.shape[1],fields.shape[2],NumberLevels))
+        if outMean is None:
+            outMean = np.zeros((nrOfFields,NumberLevels))
+        if outStd is None:
+            outStd = np.zeros((nrOfFields,NumberLevels))
         
-            fsize = 14
+        k = NumberLevels-1 # the k level is the residuals
+        for i0 in xrange(0,nrOfFields,self.chunkSize):
+            i1 = np.min((i0 + self.chunkSize, nrOfFields))
+            InputMaps = fields[i0:i1,:,:]
             
-            if NumberLevels<3:
-                ncols=2
-            elif NumberLevels<7:
-                ncols=3
+            if k > 0:
+                # Zero padding
+                if zp > 0:
+                    paddedMaps = np.zeros((i1-i0,) + self.FFTShape)
+                    paddedMaps[:,zp:-zp,zp:-zp] = InputMaps
+                else:
+                    paddedMaps = InputMaps
+                
+                # Filter all levels at once and calculate the inverse fft
+                fftNoShift = self.rfft2(paddedMaps)
+                levels = self.irfft2(fftNoShift[:,None,:,:]*self.halfFilters[None,:,:,:]) # (fields, levels, rows, cols)
+                
+                # Crop the zero edges
+                if zp > 0:
+                    levels = levels[:,:,zp:-zp,zp:-zp]
+                Residual = InputMaps - levels.sum(axis=1)
             else:
-                ncols=4
-            
-            nrows = np.ceil(NumberLevels/ncols) #+ 1
-            
-            plt.close()
-            plt.figure(figsize=(5*ncols, 4.9*nrows))
-            
-            # plt.subplot(nrows,4,1)
-            # plt.title('Original image')
-            # plt.imshow(InputMap,interpolation='none',vmin=0,vmax=45)
-            # cbar = plt.colorbar()
-            # cbar.set_label('dBZ')
-            # plt.axis('off')
-            
-            # CascadeSum = np.zeros(InputMap.shape)
-            # for LevelA in xrange(NumberLevels):
-                # if LevelA!=k:
-                    # CascadeSum += Cascade[:,:,LevelA]*CascadeStd[LevelA] + CascadeMean[LevelA]
-            # plt.subplot(nrows,4,2)
-            # plt.title('Sum of levels 0 to %i' % (NumberLevels-2))
-            # plt.imshow(CascadeSum,interpolation='none',vmin=0,vmax=45)
-            # cbar=plt.colorbar()
-            # cbar.set_label('dBZ')
-            # plt.axis('off')
-
-            recon_image = np.zeros(InputMap.shape)
-            for nl in xrange(NumberLevels):
-                plt.subplot(nrows,ncols,1+nl)
-                plt.title('(%s) Level %i (%i km)' % (chr(97+nl),nl, CentreWaveLengths[nl]),fontsize=fsize)
-                if nl==NumberLevels-1:
-                    plt.title('(%s) Level %i (%i km + residuals)' % (chr(97+nl),nl, CentreWaveLengths[nl]),fontsize=fsize)
-                nlevel = Cascade[:,:,nl].copy()*CascadeStd[nl] + CascadeMean[nl] 
-                recon_image += nlevel
-                vmax = np.percentile(nlevel,99.0)
-                vmin = np.percentile(nlevel,1.0)
-                ax = plt.gca()
-                im = ax.imshow(nlevel,vmin=vmin,vmax=vmax,interpolation='none')
-                plt.axis('off')  
-                # plt.imshow(Cascade[:,:,nl],vmin=-5,vmax=5,interpolation='none')
-                divider = make_axes_locatable(ax)
-                cax = divider.append_axes("right", size="5%", pad=0.05)
-                cbar = plt.colorbar(im, cax=cax)
-                cbar.set_label('dBZ',fontsize=fsize)
+                levels = np.zeros((i1-i0,0) + InputMaps.shape[1:])
+                Residual = InputMaps.copy()
                 
+            # normalize the levels
+            if zerothr is None:
+                levelsMean = levels.mean(axis=(2,3))
+                levelsStd = levels.std(axis=(2,3))
+            else:
+                levelsMean = np.zeros((i1-i0,k))
+                levelsStd = np.zeros((i1-i0,k))
+                for i in xrange(i1-i0):
+                    for Level in xrange(k):
+                        wet_pixels = levels[i,Level,:,:] > zerothr
+                        levelsMean[i,Level] = levels[i,Level,:,:][wet_pixels].mean()
+                        levelsStd[i,Level] = levels[i,Level,:,:][wet_pixels].std()
+            outMean[i0:i1,:k] = levelsMean
+            outStd[i0:i1,:k] = levelsStd
+            out[i0:i1,:,:,:k] = ( (levels - levelsMean[:,:,None,None]) / levelsStd[:,:,None,None] ).transpose((0,2,3,1))
             
-            # plt.subplot(nrows,4,3)
-            # plt.title('Reconstructed image + residuals')
-            # plt.imshow(recon_image,interpolation='nearest',vmin=0,vmax=45)
-            # cbar = plt.colorbar()
-            # cbar.set_label('dBZ')
-            # plt.axis('off')
+            # and the residuals
+            outMean[i0:i1,k] = Residual.mean(axis=(1,2))
+            outStd[i0:i1,k] = Residual.std(axis=(1,2))
+            out[i0:i1,:,:,k] = (Residual - outMean[i0:i1,k,None,None]) / outStd[i0:i1,k,None,None]
+            
+        return out, outMean, outStd
+        
+def get_cascade_from_stack(dbzStack, NumberLevels, BandpassFilter2D, CentreWaveLengths, zerothr = None, zeroPadding = 0, verbose=0, doplot=0, engine=None):
+    
+    nrOfFields = len(dbzStack)
+    if engine is None:
+        engine = CascadeEngine(BandpassFilter2D, zeroPadding = zeroPadding)
+        
+    if verbose==1:
+        print('Applying the filters',end="")
+        stdout.flush()
+    
+    # decompose all fields at once
+    Cascades, CascadeMeans, CascadeStds = engine.decompose(np.array(dbzStack), zerothr = zerothr)
+    cascadeStack = [Cascades[n] for n in xrange(nrOfFields)]
+    cascadeMeanStack = [CascadeMeans[n] for n in xrange(nrOfFields)]
+    cascadeStdStack = [CascadeStds[n] for n in xrange(nrOfFields)]
+    
+    # The k level is the residuals
+    k = NumberLevels-1
+    
+    if doplot==1:
+        # plot the last field
+        Cascade = cascadeStack[-1]
+        CascadeMean = cascadeMeanStack[-1]
+        CascadeStd = cascadeStdStack[-1]
+        InputMap = np.asarray(dbzStack[-1])
+    
+        fsize = 14
+        
+        if NumberLevels<3:
+            ncols=2
+        elif NumberLevels<7:
+            ncols=3
+        else:
+            ncols=4
+        
+        nrows = np.ceil(NumberLevels/ncols) #+ 1
+        
+        plt.close()
+        plt.figure(figsize=(5*ncols, 4.9*nrows))
+        
+        # plt.subplot(nrows,4,1)
+        # plt.title('Original image')
+        # plt.imshow(InputMap,interpolation='none',vmin=0,vmax=45)
+        # cbar = plt.colorbar()
+        # cbar.set_label('dBZ')
+        # plt.axis('off')
+        
+        # CascadeSum = np.zeros(InputMap.shape)
+        # for LevelA in xrange(NumberLevels):
+            # if LevelA!=k:
+                # CascadeSum += Cascade[:,:,LevelA]*CascadeStd[LevelA] + CascadeMean[LevelA]
+        # plt.subplot(nrows,4,2)
+        # plt.title('Sum of levels 0 to %i' % (NumberLevels-2))
+        # plt.imshow(CascadeSum,interpolation='none',vmin=0,vmax=45)
+        # cbar=plt.colorbar()
+        # cbar.set_label('dBZ')
+        # plt.axis('off')
 
-            # plt.show()
-            plt.tight_layout()
-            plt.savefig('fig_cascade_decomposition_%ilevels.pdf' % NumberLevels)
-            print('Saved: fig_cascade_decomposition_%ilevels.pdf' % NumberLevels)
+        recon_image = np.zeros(InputMap.shape)
+        for nl in xrange(NumberLevels):
+            plt.subplot(nrows,ncols,1+nl)
+            plt.title('(%s) Level %i (%i km)' % (chr(97+nl),nl, CentreWaveLengths[nl]),fontsize=fsize)
+            if nl==NumberLevels-1:
+                plt.title('(%s) Level %i (%i km + residuals)' % (chr(97+nl),nl, CentreWaveLengths[nl]),fontsize=fsize)
+            nlevel = Cascade[:,:,nl].copy()*CascadeStd[nl] + CascadeMean[nl] 
+            recon_image += nlevel
+            vmax = np.percentile(nlevel,99.0)
+            vmin = np.percentile(nlevel,1.0)
+            ax = plt.gca()
+            im = ax.imshow(nlevel,vmin=vmin,vmax=vmax,interpolation='none')
+            plt.axis('off')  
+            # plt.imshow(Cascade[:,:,nl],vmin=-5,vmax=5,interpolation='none')
+            divider = make_axes_locatable(ax)
+            cax = divider.append_axes("right", size="5%", pad=0.05)
+            cbar = plt.colorbar(im, cax=cax)
+            cbar.set_label('dBZ',fontsize=fsize)
             
-        # add to the stack
-        cascadeStack.append(Cascade)    
-        cascadeMeanStack.append(CascadeMean)
-        cascadeStdStack.append(CascadeStd)
+        
+        # plt.subplot(nrows,4,3)
+        # plt.title('Reconstructed image + residuals')
+        # plt.imshow(recon_image,interpolation='nearest',vmin=0,vmax=45)
+        # cbar = plt.colorbar()
+        # cbar.set_label('dBZ')
+        # plt.axis('off')
+
+        # plt.show()
+        plt.tight_layout()
+        plt.savefig('fig_cascade_decomposition_%ilevels.pdf' % NumberLevels)
+        print('Saved: fig_cascade_decomposition_%ilevels.pdf' % NumberLevels)
         
     if verbose==1:    
         print(' DONE!') 
     
     return cascadeStack, cascadeMeanStack, cascadeStdStack
 
-def get_cascade_from_array(InputMap, NumberLevels, BandpassFilter2D, CentreWaveLengths, zerothr = None, zeroPadding = 0, squeeze=True, verbose=0, doplot=0):
+def get_cascade_from_array(InputMap, NumberLevels, BandpassFilter2D, CentreWaveLengths, zerothr = None, zeroPadding = 0, squeeze=True, verbose=0, doplot=0, engine=None, out=None):
     
     if InputMap.ndim == 2:
         InputMap = InputMap[None,:,:]
     
-    FFTSize = InputMap.shape[1]
-    Nyquest = FFTSize/2
     nrOfFields = InputMap.shape[0]
+    if engine is None:
+        engine = CascadeEngine(BandpassFilter2D, zeroPadding = zeroPadding)
     
-    Cascade = np.zeros((nrOfFields,FFTSize,FFTSize,NumberLevels))
-    CascadeMean = np.zeros((nrOfFields,NumberLevels))
-    CascadeStd = np.zeros((nrOfFields,NumberLevels))
+    if verbose==1:
+        print('Applying the filters',end="")
+        stdout.flush()
     
-    for i in xrange(nrOfFields):
+    # out is an optional (nrOfFields, ny, nx, NumberLevels) buffer for the cascade
+    Cascade,CascadeMean,CascadeStd = engine.decompose(InputMap, zerothr = zerothr, out = out)
     
-        thisInputMap = InputMap[i,:,:].copy()
-    
-        # Zero padding
-        if zeroPadding > 0:
-            thisInputMap = cv2.copyMakeBorder(thisInputMap,zeroPadding,zeroPadding,zeroPadding,zeroPadding,cv2.BORDER_CONSTANT,0)
-        
-        # Calculate the FFT
-        fftNoShift = np.fft.fft2(thisInputMap)
-        
-        # For each level, filter the transform and place the data into the cascade
-        if (verbose==1) and (n==0):
-            print('Applying the filters',end="")
-            stdout.flush()
-        
-        for Level in xrange(NumberLevels):
-            if verbose==1:
-                print('.',end="")
-                stdout.flush()
-                       
-            FFTPassedOut = np.zeros_like(fftNoShift)
-            
-            # Extract the filter for the given level
-            Filter = BandpassFilter2D[Level,:,:].copy()
-
-            # Apply the filter        
-            FFTPassedOut =  fftNoShift * Filter
-                    
-            # Calculate the inverse ff
-            new_image = np.real(np.fft.ifft2(FFTPassedOut)) 
-            
-            # Crop the zero edges
-            if zeroPadding > 0:
-                new_image = new_image[zeroPadding:-zeroPadding,zeroPadding:-zeroPadding]
-            
-            if zerothr is None:
-                CascadeMean[i,Level] = new_image.mean()
-                CascadeStd[i,Level] = new_image.std()
-                Cascade[i,:,:,Level] = (new_image - CascadeMean[i,Level]) / CascadeStd[i,Level]
-            else:
-                wet_pixels = new_image > zerothr   
-                CascadeMean[i,Level] = new_image[wet_pixels].mean()
-                CascadeStd[i,Level] = new_image[wet_pixels].std()
-                new_image = (new_image - CascadeMean[i,Level]) / CascadeStd[i,Level]
-                # new_image[~wet_pixels] = new_image[wet_pixels].min()
-                Cascade[i,:,:,Level] = new_image
-
-        # The k level is the residuals
-        k = NumberLevels-1
-        CascadeSum = np.zeros(InputMap[i,:,:].shape)
-        for LevelA in xrange(NumberLevels):
-            if LevelA!=k:
-                CascadeSum += Cascade[i,:,:,LevelA]*CascadeStd[i,LevelA] + CascadeMean[i,LevelA]
-        Residual = InputMap[i,:,:] - CascadeSum
-        CascadeMean[i,k] = Residual.mean()
-        CascadeStd[i,k] = Residual.std()
-        Cascade[i,:,:,k] = (Residual - CascadeMean[i,k]) / CascadeStd[i,k]
+    # The k level is the residuals
+    k = NumberLevels-1
     
     if (doplot==1):
         vmaxorig = InputMap.max()
@@ -1079,17 +1315,27 @@ def autoregressive_parameters(cascadeStack, cascadeMeanStack, cascadeStdStack, o
 
     return phi,r
     
-def get_perturbation_fields(radarImage, NumberMembers, NumberLeadtimes, winsize = [], local_level = 0, seed = 42):
+def get_perturbation_fields(radarImage, NumberMembers, NumberLeadtimes, winsize = [], local_level = 0, seed = 42, chunk_size = 16, nthreads = 1):
+    noiseStack = []
+    for perturbationFields in get_perturbation_fields_chunks(radarImage, NumberMembers, NumberLeadtimes, winsize, local_level, seed, chunk_size, nthreads):
+        for n  in xrange(perturbationFields.shape[2]):
+            noiseStack.append(perturbationFields[:,:,n])
+    return noiseStack
+    
+def get_perturbation_fields_chunks(radarImage, NumberMembers, NumberLeadtimes, winsize = [], local_level = 0, seed = 42, chunk_size = 16, nthreads = 1):
+    '''
+    Yields the NumberMembers*(NumberLeadtimes + 2) perturbation fields by chunks of 
+    (ny, nx, chunk_size) fields.
+    '''
     totfields = int(NumberMembers*(NumberLeadtimes + 2))
     if not winsize:
-        perturbationFields = ssft.nested_fft2(radarImage, nr_frames = totfields, max_level = local_level, seed = seed)
+        for perturbationFields in ssft.nested_fft2_chunks(radarImage, nr_frames = totfields, max_level = local_level, seed = seed, \
+                                    chunk_size = chunk_size, nthreads = nthreads):
+            yield perturbationFields
     else:
-        perturbationFields,_,_ = ssft.corrNoise(radarImage, winsize = winsize, nmembers = totfields, verbose = 0, fillgaps = 1, seed = seed)
-    
-    noiseStack = []
-    for n  in xrange(totfields):
-        noiseStack.append(perturbationFields[:,:,n])
-    return noiseStack
+        perturbationFields,_,_ = ssft.corrNoise(radarImage, winsize = winsize, nmembers = totfields, verbose = 0, fillgaps = 1, seed = seed, \
+                                    chunk_size = chunk_size, nthreads = nthreads)
+        yield perturbationFields
     
 def aggregate_in_time(dataArray,timeAccumMin,type='sum'):
     
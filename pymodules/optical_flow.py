@@ -8,7 +8,8 @@ import sys
 import cv2
 
 from scipy.spatial.distance import cdist
-from scipy.interpolate import griddata
+from scipy.spatial import cKDTree
+from scipy.interpolate import griddata, RectBivariateSpline
 import scipy.ndimage.filters as filters
 import scipy.ndimage as ndimage
 
@@ -133,35 +134,42 @@ def declustering(x, y, u, v, R, minN=3):
     xT = np.floor(xT)
     yT = np.floor(yT)
 
-    # keep only unique combinations of coordinates
+    # label each vector with its cell (labels follow the order of unique_rows)
     xy = np.hstack((xT,yT))
-    unique_xy = unique_rows(xy)
-    
-    # now loop through these unique values and average vectors which belong to the same unit
-    xN=[]; yN=[]; uN=[]; vN=[]
-    for i in range(0,unique_xy.shape[0]):
-        idx = (xT==unique_xy[i,0])&(yT==unique_xy[i,1])
-        npoints = np.sum(idx)
-        if npoints >= minN:
-            xtemp = x[idx]
-            ytemp = y[idx]
-            utemp = u[idx]
-            vtemp = v[idx]
-            
-            xN.append(np.median(xtemp))
-            yN.append(np.median(ytemp))
-            uN.append(np.median(utemp))
-            vN.append(np.median(vtemp))
-    
-    # extract declustered values
-    xP = np.array(xN)
-    yP = np.array(yN) 
-    uP = np.array(uN)
-    vP = np.array(vN) 
-
+    xyVoid = np.ascontiguousarray(xy).view(np.dtype((np.void, xy.dtype.itemsize * xy.shape[1])))
+    _, cellIdx = np.unique(xyVoid, return_inverse=True)
+    cellIdx = cellIdx.ravel()
+    
+    # keep only the cells with at least minN vectors
+    counts = np.bincount(cellIdx)
+    keep = counts >= minN
+    if not np.any(keep):
+        return(np.array([]), np.array([]), np.array([]), np.array([]))
+    
+    # take the median of all vectors which belong to the same cell
+    xP = grouped_median(x.ravel(), cellIdx, counts)[keep]
+    yP = grouped_median(y.ravel(), cellIdx, counts)[keep]
+    uP = grouped_median(u.ravel(), cellIdx, counts)[keep]
+    vP = grouped_median(v.ravel(), cellIdx, counts)[keep]
     
     return(xP, yP, uP, vP)
     
+def grouped_median(values, groupIdx, counts):
+    '''
+    Median of the values within each group, with groupIdx the (0 to ngroups-1) 
+    group label of each value and counts the number of values per group.
+    '''
+    # sort by group and then by value within each group
+    order = np.lexsort((values, groupIdx))
+    sortedValues = values[order]
+    
+    # pick the middle value(s) of each group
+    starts = np.cumsum(counts) - counts
+    lower = sortedValues[starts + (counts - 1)//2]
+    upper = sortedValues[starts + counts//2]
+    
+    return((lower + upper)/2)
+    
 def morphological_opening(image, thr=0.08, n=3):
     '''
     Function to apply a binary morphological opening to filter small isolated echoes
@@ -209,9 +217,16 @@ def silverman(sigma,n):
     
     return(bandwidth)
 
-def interpolate_sparse_vectors_kernel(x, y, u, v, domainSize, b = []):
+def interpolate_sparse_vectors_kernel(x, y, u, v, domainSize, b = [], cutoff = 5, gridStep = 1, memoryBudgetMB = 256):
     '''
-    Gaussian kernel interpolation to obtain a dense field of motion vectors
+    Gaussian kernel interpolation to obtain a dense field of motion vectors.
+    
+    The grid is processed in tiles whose size is set by memoryBudgetMB, and for 
+    each tile only the vectors found with a KD-tree within cutoff bandwidths of the 
+    tile (beyond the distance to its nearest vector) are used. The relative weight 
+    of the neglected vectors is thus below exp(-cutoff**2/2).
+    With gridStep > 1 the kernel is evaluated on a coarser grid (every gridStep 
+    pixels) and then bilinearly interpolated to the full grid.
     '''
 
     # make sure these are vertical arrays
@@ -226,35 +241,80 @@ def interpolate_sparse_vectors_kernel(x, y, u, v, domainSize, b = []):
     # generate the grid
     xgrid = np.arange(domainSize[1])
     ygrid = np.arange(domainSize[0])
-    X, Y = np.meshgrid(xgrid,ygrid)
-    grid = np.column_stack((X.flatten(),Y.flatten()))
     
-    # compute  distances
+    # the grid where the kernel is evaluated (always including the last row and column)
+    gridStep = int(gridStep)
+    xgridEval = np.unique(np.append(xgrid[::gridStep], xgrid[-1]))
+    ygridEval = np.unique(np.append(ygrid[::gridStep], ygrid[-1]))
+    
     points = np.column_stack((x,y))
-    D = cdist(points,grid, 'euclidean')
+    n = points.shape[0]
+    
+    # tiles of (tileSize x tileSize) pixels, such that the (n, tileSize**2) distance 
+    # and weight matrices (and their temporaries) fit in memoryBudgetMB
+    tileSize = int(np.sqrt(memoryBudgetMB*1e6/(8*4*n)))
+    tileSize = np.max((tileSize,1))
 
     # get bandwidth if empty argument
     if not b:
-        n = points.shape[0]
-        sigma = np.std(D[:])
+        # standard deviation of the distances between the vectors and the grid 
+        # (accumulated tile by tile on a grid of at most ~100x100 pixels)
+        step = int(np.max((1,np.ceil(np.max(domainSize)/100.0))))
+        sigma = distance_std_tiled(points, xgrid[::step], ygrid[::step], tileSize)
         b = silverman(sigma,n)
-        
-    # compute kernel weights
-    weights = gaussian_kernel(D,b)
-   
-    uR = np.repeat(u,weights.shape[1]).reshape(weights.shape)
-    vR = np.repeat(v,weights.shape[1]).reshape(weights.shape)
     
-    # perform weighted average on the grid
-    U = np.sum(weights*u,axis=0)/np.sum(weights,axis=0)
-    V = np.sum(weights*v,axis=0)/np.sum(weights,axis=0)
+    # interpolate tile by tile 
+    tree = cKDTree(points)
+    U = np.zeros((ygridEval.size, xgridEval.size))
+    V = np.zeros((ygridEval.size, xgridEval.size))
+    for i0 in range(0, ygridEval.size, tileSize):
+        for j0 in range(0, xgridEval.size, tileSize):
+            xtile = xgridEval[j0:j0+tileSize]
+            ytile = ygridEval[i0:i0+tileSize]
+            X, Y = np.meshgrid(xtile,ytile)
+            grid = np.column_stack((X.flatten(),Y.flatten()))
+            
+            # vectors close enough to the tile
+            centre = [(xtile[0] + xtile[-1])/2.0, (ytile[0] + ytile[-1])/2.0]
+            halfDiagonal = np.sqrt((xtile[-1] - xtile[0])**2 + (ytile[-1] - ytile[0])**2)/2.0
+            distNearest,_ = tree.query(centre)
+            radius = distNearest + 2*halfDiagonal + cutoff*b
+            idx = tree.query_ball_point(centre, radius)
+            
+            # compute kernel weights
+            D = cdist(points[idx,:], grid, 'euclidean')
+            weights = gaussian_kernel(D,b)
+            
+            # perform weighted average on the grid
+            sumWeights = np.sum(weights,axis=0)
+            U[i0:i0+tileSize,j0:j0+tileSize] = ( np.sum(weights*u[idx],axis=0)/sumWeights ).reshape(X.shape)
+            V[i0:i0+tileSize,j0:j0+tileSize] = ( np.sum(weights*v[idx],axis=0)/sumWeights ).reshape(X.shape)
     
-    # reshape back to domain size
-    U = U.reshape(domainSize[0],domainSize[1])
-    V = V.reshape(domainSize[0],domainSize[1])
+    # back to the full grid
+    if gridStep > 1:
+        U = RectBivariateSpline(ygridEval, xgridEval, U, kx=1, ky=1)(ygrid, xgrid)
+        V = RectBivariateSpline(ygridEval, xgridEval, V, kx=1, ky=1)(ygrid, xgrid)
     
     return(xgrid, ygrid, U, V, b)
     
+def distance_std_tiled(points, xgrid, ygrid, tileSize):
+    '''
+    Standard deviation of the euclidean distances between the points and all the 
+    grid points, accumulated over tiles of the grid to bound the memory.
+    '''
+    sumD = 0.0
+    sumD2 = 0.0
+    count = 0
+    for i0 in range(0, ygrid.size, tileSize):
+        for j0 in range(0, xgrid.size, tileSize):
+            X, Y = np.meshgrid(xgrid[j0:j0+tileSize],ygrid[i0:i0+tileSize])
+            D = cdist(points, np.column_stack((X.flatten(),Y.flatten())), 'euclidean')
+            sumD += D.sum()
+            sumD2 += (D**2).sum()
+            count += D.size
+    meanD = sumD/count
+    return np.sqrt(np.max((sumD2/count - meanD**2, 0)))
+    
 def interpolate_sparse_vectors_linear(x, y, u, v, domainSize):
     '''
     Linear interpolation to obtain a dense field of motion vectors.
@@ -8,6 +8,7 @@ import sys
 import os
 import time
 import pickle
+import multiprocessing.pool
 
 import radialprofile
 import cv2
@@ -16,7 +17,10 @@ import scipy as sp
 from scipy import fftpack
 from scipy.ndimage.interpolation import rotate
 from scipy.ndimage.filters import gaussian_filter, median_filter
-#import pyfftw
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
 from scipy.interpolate import griddata
 from skimage import measure
 from scipy.optimize import leastsq
@@ -31,8 +35,12 @@ import optical_flow as of
 ###########################################################
 
 def corrNoise(rainfield_dBZin, randValues=[], winsize=128, wintype='flat-hanning', overlap=0.5, nmembers = 1, \
-                    doshiftandscale = 0, fillgaps = 0, fillmethod = 'nearest', warThr = 0.03, verbose = 1, seed = 42): 
-    
+                    doshiftandscale = 0, fillgaps = 0, fillmethod = 'nearest', warThr = 0.03, verbose = 1, seed = 42, \
+                    chunk_size = 16, nthreads = 1): 
+    '''
+    The members are filtered by chunks of chunk_size members with batched FFTs 
+    (FFTW plans reused if pyfftw is available, with nthreads threads).
+    '''
     
     # start the clock
     tic = time.clock()
@@ -84,14 +92,12 @@ def corrNoise(rainfield_dBZin, randValues=[], winsize=128, wintype='flat-hanning
             randValues = randValues[:,:,np.newaxis]
         nmembers = randValues.shape[2]
         
-    # Turn on the fftw cache for improved performance
-    pyfftw.interfaces.cache.enable()
-        
-    # Compute FFT for all noise fields
-    fnoise=[]
+    # FFTs with plans reused for all members and windows
+    fft = FFTPlans(nthreads = nthreads)
+    
+    # force zscores for all noise fields
     for n in xrange(nmembers):
         randValues[:,:,n] = _zscores(randValues[:,:,n])
-        fnoise.append(pyfftw.interfaces.numpy_fft.fft2(randValues[:,:,n]))  
         
     ## Compute the windowed fft and store the spectra
          
@@ -135,7 +141,7 @@ def corrNoise(rainfield_dBZin, randValues=[], winsize=128, wintype='flat-hanning
                 if  (np.sum(rmask>norain)/wind.size > warThr):
                     
                     # fft of the windowed rainfall field
-                    fftw = pyfftw.interfaces.numpy_fft.fft2(rmask)
+                    fftw = fft.fft2(rmask)
                     # normalize the spectrum
                     fftw.imag = _zscores(fftw.imag)
                     fftw.real = _zscores(fftw.real)
@@ -208,7 +214,7 @@ def corrNoise(rainfield_dBZin, randValues=[], winsize=128, wintype='flat-hanning
     
     if (~globalApproach and fillgaps == 1  and fillmethod == 'global'):
         wind = build2dWindow(rainfield_dBZ.shape,wintype)
-        fglobal = pyfftw.interfaces.numpy_fft.fft2(rainfield_dBZ*wind)
+        fglobal = fft.fft2(rainfield_dBZ*wind)
         fglobal.imag = _zscores(fglobal.imag)
         fglobal.real = _zscores(fglobal.real)
         fglobal = np.abs(fglobal)
@@ -221,86 +227,71 @@ def corrNoise(rainfield_dBZin, randValues=[], winsize=128, wintype='flat-hanning
     wpjm = np.array(wpjm)
     fftyes = np.array(fftyes)
     fcorrNoiseTotal = np.zeros(randValues.shape)
-    idxi = np.zeros((2,1),dtype=int); idxj = np.zeros((2,1),dtype=int)
-    maskSum = np.zeros(randValues.shape) 
+    maskSum = np.zeros(rainfield_dBZ.shape) 
     
-    # loop members
-    for n in xrange(nmembers):
-        count=-1
+    # the windows and their spectra are the same for all members
+    windows = []
+    halfSpectra = {}
+    count=-1
+    # loop through rows       
+    for i in xrange(0,rainfield_dBZ.shape[0],delta):
         
-        if (nmembers > 1) and (verbose==1):
-            dt.update_progress((n+1)/nmembers)
-        # loop through rows       
-        for i in xrange(0,rainfield_dBZ.shape[0],delta):
+        # loop through columns
+        for j in xrange(0,rainfield_dBZ.shape[1],delta):
+            i1 = np.min((i + winsize, rainfield_dBZ.shape[0])) 
+            j1 = np.min((j + winsize, rainfield_dBZ.shape[1])) 
             
-            # loop through columns
-            for j in xrange(0,rainfield_dBZ.shape[1],delta):
-                # print(i,j,winsize)
-                idxi[0] = i
-                idxi[1] = np.min((i + winsize, rainfield_dBZ.shape[0])) 
-                idxj[0] = j
-                idxj[1] = np.min((j + winsize, rainfield_dBZ.shape[1])) 
-                
-                # build window
-                wind = build2dWindow(((idxi[1]-idxi[0]),(idxj[1]-idxj[0])),wintype)
+            # build window
+            wind = build2dWindow((i1-i,j1-j),wintype)
+            
+            # stopping criteria
+            if (wind.shape[0]*wind.shape[1])/winsize**2 > 0.5: 
+                count += 1
                 
-                # stopping criteria
-                if (wind.shape[0]*wind.shape[1])/winsize**2 > 0.5: 
-                    count += 1
-                    mask = np.zeros(rainfield_dBZ.shape) 
-                    mask[int(idxi[0]):int(idxi[1]),int(idxj[0]):int(idxj[1])] = wind + 1e-6
-                    
-                    # the local spectrum exists
-                    if fftyes[count]==1:
-                        idxSpectrum = count
-                    # or find the nearest available spectrum
-                    elif (fftyes[count]==0) and (fillgaps == 1) and (fillmethod == 'nearest'):
-                        dx = (wpim[count] - wpim)**2 + (wpjm[count] - wpjm)**2
-                        dx[fftyes == 0] = np.inf
-                        idxSpectrum = np.argmin(dx)
-                    # or use global spectrum to fill the gaps
-                    elif (fftyes[count]==0) and (fillgaps == 1) and (fillmethod == 'global'):   
-                        idxSpectrum = -1
-                    # or do nothing
-                    else:
-                        idxSpectrum = -2
-
-                    if idxSpectrum >= -1:
-                        # Build local white noise Fourier
-                        # windN = build2dWindow(((idxi[1]-idxi[0]),(idxj[1]-idxj[0])),'rectangular')
-                        # maskN = np.zeros(rainfield_dBZ.shape) 
-                        # maskN[idxi[0]:idxi[1],idxj[0]:idxj[1]] = windN
-                        # fnoise_l =  pyfftw.interfaces.numpy_fft.fft2(maskN*randValues[:,:,n])
-                        
-                        # Build the filter based on rain analysis
-                        fcorrNoise = fprecipNoShift[idxSpectrum].copy()
-                       
-                        # apply the filter to the noise spectrum
-                        fcorrNoise = fnoise[n]*fcorrNoise
-                        # fcorrNoise = fnoise_l*fcorrNoise
-
-                        # Do the inverse FFT
-                        corrNoise = pyfftw.interfaces.numpy_fft.ifft2(fcorrNoise)
-                        corrNoiseReal = np.array(corrNoise.real)
-                        
-                        # Merge 
-                        fcorrNoiseTotal[:,:,n] = fcorrNoiseTotal[:,:,n] + corrNoiseReal.copy()*mask
+                # the local spectrum exists
+                if fftyes[count]==1:
+                    idxSpectrum = count
+                # or find the nearest available spectrum
+                elif (fftyes[count]==0) and (fillgaps == 1) and (fillmethod == 'nearest'):
+                    dx = (wpim[count] - wpim)**2 + (wpjm[count] - wpjm)**2
+                    dx[fftyes == 0] = np.inf
+                    idxSpectrum = np.argmin(dx)
+                # or use global spectrum to fill the gaps
+                elif (fftyes[count]==0) and (fillgaps == 1) and (fillmethod == 'global'):   
+                    idxSpectrum = -1
+                # or do nothing
+                else:
+                    idxSpectrum = -2
 
-                        # Update sum of weights
-                        maskSum[:,:,n] = maskSum[:,:,n] + mask
-                        
-                        
-                        # plt.clf()
-                        # plt.imshow(corrNoiseReal)
-                        # plt.autoscale(False)
-                        # plt.plot([idxj[0],idxj[1],idxj[1],idxj[0],idxj[0]],[idxi[0],idxi[0],idxi[1],idxi[1],idxi[0]],color='red')
-                        # plt.title((n,i,j))
-                        # plt.pause(2)
-                                            
+                if idxSpectrum >= -1:
+                    # Build the filter based on rain analysis (half spectrum for the real FFTs)
+                    if idxSpectrum not in halfSpectra:
+                        halfSpectra[idxSpectrum] = half_spectrum_filter(fprecipNoShift[idxSpectrum])
+                    windows.append((i,i1,j,j1,wind + 1e-6,idxSpectrum))
+                    
+                    # Update sum of weights
+                    maskSum[i:i1,j:j1] += wind + 1e-6
+    
+    # loop chunks of members
+    for n0 in xrange(0,nmembers,chunk_size):
+        n1 = np.min((n0 + chunk_size, nmembers))
+        
+        if (nmembers > 1) and (verbose==1):
+            dt.update_progress(n1/nmembers)
+            
+        # Compute FFT for all noise fields of the chunk
+        fnoise = fft.rfft2(np.rollaxis(randValues[:,:,n0:n1],2))
+        
+        for i,i1,j,j1,mask,idxSpectrum in windows:
+            # apply the filter to the noise spectrum and do the inverse FFT
+            corrNoiseReal = fft.irfft2(fnoise*halfSpectra[idxSpectrum][None,:,:], rainfield_dBZ.shape)
+            
+            # Merge 
+            fcorrNoiseTotal[i:i1,j:j1,n0:n1] += np.rollaxis(corrNoiseReal[:,i:i1,j:j1],0,3)*mask[:,:,None]
     
     # normalize the sum
     idx = maskSum>0
-    fcorrNoiseTotal[idx] = fcorrNoiseTotal[idx]/maskSum[idx]
+    fcorrNoiseTotal[idx,:] = fcorrNoiseTotal[idx,:]/maskSum[idx][:,None]
     
     # pinkHex = '#%02x%02x%02x' % (232, 215, 242)
     # redgreyHex = '#%02x%02x%02x' % (156, 126, 148)
@@ -1163,35 +1154,101 @@ def levy(alpha,size):
     
 def quantile_transformation(initialarray,targetarray):
 
-    # zeros in initial image
-    idxZeros = initialarray == 0
+    # rank target values
+    rankedTarget = rank_target(targetarray)
+    
+    # map the initial values onto the ranked target values
+    outputarray = quantile_transformation_batch(initialarray[None,...],rankedTarget,zerovalue=0)[0]
 
+    return outputarray
+    
+def rank_target(targetarray, nquantiles=None, perfield=False):
+    '''
+    Sorted values of the target array(s) to be used with quantile_transformation_batch, 
+    so that a target shared by many fields (e.g. the members at one lead time) is sorted 
+    only once. With perfield=True the first dimension of targetarray indexes the 
+    fields and one ranked target per field is returned.
+    With nquantiles < number of pixels only nquantiles evenly spaced order statistics 
+    (including the minimum and the maximum) are kept, as an approximation of the target CDF.
+    '''
+    
+    if perfield:
+        ranked = np.sort(targetarray.reshape(targetarray.shape[0],-1),axis=1)
+    else:
+        ranked = np.sort(targetarray.flatten())
+    
+    npixels = ranked.shape[-1]
+    if (nquantiles is not None) and (nquantiles < npixels):
+        nquantiles = np.max((nquantiles,2))
+        idxQuantiles = np.round(np.linspace(0,npixels - 1,nquantiles)).astype(int)
+        ranked = ranked[...,idxQuantiles]
+        
+    return ranked
+    
+def quantile_transformation_batch(initialarrays,rankedTarget,zerovalue=0):
+    '''
+    Probability matching of a batch of fields initialarrays (n,ny,nx) with one 
+    batched argsort. rankedTarget is the output of rank_target, either shared by all 
+    the fields (1D) or one per field (2D).
+    If rankedTarget holds fewer values than the number of pixels (CDF approximation), 
+    the ranks are linearly interpolated between the stored quantiles and the error on 
+    each pixel is bounded by the largest difference between two consecutive quantiles.
+    Pixels equal to zerovalue keep their value, with zerovalue=None the minimum of 
+    each field is used.
+    '''
+    
     # flatten the arrays
-    arrayshape = initialarray.shape
-    target = targetarray.flatten()
-    array = initialarray.flatten()
+    arraysshape = initialarrays.shape
+    nfields = arraysshape[0]
+    arrays = initialarrays.reshape(nfields,-1)
+    npixels = arrays.shape[1]
+    
+    # zeros in initial images
+    if zerovalue is None:
+        zvalues = arrays.min(axis=1)[:,None]
+    else:
+        zvalues = np.ones((nfields,1))*zerovalue
+    idxZeros = arrays == zvalues
     
-    # rank target values
-    order = target.argsort()
-    ranked = target[order]
-
     # rank initial values order
-    orderin = array.argsort()
-    ranks = np.empty(len(array), int)
-    ranks[orderin] = np.arange(len(array))
-
+    orderin = arrays.argsort(axis=1)
+    ranks = np.empty(arrays.shape, int)
+    ranks[np.arange(nfields)[:,None],orderin] = np.arange(npixels)
+    
     # get ranked values from target and rearrange with inital order
-    outputarray = ranked[ranks]
-
-    # reshape as 2D array
-    outputarray = outputarray.reshape(arrayshape)
+    nquantiles = rankedTarget.shape[-1]
+    if nquantiles == npixels:
+        if rankedTarget.ndim > 1:
+            outputarrays = rankedTarget[np.arange(nfields)[:,None],ranks]
+        else:
+            outputarrays = rankedTarget[ranks]
+    else:
+        position = ranks*(nquantiles - 1)/(npixels - 1)
+        idxLow = np.minimum(np.floor(position).astype(int),nquantiles - 2)
+        weight = position - idxLow
+        if rankedTarget.ndim > 1:
+            rows = np.arange(nfields)[:,None]
+            outputarrays = (1 - weight)*rankedTarget[rows,idxLow] + weight*rankedTarget[rows,idxLow + 1]
+        else:
+            outputarrays = (1 - weight)*rankedTarget[idxLow] + weight*rankedTarget[idxLow + 1]
+    
+    # reassign original zeros
+    outputarrays[idxZeros] = np.repeat(zvalues,npixels,axis=1)[idxZeros]
     
-    # reassing original zeros
-    outputarray[idxZeros] = 0
+    # reshape as original arrays
+    outputarrays = outputarrays.reshape(arraysshape)
 
-    return outputarray
+    return outputarrays
     
-def local_quantile_transform(refimage,image,wintype='hanning',winsize=64,overlap=0.9):
+def local_quantile_transform(refimage,image,wintype='hanning',winsize=64,overlap=0.9,nworkers=1):
+    '''
+    Probability matching of image with refimage within overlapping windows, 
+    blended with the window weights. 
+    The windows of one row are transformed together (one batched argsort per window 
+    shape) and with nworkers > 1 several rows of windows are transformed in parallel 
+    threads. The weighted sums are accumulated only over each window slice, in the 
+    same order as the serial loop.
+    '''
 
     # rain/no rain threshold
     mindBZ = np.nanmin(refimage)
@@ -1202,38 +1259,45 @@ def local_quantile_transform(refimage,image,wintype='hanning',winsize=64,overlap
     delta = np.max((delta,1))
     
     # Initialise variables
-    count=-1
-    idxi = np.zeros((2,1),dtype=int); idxj = np.zeros((2,1),dtype=int)
     maskSum = np.zeros(image.shape)
     transf = np.zeros(image.shape) 
-
     
-    # loop through rows       
+    # build the windows once (only the windows at the borders are truncated)
+    windows = {}
+    rows = []
     for i in xrange(0,refimage.shape[0],delta):
-        
-        # loop through columns
+        row = []
         for j in xrange(0,refimage.shape[1],delta):
-            
-            mask = np.zeros(refimage.shape)
-            idxi[0] = i
-            idxi[1] = np.min((i + winsize, refimage.shape[0]))
-            idxj[0] = j
-            idxj[1] = np.min((j + winsize, refimage.shape[1])) 
-            
-            # build window
-            wind = build2dWindow(((idxi[1]-idxi[0]),(idxj[1]-idxj[0])),wintype) + 1e-6
-            
+            i1 = np.min((i + winsize, refimage.shape[0]))
+            j1 = np.min((j + winsize, refimage.shape[1]))
+            if (i1-i,j1-j) not in windows:
+                windows[(i1-i,j1-j)] = build2dWindow((i1-i,j1-j),wintype) + 1e-6
+            wind = windows[(i1-i,j1-j)]
             if (wind.shape[0]*wind.shape[1])/winsize**2 > 0.1: 
-                count += 1
-                mask[idxi[0]:idxi[1],idxj[0]:idxj[1]] = wind
-                
-                subrefimage = refimage[idxi[0]:idxi[1],idxj[0]:idxj[1]]
-                subimage = image[idxi[0]:idxi[1],idxj[0]:idxj[1]]
-                subtransf = quantile_transformation(subimage,subrefimage)
+                row.append((i,i1,j,j1))
+        rows.append(row)
+    
+    if nworkers > 1:
+        pool = multiprocessing.pool.ThreadPool(nworkers)
+        
+    # transform the windows by chunks of rows
+    for r0 in xrange(0,len(rows),nworkers):
+        chunk = rows[r0:r0 + nworkers]
+        if nworkers > 1:
+            subtransfs = pool.map(lambda row: local_quantile_transform_row(refimage,image,row), chunk)
+        else:
+            subtransfs = [local_quantile_transform_row(refimage,image,row) for row in chunk]
+        
+        #interpolate by window
+        for row,rowtransf in zip(chunk,subtransfs):
+            for (i,i1,j,j1),subtransf in zip(row,rowtransf):
+                wind = windows[(i1-i,j1-j)]
+                transf[i:i1,j:j1] += subtransf*wind
+                maskSum[i:i1,j:j1] += wind
                 
-                #interpolate by window                
-                transf[idxi[0]:idxi[1],idxj[0]:idxj[1]] = transf[idxi[0]:idxi[1],idxj[0]:idxj[1]] + subtransf*wind
-                maskSum[:,:] = maskSum[:,:] + mask  
+    if nworkers > 1:
+        pool.close()
+        pool.join()
 
     # normalize the sums
     idx = maskSum>0
@@ -1241,6 +1305,23 @@ def local_quantile_transform(refimage,image,wintype='hanning',winsize=64,overlap
        
     return(transf)
 
+def local_quantile_transform_row(refimage,image,row):
+    '''
+    Quantile transformation of image with refimage within the windows (i0,i1,j0,j1) 
+    of row, batched over the windows of same shape.
+    '''
+    subtransfs = [None]*len(row)
+    shapes = [(i1-i,j1-j) for (i,i1,j,j1) in row]
+    for shape in set(shapes):
+        idxWindows = [w for w in xrange(len(row)) if shapes[w] == shape]
+        subimages = np.array([image[row[w][0]:row[w][1],row[w][2]:row[w][3]] for w in idxWindows])
+        subrefimages = np.array([refimage[row[w][0]:row[w][1],row[w][2]:row[w][3]] for w in idxWindows])
+        batchtransf = quantile_transformation_batch(subimages,rank_target(subrefimages,perfield=True),zerovalue=0)
+        for n,w in enumerate(idxWindows):
+            subtransfs[w] = batchtransf[n]
+            
+    return subtransfs
+    
 ###
 def logistic(x,L = 1,k = 1,x0 = 0):
     return L/(1 + np.exp(-k*(x - x0)))  
@@ -1337,12 +1418,91 @@ def fourier_analysis(fieldin):
 
     return fftw   
     
-def nested_fft2(target, nr_frames = 10, max_level = 3, win_type = 'flat-hanning', war_thr = 0.1, overlap = 40, do_set_seed = True, do_plot = False, seed = 42):
+class FFTPlans(object):
+    '''
+    2D FFTs over the last two axes of a batch of fields (nfields, ny, nx). If pyfftw is 
+    available, the FFTW plans are built once per array shape and reused (with nthreads 
+    threads), otherwise numpy.fft is used.
+    The returned arrays can be the internal output arrays of the plans, they are 
+    overwritten by the next call with the same shape.
+    '''
+    
+    def __init__(self, nthreads = 1, usefftw = True):
+        self.nthreads = nthreads
+        self.usefftw = usefftw and (pyfftw is not None)
+        self.plans = {}
+        
+    def get_plan(self, kind, shape, dtype, s = None):
+        key = (kind,) + shape
+        if key not in self.plans:
+            builder = getattr(pyfftw.builders, kind)
+            if s is None:
+                self.plans[key] = builder(pyfftw.empty_aligned(shape, dtype=dtype), \
+                                    threads=self.nthreads, planner_effort='FFTW_ESTIMATE')
+            else:
+                self.plans[key] = builder(pyfftw.empty_aligned(shape, dtype=dtype), s=s, \
+                                    threads=self.nthreads, planner_effort='FFTW_ESTIMATE')
+        return self.plans[key]
+        
+    def fft2(self, fields):
+        if not self.usefftw:
+            return np.fft.fft2(fields)
+        return self.get_plan('fft2', fields.shape, 'complex128')(fields)
+        
+    def rfft2(self, fields):
+        if not self.usefftw:
+            return np.fft.rfft2(fields)
+        return self.get_plan('rfft2', fields.shape, 'float64')(fields)
+        
+    def irfft2(self, spectra, shape):
+        if not self.usefftw:
+            return np.fft.irfft2(spectra, s=shape)
+        return self.get_plan('irfft2', spectra.shape, 'complex128', s=tuple(shape))(spectra)
+        
+def half_spectrum_filter(fourierFilter):
+    '''
+    Half spectrum (for rfft2) of the symmetrized Fourier filter, F(k) -> (F(k) + F(-k))/2, 
+    so that irfft2(rfft2(x)*half_spectrum_filter(F)) = np.real(ifft2(fft2(x)*F)) for real x.
+    '''
+    filterMirror = np.roll(np.roll(fourierFilter[...,::-1,::-1],1,axis=-2),1,axis=-1)
+    nxHalf = int(fourierFilter.shape[-1]/2) + 1
+    return 0.5*(fourierFilter + filterMirror)[...,:nxHalf]
+    
+def nested_fft2(target, nr_frames = 10, max_level = 3, win_type = 'flat-hanning', war_thr = 0.1, overlap = 40, do_set_seed = True, do_plot = False, seed = 42, \
+                chunk_size = 16, nthreads = 1):
+    '''
+    Produces nr_frames of 2-dimensional correlated noise (ny, nx, nr_frames), see 
+    nested_fft2_chunks.
+    '''
+    
+    output = np.zeros(target.shape + (nr_frames,))
+    m = 0
+    for frames in nested_fft2_chunks(target, nr_frames, max_level, win_type, war_thr, overlap, do_set_seed, seed, chunk_size, nthreads):
+        output[:,:,m:m + frames.shape[2]] = frames
+        m += frames.shape[2]
+    
+    if do_plot:
+        for m in xrange(nr_frames):
+            plt.clf()
+            plt.subplot(121)
+            plt.imshow(target,interpolation='nearest')
+            plt.subplot(122)
+            plt.imshow(output[:,:,m],interpolation='nearest',vmin=-3.5,vmax=3.5)
+            plt.pause(1)
+   
+    return output    
+    
+def nested_fft2_chunks(target, nr_frames = 10, max_level = 3, win_type = 'flat-hanning', war_thr = 0.1, overlap = 40, do_set_seed = True, seed = 42, \
+                chunk_size = 16, nthreads = 1):
 
-	#Produces a 2-dimensional correlated noise
-	#Use the last observation as filter
+    #Produces a 2-dimensional correlated noise
+    #Use the last observation as filter
     #Nested implementation to account for non-stationarities
-	#Example:
+    #The frames are generated and yielded by chunks of chunk_size frames (ny, nx, chunk_size),
+    #with batched FFTs (plans reused if pyfftw is available) so that all the frames never 
+    #need to be in memory. The white noise is drawn frame by frame, the frames do not depend 
+    #on chunk_size.
+    #Example:
     #Created:
     #ned, October 2017
     
@@ -1430,71 +1590,63 @@ def nested_fft2(target, nr_frames = 10, max_level = 3, win_type = 'flat-hanning'
         Idxipsd, Idxjpsd = split_field((0,2**max_level),(0,2**max_level),2**level)
         
     ## Power-filter images
-
-	# produce normal noise array
-    if do_set_seed: 
-        np.random.seed(seed)
-	white_noise = np.random.randn(dim[0],dim[1],nr_frames)
-    
-    # build composite image of correlated noise
-    corr_noise = np.zeros((dim_y,dim_x,nr_frames))
-    sum_of_masks = np.zeros((dim_y,dim_x,nr_frames))
-    idxi = np.zeros((2,1),dtype=int)
-    idxj = np.zeros((2,1),dtype=int)
-    winsize = np.round( dim[0]  / 2**max_level )
     
-    # loop frames
-    for m in xrange(nr_frames):
+    # half spectra of the local filters (rows, columns of the local areas)
+    nr_areas = 2**max_level
+    half_filters = half_spectrum_filter(mfilter.reshape((nr_areas**2,) + mfilter.shape[2:]))
     
-        # get fourier spectrum of white noise field
-        white_noise_ft = np.fft.fft2(white_noise[:,:,m])
-    
-        # loop rows
-        for i in xrange(2**max_level):
-            # loop columns
-            for j in xrange(2**max_level):
-
-                # apply fourier filtering with local filter
-                this_filter = mfilter[i,j,:,:]
-                this_corr_noise_ft = white_noise_ft * this_filter
-                this_corr_noise = np.fft.ifft2(this_corr_noise_ft)
-                this_corr_noise = np.array(this_corr_noise.real)
-                
-                # compute indices of local area
-                idxi[0] = np.max( (np.round(i*winsize - overlap/2), 0) )
-                idxi[1] = np.min( (np.round(idxi[0] + winsize  + overlap/2), dim[0]) )
-                idxj[0] = np.max( (np.round(j*winsize - overlap/2), 0) )
-                idxj[1] = np.min( (np.round(idxj[0] + winsize  + overlap/2), dim[1]) )
-                
-                # build mask and add local noise field to the composite image
-                mask = get_mask(dim[0],idxi,idxj,win_type)
-                corr_noise[:,:,m] += this_corr_noise*mask
-                sum_of_masks[:,:,m] += mask
-                
-    # normalize the sum
+    # local areas and their masks, the same for all the frames
+    areas = []
+    sum_of_masks = np.zeros((dim_y,dim_x))
+    winsize = np.round( dim[0]  / 2**max_level )
+    for i in xrange(nr_areas):
+        for j in xrange(nr_areas):
+            # compute indices of local area
+            i0 = int( np.max( (np.round(i*winsize - overlap/2), 0) ) )
+            i1 = int( np.min( (np.round(i0 + winsize  + overlap/2), dim[0]) ) )
+            j0 = int( np.max( (np.round(j*winsize - overlap/2), 0) ) )
+            j1 = int( np.min( (np.round(j0 + winsize  + overlap/2), dim[1]) ) )
+            wind = build2dWindow((i1 - i0, j1 - j0),win_type)
+            areas.append((i0,i1,j0,j1,wind))
+            sum_of_masks[i0:i1,j0:j1] += wind
     idx = sum_of_masks > 0
-    corr_noise[idx] = corr_noise[idx]/sum_of_masks[idx]
     
-    # crop the image back to the original size
-    difx = dim_x - orig_dim_x
-    dify = dim_y - orig_dim_y
-    output = corr_noise[int(dify/2):int(dim_y-dify/2),int(difx/2):int(dim_x-difx/2),:]
-    
-    # standardize the results to N(0,1)
-    for m in xrange(nr_frames):
-        output[:,:,m]  -= np.mean(output[:,:,m])
-        output[:,:,m]  /= np.std(output[:,:,m])
-    
-    if do_plot:
-        for m in xrange(nr_frames):
-            plt.clf()
-            plt.subplot(121)
-            plt.imshow(target,interpolation='nearest')
-            plt.subplot(122)
-            plt.imshow(output[:,:,m],interpolation='nearest',vmin=-3.5,vmax=3.5)
-            plt.pause(1)
-   
-    return output    
+    fft = FFTPlans(nthreads = nthreads)
+    if do_set_seed: 
+        np.random.seed(seed)
+        
+    # loop chunks of frames
+    for m0 in xrange(0,nr_frames,chunk_size):
+        nr_chunk = int(np.min((chunk_size, nr_frames - m0)))
+        
+        # produce normal noise array and get its fourier spectrum
+        white_noise = np.random.randn(nr_chunk,dim[0],dim[1])
+        white_noise_ft = fft.rfft2(white_noise).copy()
+        
+        # build composite image of correlated noise
+        corr_noise = np.zeros((nr_chunk,dim_y,dim_x))
+        for n in xrange(nr_areas**2):
+            # apply fourier filtering with local filter
+            this_corr_noise = fft.irfft2(white_noise_ft*half_filters[n][None,:,:], dim)
+            
+            # add local noise field to the composite image
+            i0,i1,j0,j1,wind = areas[n]
+            corr_noise[:,i0:i1,j0:j1] += this_corr_noise[:,i0:i1,j0:j1]*wind
+                
+        # normalize the sum
+        corr_noise[:,idx] = corr_noise[:,idx]/sum_of_masks[idx]
+        
+        # crop the image back to the original size
+        difx = dim_x - orig_dim_x
+        dify = dim_y - orig_dim_y
+        output = corr_noise[:,int(dify/2):int(dim_y-dify/2),int(difx/2):int(dim_x-difx/2)]
+        
+        # standardize the results to N(0,1)
+        for m in xrange(nr_chunk):
+            output[m,:,:]  -= np.mean(output[m,:,:])
+            output[m,:,:]  /= np.std(output[m,:,:])
+        
+        yield np.rollaxis(output,0,3)
  
 def get_fourier_filter(fieldin, do_norm = True):
 
@@ -81,6 +81,98 @@ def compute_war_array(rainfieldArray, rainThreshold, noData=-999.0):
     warArray = np.array(warArray)
     return(warArray)
     
+def compute_code_histogram(codes, nrCodes=256):
+    '''
+    Function to compute the histogram of the 8-bit codes of one field (ny,nx) or of a stack of fields (n,ny,nx).
+    
+    Parameters
+    ----------
+    codes : uint8
+        Array of codes (e.g. rain8bit)
+    nrCodes : int
+        Number of codes (length of the lookup table)
+    
+    Returns
+    -------
+    counts : int
+        Number of pixels of each code, (nrCodes,) for one field or (n,nrCodes) for a stack of fields
+    '''
+    codes = np.asarray(codes)
+    if codes.ndim <= 2:
+        return(np.bincount(codes.ravel(), minlength=nrCodes))
+    counts = np.zeros((codes.shape[0], nrCodes), dtype=int)
+    for i in range(codes.shape[0]):
+        counts[i] = np.bincount(codes[i].ravel(), minlength=nrCodes)
+    return(counts)
+    
+def compute_war_histogram(counts, lut, rainThreshold, noData=-999.0):
+    '''
+    Function to compute the WAR (as compute_war) from the histogram(s) of the codes and their lookup table of rain rates.
+    '''
+    counts = np.asarray(counts)
+    lut = np.asarray(lut)
+    nrRain = np.dot(counts, lut > rainThreshold)
+    nrRadarDomain = np.dot(counts, lut > noData + 1)
+    
+    war = 100.0*nrRain/np.maximum(nrRadarDomain, 1)
+    if np.any(nrRadarDomain == 0):
+        print("Problem in the computation of WAR. No pixel in the radar domain.")
+        print("WAR set to -1")
+    war = np.where(nrRadarDomain > 0, war, noData)
+    if war.ndim == 0:
+        war = float(war)
+    return(war)
+    
+def compute_imf_histogram(counts, lut, rainThreshold=-1, noData=-999.0):
+    '''
+    Function to compute the IMF (as compute_imf) from the histogram(s) of the codes and their lookup table of rain rates.
+    '''
+    counts = np.asarray(counts)
+    lut = np.asarray(lut)
+    idxRain = (lut > rainThreshold) & (lut != noData)
+    nrRain = np.dot(counts, idxRain)
+    sumRain = np.dot(counts, np.where(idxRain, lut, 0.0))
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        imf = sumRain/nrRain
+    if imf.ndim == 0:
+        imf = float(imf)
+    return(imf)
+    
+def compute_histogram_moments(counts, values):
+    '''
+    Function to compute the mean and standard deviation (as np.nanmean and np.nanstd) of the field(s) 
+    from the histogram(s) of their codes and the values of the codes (nan values are excluded).
+    
+    Parameters
+    ----------
+    counts : int
+        Number of pixels of each code, (nrCodes,) for one field or (n,nrCodes) for a stack of fields
+    values : float
+        Value of each code (nrCodes,)
+    
+    Returns
+    -------
+    mean: float
+        Mean of the field(s)
+    std: float
+        Standard deviation of the field(s)
+    '''
+    counts = np.asarray(counts, dtype=float)
+    values = np.asarray(values, dtype=float)
+    isValid = ~np.isnan(values)
+    values = np.where(isValid, values, 0.0)
+    weights = counts*isValid
+    nrValid = np.sum(weights, axis=-1)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.dot(weights, values)/nrValid
+        std = np.sqrt(np.sum(weights*(values - mean[...,None])**2, axis=-1)/nrValid)
+    if mean.ndim == 0:
+        mean = float(mean)
+        std = float(std)
+    return(mean, std)
+    
 def compute_beta(logScale, logPower):
     beta, intercept, r_beta, p_value, std_err = stats.linregress(logScale, logPower)
     return(beta, intercept, r_beta)
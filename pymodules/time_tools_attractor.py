@@ -134,49 +134,115 @@ def juliantimestring2datetime(timeString, format='YYJJJHHMM'):
 
 def juliantimestring2datetime_array(timeStampJulianArray, format='YYJJJHHMM', timeString=True):
     '''
-    Same as above but for a list or array of time stamps.
+    Same as above but for a list or array of time stamps (computed arithmetically with datetime64).
+    Returns lists of datetimes and time strings YYYYmmDDHHMMSS for less than 1e6 samples, 
+    otherwise arrays of datetime64[m] and of time strings YYYYmmDDHHMM.
     '''
     nrSamples = len(timeStampJulianArray)
+    timeStampDt = juliantime_array2datetime64(timeStampJulianArray, format=format)
     
     # If not many samples...
     if nrSamples < 1000000:
-        timeStampJulianArrayStr = np.array(map(lambda n: "%0.9i"%n, timeStampJulianArray))
-        timeStampJulianArrayDt = map(juliantimestring2datetime, timeStampJulianArrayStr)
+        timeStampJulianArrayDt = timeStampDt.astype(datetime.datetime).tolist()
         if timeString == True:
-            timeStampArrayStr = map(datetime2timestring, timeStampJulianArrayDt)
+            timeStampArrayStr = datetime64_2timestamp_array(timeStampDt).astype(str).tolist()
         else:
             timeStampArrayStr = []
         return(timeStampJulianArrayDt, timeStampArrayStr)
     
     else:
         # If a lot of samples
-        timeStampJulianSet = np.unique(timeStampJulianArray)
-        
-        nrUniqueSamples = len(timeStampJulianSet)
-        print(nrSamples, nrUniqueSamples)
-        
-        timeStampDt = np.empty((nrSamples,), dtype='datetime64[m]')
-        timeStampStr = np.empty((nrSamples,), dtype='S12')
-        
-        # Do the operations over the unique time stamps
-        for i in range(0,nrUniqueSamples):
-            timeStampJulianStr = "%0.9i"% timeStampJulianSet[i]
-            dt = juliantimestring2datetime(timeStampJulianStr, format=format)
-            
-            bool = (timeStampJulianArray == timeStampJulianSet[i])
-            
-            # Set values in array
-            timeStampDt[bool] = dt
-            if timeString == True:
-                dtStr = datetime2timestring(dt)
-                timeStampStr[bool] = dtStr
-
-            # Print out advancement (for large arrays)    
-            if ((i % 100) == 0):
-                print(fmt1 % (i/nrUniqueSamples*100),"%")
-            
+        if timeString == True:
+            timeStampStr = datetime64_2timestamp_array(timeStampDt, seconds=False).astype('S12')
+        else:
+            timeStampStr = np.empty((nrSamples,), dtype='S12')
         return(timeStampDt, timeStampStr)   
     
+def timestamp_array2datetime64(timeStamps):
+    '''
+    Function to convert an array of time stamps YYYYmmDDHHMM or YYYYmmDDHHMMSS (integers or strings) 
+    into a datetime64 array, arithmetically.
+    
+    Parameters
+    ----------
+    timeStamps : int or str
+        Array of time stamps YYYYmmDDHHMM or YYYYmmDDHHMMSS
+    
+    Returns
+    -------
+    timeDate64: datetime64[s]
+        Array of datetime64
+    '''
+    timeStamps = np.asarray(timeStamps).astype(np.int64)
+    
+    # Add seconds to the time stamps YYYYmmDDHHMM
+    if (timeStamps.size > 0) and (np.max(timeStamps) < 10**12):
+        timeStamps = timeStamps*100
+    
+    years = timeStamps//10**10
+    months = timeStamps//10**8 % 100
+    days = timeStamps//10**6 % 100
+    secs = (timeStamps//10**4 % 100)*3600 + (timeStamps//100 % 100)*60 + timeStamps % 100
+    
+    timeDate64 = ((years - 1970)*12 + months - 1).astype('datetime64[M]').astype('datetime64[s]') + \
+        ((days - 1)*86400 + secs).astype('timedelta64[s]')
+    return(timeDate64)
+    
+def datetime64_2timestamp_array(timeDate64, seconds=True):
+    '''
+    Function to convert a datetime64 array into an array of integer time stamps YYYYmmDDHHMMSS (or YYYYmmDDHHMM).
+    Use .astype(str) to get the time strings.
+    '''
+    timeDate64 = np.asarray(timeDate64, dtype='datetime64[s]')
+    years = timeDate64.astype('datetime64[Y]').astype(np.int64) + 1970
+    months = timeDate64.astype('datetime64[M]')
+    days = timeDate64.astype('datetime64[D]')
+    secs = (timeDate64 - days).astype(np.int64)
+    
+    timeStamps = years*10**10 + (months.astype(np.int64) % 12 + 1)*10**8 + ((days - months).astype(np.int64) + 1)*10**6 + \
+        (secs//3600)*10**4 + (secs % 3600//60)*100 + secs % 60
+    if seconds == False:
+        timeStamps = timeStamps//100
+    return(timeStamps)
+    
+def juliantime_array2datetime64(timeStampJulianArray, format='YYJJJHHMM'):
+    '''
+    Function to convert an array of Julian time stamps YYJJJHHMM or YYYYJJJHHMM (integers or strings) 
+    into a datetime64 array, arithmetically.
+    Years YY > 80 are in the 20th century (as juliantimestring2datetime).
+    '''
+    timeStamps = np.asarray(timeStampJulianArray).astype(np.int64)
+    
+    if format == 'YYJJJHHMM':
+        years = timeStamps//10**7
+        years = np.where(years > 80, 1900 + years, 2000 + years)
+    elif format == 'YYYYJJJHHMM':
+        years = timeStamps//10**7
+    else:
+        print("Julian time stamp format not supported.")
+        sys.exit(1)
+    julianDays = timeStamps//10**4 % 1000
+    mins = (timeStamps//100 % 100)*60 + timeStamps % 100
+    
+    timeDate64 = (years - 1970).astype('datetime64[Y]').astype('datetime64[m]') + \
+        ((julianDays - 1)*1440 + mins).astype('timedelta64[m]')
+    return(timeDate64)
+    
+def datetime64_2juliantime_array(timeDate64, format='YYJJJHHMM'):
+    '''
+    Function to convert a datetime64 array into an array of integer Julian time stamps YYJJJHHMM (or YYYYJJJHHMM).
+    '''
+    timeDate64 = np.asarray(timeDate64, dtype='datetime64[m]')
+    years = timeDate64.astype('datetime64[Y]')
+    julianDays = (timeDate64.astype('datetime64[D]') - years).astype(np.int64) + 1
+    mins = (timeDate64 - timeDate64.astype('datetime64[D]')).astype(np.int64)
+    
+    years = years.astype(np.int64) + 1970
+    if format == 'YYJJJHHMM':
+        years = years % 100
+    timeStamps = years*10**7 + julianDays*10**4 + (mins//60)*100 + mins % 60
+    return(timeStamps)
+    
 def get_julianday(timeDate):
     '''
     Get Julian day from datetime object.
@@ -319,10 +385,11 @@ def datetime2absolutetime(timeDate):
     '''
     
     # Convert list or numpy array of values
-    if type(timeDate) == list or type(timeDate) == np.ndarray:
-        absTime = []
-        for t in range(0,len(timeDate)):
-            absTime.append(datetime2absolutetime(timeDate[t]))
+    if (type(timeDate) == np.ndarray) and np.issubdtype(timeDate.dtype, np.datetime64):
+        absTime = timeDate.astype('datetime64[s]').astype(np.int64)
+    elif type(timeDate) == list or type(timeDate) == np.ndarray:
+        epoch = datetime.datetime(1970,1,1)
+        absTime = [int((t - epoch).total_seconds()) for t in timeDate]
     else:
         # Convert single value
         absTime = int((timeDate-datetime.datetime(1970,1,1)).total_seconds())
@@ -354,11 +421,14 @@ def sample_independent_times(timeStampsDt, indepTimeHours=6, method='start'):
     if len(timeStampsDt) <= 1:
         return(timeStampsDt,[0])
     
-    sortedIdx = np.argsort(timeStampsDt)
-    timeStampsDt = np.sort(timeStampsDt)
+    # Integer seconds instead of datetimes
+    timeStampsSec = np.array(datetime2absolutetime(np.asarray(timeStampsDt)), dtype=np.int64)
+    sortedIdx = np.argsort(timeStampsSec, kind='mergesort')
+    timeStampsSec = timeStampsSec[sortedIdx]
     
-    timeDiffs = np.diff(datetime2absolutetime(timeStampsDt))
-    timeDiffs = np.hstack((timeDiffs[0], timeDiffs))
+    timeDiffs = np.diff(timeStampsSec)
+    timeDiffs = np.hstack((timeDiffs[0], timeDiffs)).tolist()
+    sortedIdx = sortedIdx.tolist()
     
     indepTimeSecs = indepTimeHours*60*60
     #print(timeStampsDt.shape, timeDiffs)
@@ -367,7 +437,7 @@ def sample_independent_times(timeStampsDt, indepTimeHours=6, method='start'):
         timeDiffsAccum = 0
         indepIndices = []
         indepTimeStampsDt = []
-        for i in range(0,len(timeStampsDt)):
+        for i in range(0,len(timeStampsSec)):
             if (i == 0) | (timeDiffs[i] >= indepTimeSecs) | (timeDiffsAccum >= indepTimeSecs):
                 indepIndices.append(sortedIdx[i])
                 indepTimeStampsDt.append(sortedIdx[i])
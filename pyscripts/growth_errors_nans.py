@@ -66,7 +66,7 @@ parser.add_argument('-accum', default=5, type=int,help='Accumulation time of the
 parser.add_argument('-temp', default=5, type=int,help='Temporal sampling of the products [minutes].')
 parser.add_argument('-format', default='netcdf', type=str,help='Format of the file containing the statistics [csv,netcdf].')
 parser.add_argument('-plt', default='spread', type=str,help='Plot type [spread, evolution].')
-parser.add_argument('-refresh', default=0, type=int,help='Whether to refresh the binary .npy archive or not.')
+parser.add_argument('-refresh', default=0, type=int,help='Whether to rebuild the statistics store from the daily files of the period or not.')
 
 args = parser.parse_args()
 
@@ -105,40 +105,31 @@ if spreadMeasure == 'scatter':
     
 ############### OPEN FILES WITH STATS
 
-## Open single binary python file with stats to speed up (if it exists)
-tmpArchiveFileName = tmpBaseDir + timeStartStr + '-' + timeEndStr + '_temporaryAttractor.npy'
-tmpArchiveFileNameVariables = tmpBaseDir + timeStartStr + '-' + timeEndStr + '_temporaryAttractor_varNames.npy'
-if (os.path.isfile(tmpArchiveFileName) == True) and (refreshArchive == False):
-    arrayStats = np.load(tmpArchiveFileName)
-    arrayStats = arrayStats.tolist()
-    variableNames = np.load(tmpArchiveFileNameVariables)
-    print('Loaded:', tmpArchiveFileName)
-else: 
-    ## Open whole list of CSV or netCDF files
-    if args.format == 'csv':
-        arrayStats, variableNames = io.csv_list2array(timeStart, timeEnd, inBaseDir, analysisType='STATS', \
-        product = product, timeAccumMin = timeSampMin, minR=args.minR, wols=args.wols)
-    elif args.format == 'netcdf':
-        arrayStats, variableNames = io.netcdf_list2array(timeStart, timeEnd, inBaseDir, analysisType='STATS', \
-        product = product, timeAccumMin = timeAccumMin, minR=args.minR, wols=args.wols, variableBreak = 0)
-    else:
-        print('Please provide a valid file format.')
-        sys.exit(1)
-        
-    # Check if there are data
-    if (len(arrayStats) == 0) & (args.format == 'csv'):
-        print("No data found in CSV files.")
-        sys.exit(1)
-    if (len(arrayStats) == 0) & (args.format == 'netcdf'):
-        print("No data found in NETCDF files.")
-        sys.exit(1)
-
-## Save data into a single binary bython file to speed up further analysis with same dataset
-arrayData = []
-if refreshArchive == True:
-    np.save(tmpArchiveFileName, arrayStats)
-    np.save(tmpArchiveFileNameVariables, variableNames)
-    print('Saved:',tmpArchiveFileName)
+## Statistics store updated by radar_statistics.py (the days of the period not in the store yet are read from the daily files, all of them with -refresh)
+storeDir = io.get_dirname_stats_store(inBaseDir, 'STATS', product, timeAccumMin=timeAccumMin, minR=args.minR, \
+wols=args.wols, variableBreak=0)
+statsStore = io.Stats_store(storeDir)
+if args.format == 'csv':
+    # csv files are named with the sampling time
+    nrDaysRead = statsStore.load_daily_files(timeStart, timeEnd, inBaseDir, format=args.format, refresh=refreshArchive, analysisType='STATS', \
+    product = product, timeAccumMin = timeSampMin, minR=args.minR, wols=args.wols)
+else:
+    nrDaysRead = statsStore.load_daily_files(timeStart, timeEnd, inBaseDir, format=args.format, refresh=refreshArchive, analysisType='STATS', \
+    product = product, timeAccumMin = timeAccumMin, minR=args.minR, wols=args.wols, variableBreak=0)
+if nrDaysRead > 0:
+    print('Saved', nrDaysRead, 'days:', storeDir)
+
+## Read only the period from the store
+arrayStats, variableNames = statsStore.read(timeStart, timeEnd)
+print('Loaded:', storeDir)
+
+# Check if there are data
+if (len(arrayStats) == 0) & (args.format == 'csv'):
+    print("No data found in CSV files.")
+    sys.exit(1)
+if (len(arrayStats) == 0) & (args.format == 'netcdf'):
+    print("No data found in NETCDF files.")
+    sys.exit(1)
     
 ################ Fill both datetime and data arrays with NaNs where there is no data
 # Generate list of datetime objects
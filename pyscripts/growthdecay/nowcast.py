@@ -13,11 +13,15 @@ import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
 
 from scipy import fftpack
-from scipy.linalg import inv,pinv
+from scipy.linalg import inv,cho_factor,cho_solve,eigh,LinAlgError
 from scipy.spatial.distance import cdist
 from scipy.stats import norm
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
 
-from numpy import dot, zeros, eye, outer
+from numpy import dot, zeros, eye
 from numpy.random import multivariate_normal
 
 import time_tools_attractor as ti
@@ -31,6 +35,129 @@ import cv2
 
 import load_forecasts as lf
 
+def gain_matrix(C, S):
+    '''
+    Gain C.S^+ for a symmetric matrix S (e.g. K = P.(P+R)^+), solved with a Cholesky 
+    factorization of S, or with its eigendecomposition (pseudo-inverse of the 
+    non-zero eigenvalues, as pinv) if S is not positive definite.
+    '''
+    try:
+        return cho_solve(cho_factor(S), C.T).T
+    except LinAlgError:
+        w, V = eigh(S)
+        tol = np.max(np.abs(w))*len(w)*np.finfo(float).eps
+        winv = np.zeros(len(w))
+        winv[np.abs(w) > tol] = 1.0/w[np.abs(w) > tol]
+        return dot(dot(C, V)*winv, V.T)
+        
+class PCA_operator(object):
+    '''
+    Reduced-space observation operator hx for Nowcasting.update.
+    The principal components are estimated with a randomized SVD with a fixed budget of 
+    n_components, only on a subset of pixels (e.g. the wet pixels idxWet), and the 
+    range finder is warm-started with the components of the previous cycle. 
+    Same attributes as sklearn.decomposition.PCA (mean_, components_, explained_variance_, 
+    whiten), but restricted to the pixels idx_.
+    
+    Parameters
+    ----------
+    n_components : int
+        number of principal components.
+    n_oversamples : int
+        additional random vectors of the range finder.
+    n_iter : int
+        number of power iterations.
+    whiten : bool
+        scale the projections to unit variance.
+    warm_start : bool
+        start the range finder from the components of the previous fit.
+    '''
+    
+    def __init__(self, n_components, n_oversamples = 10, n_iter = 2, whiten = False, warm_start = True, random_state = None):
+        self.n_components = n_components
+        self.n_oversamples = n_oversamples
+        self.n_iter = n_iter
+        self.whiten = whiten
+        self.warm_start = warm_start
+        self.random_state = np.random.RandomState(random_state)
+        
+        self.idx_ = None
+        self.dim_n = None
+        self.mean_ = None
+        self.components_ = None
+        self.explained_variance_ = None
+        
+    def previous_components(self, idx):
+        ''' Components of the previous fit on the new pixels idx (zero on the pixels not used before). '''
+        if (not self.warm_start) or (self.components_ is None):
+            return None
+        components = np.zeros((self.components_.shape[0], self.dim_n))
+        components[:,self.idx_] = self.components_
+        return components[:,idx]
+        
+    def fit_transform(self, X, idx = None):
+        ''' Fit the components on the columns idx of X (nsamples, dim_n) and return the projections (nsamples, n_components). '''
+        nsamples, dim_n = X.shape
+        if idx is None:
+            idx = np.arange(dim_n)
+        idx = np.flatnonzero(idx) if np.asarray(idx).dtype == bool else np.asarray(idx)
+        if len(idx) == 0:
+            # no pixel selected (e.g. no wet pixel): fit on all pixels
+            idx = np.arange(dim_n)
+
+        # centred data on the selected pixels only
+        mean = X[:,idx].mean(axis=0)
+        A = X[:,idx] - mean
+        
+        k = int(np.min((self.n_components, nsamples, len(idx))))
+        nvectors = int(np.min((k + self.n_oversamples, nsamples, len(idx))))
+        
+        # range finder, warm-started with the previous components
+        Omega = self.random_state.normal(size=(len(idx), nvectors))
+        previous = self.previous_components(idx)
+        if previous is not None:
+            nprevious = np.min((previous.shape[0], nvectors))
+            Omega[:,:nprevious] = previous[:nprevious,:].T
+        Q = np.linalg.qr(A.dot(Omega))[0]
+        for it in xrange(self.n_iter):
+            Q = np.linalg.qr(A.T.dot(Q))[0]
+            Q = np.linalg.qr(A.dot(Q))[0]
+            
+        # SVD of the small projected matrix
+        U, S, Vt = np.linalg.svd(Q.T.dot(A), full_matrices=False)
+        S = S[:k]
+        Vt = Vt[:k,:]
+        
+        # deterministic signs (largest loading of each component positive)
+        signs = np.sign(Vt[np.arange(k), np.argmax(np.abs(Vt), axis=1)])
+        signs[signs == 0] = 1
+        Vt *= signs[:,None]
+        
+        self.idx_ = idx
+        self.dim_n = dim_n
+        self.mean_ = mean
+        self.components_ = Vt
+        self.explained_variance_ = S**2/(nsamples - 1)
+        
+        # exact projections on the estimated components
+        X_h = A.dot(Vt.T)
+        if self.whiten:
+            X_h /= np.sqrt(self.explained_variance_)
+        return X_h
+        
+    def transform(self, X):
+        ''' Projections of X (nsamples, dim_n) on the components. '''
+        X_h = (X[:,self.idx_] - self.mean_).dot(self.components_.T)
+        if self.whiten:
+            X_h /= np.sqrt(self.explained_variance_)
+        return X_h
+        
+    def inverse_increment(self, dX_h):
+        ''' Increment (nsamples, len(idx_)) on the pixels idx_ of a change dX_h of the projections. '''
+        if self.whiten:
+            dX_h = dX_h*np.sqrt(self.explained_variance_)
+        return dX_h.dot(self.components_)
+        
 class Nowcasting:
     '''
     '''
@@ -38,7 +165,7 @@ class Nowcasting:
     def __init__(self, data, N, hx, fx, rx, phi,   \
                  AR_order=2, number_levels=8, transformation='dBR', probability_matching=True, \
                  resolution_km=1, label='EnKF', min_rainrate=0.01, \
-                 wet_thr=0.5, zero_padding = 0):    
+                 wet_thr=0.5, zero_padding = 0, nthreads = 1, fxlevels = None, predict_batch = 4):    
  
         """ Create a Kalman filter.
         Parameters
@@ -47,8 +174,9 @@ class Nowcasting:
             state mean
         N : int
             number of sigma points (ensembles). Must be greater than 1.
-        hx : function hx(x)
+        hx : function hx(x) or PCA_operator
             Measurement function. Converts state x into a measurement. 
+            With a PCA_operator the update is done in the reduced space of the wet pixels.
         fx : function fx(x)
             State transition function. May be linear or nonlinear. Projects
             state x into the next time period. Returns the projected state x.
@@ -56,10 +184,18 @@ class Nowcasting:
             Random noise function. 
         phi : float 
             Parameters of the AR process.
+        fxlevels : function fxlevels(x, rf, net), optional
+            Same as fx for a block of fields x(dim_y, dim_x, nfields), so that the lags, 
+            the rain rates and the mask of a member are advected with a single call. 
+            If None, fx is called on each field.
+        predict_batch : int, optional
+            Number of members decomposed and recombined together in predict 
+            (bounds the memory of the cascades, raise it to trade memory for speed). 
+            All members if None.
         """
         
         # lag-n radar images
-        xlag_rainrates_fields = data.n_last_obs(AR_order)[::-1,:,:] # xlag_rainrates_fields[0,:,:] is last image
+        xlag_rainrates_fields = data.n_last_obs(AR_order)[::-1,:,:].copy() # xlag_rainrates_fields[0,:,:] is last image
         xlag_rainrates_fields[xlag_rainrates_fields<min_rainrate] = 0
         
         # dimensions
@@ -68,12 +204,14 @@ class Nowcasting:
         self.dim_t = data.obs.shape[0]
         self.N = N
         self.idxMember = np.arange(N)
+        self.pairingCost = np.nan
         self.resolution_km = resolution_km
         self.nlags = AR_order
         
         # various operators
         self.hx = hx
         self.fx = fx
+        self.fxlevels = fxlevels
         self.rx = rx
         self.phi = phi
         self.pca = []
@@ -105,6 +243,13 @@ class Nowcasting:
         self.bandpassFilter2D = bandpassFilter2D
         self.centreWaveLengths = centreWaveLengths
         self.zero_padding = zero_padding
+        self.cascadeEngine = nw.CascadeEngine(bandpassFilter2D, zeroPadding = zero_padding, nthreads = nthreads)
+        if predict_batch is None:
+            predict_batch = N
+        self.predict_batch = int(np.min((predict_batch, N)))
+        
+        # kernel of the precipitation mask
+        self.precipmask_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (20,20))
 
         # perturbations for motion field
         # self.motion_pert = np.abs(np.random.normal(loc=1.0, scale=0.1, size=self.N)) 
@@ -161,8 +306,32 @@ class Nowcasting:
             self.xlag_fields[lag,:,:,:] = np.repeat(xlag_fields[lag,:,:][None, :, :], self.N, axis=0) # (N, dim_y, dim_x)
             self.xlag_matrix[lag,:,:] = self.xlag_fields[lag,:,:,:].reshape((N,-1)) # (N, dim_n)
             
+    def advect(self, fields, motion_pert, net=1):
+        ''' Advect a block of fields (nfields, dim_y, dim_x) with the same motion perturbation. '''
+        
+        if self.fxlevels is None:
+            return np.array([self.fx(field, motion_pert, net) for field in fields])
+        
+        # all the fields with a single call
+        fieldsAdv = self.fxlevels(np.asfortranarray(fields.transpose((1,2,0)), dtype=np.float32), motion_pert, net)
+        return np.asarray(fieldsAdv, dtype=float).transpose((2,0,1))
+        
+    def dilate_precipmask(self, x_rainrates):
+        ''' Dilated precipitation masks (N, dim_y, dim_x) of a stack of rain rate fields. '''
+        
+        precipmask = (x_rainrates > 0.3).astype('uint8')
+        # the members are dilated together as channels of one image (at most 512 channels in cv2)
+        for i0 in xrange(0, precipmask.shape[0], 512):
+            i1 = np.min((i0 + 512, precipmask.shape[0]))
+            channels = np.ascontiguousarray(precipmask[i0:i1,:,:].transpose((1,2,0)))
+            channels = cv2.dilate(channels, self.precipmask_kernel)
+            precipmask[i0:i1,:,:] = channels.reshape(channels.shape[:2] + (i1-i0,)).transpose((2,0,1))
+        return precipmask.astype(bool)
+        
     def predict(self, growthdecay=None, net=1):
-        ''' Predict next position with an AR process. '''
+        ''' Predict next position with an AR process. 
+        The whole ensemble (nlags, N, dim_y, dim_x) is decomposed and recombined at once 
+        (by blocks of predict_batch members), only the advection is done member by member. '''
         
         # update counter
         self.countpredicts += 1
@@ -174,104 +343,93 @@ class Nowcasting:
         dim_x = self.dim_yx[1]
         nlags = self.nlags
         number_levels = self.number_levels
-        bandpassFilter2D = self.bandpassFilter2D 
-        centreWaveLengths = self.centreWaveLengths
-        zero_padding = self.zero_padding
         phi = self.phi
         min_rainrate = self.min_rainrate
         minDBZ = self.minDBZ
+        nbatch = self.predict_batch
         
         # prepare perturbations
         noiseFields = self.rx(dim_yx,N)
         
+        # apply extrapolation(lag0 is most recent image), together with the rain rates and the radar mask
+        x = np.zeros((nlags, N, dim_y, dim_x))
+        x_rainrates = np.zeros((N, dim_y, dim_x))
+        mask = np.zeros((N, dim_y, dim_x))
         for i in xrange(N):
+            fields = np.concatenate((self.xlag_fields[:,i,:,:], self.x_rainrates_fields[i,:,:][None,:,:], self.mask[i,:,:][None,:,:].astype(float)), axis=0)
+            fields = self.advect(fields, self.motion_pert[i], net)
+            x[:,i,:,:] = fields[:nlags]
+            x_rainrates[i,:,:] = fields[nlags]
+            mask[i,:,:] = fields[nlags+1]
+        mask = mask >= 0.5
             
-            # extract given field 
-            x = self.xlag_fields[:,i,:,:].copy()                        # transformed (e.g. dBZ)
-            x_rainrates = self.x_rainrates_fields[i,:,:].copy()         # rain rates
-            mask = self.mask[i,:,:].copy().astype(float)                # radar mask
+        # build the precipitation masks
+        precipmask = self.dilate_precipmask(x_rainrates)
+        
+        # AR parameters and noise variances (Yule-Walker eq) of all cascade levels
+        phi_levels = phi[:,:nlags]
+        noise_variance = ( (1 + phi[:,1]) * (1 + phi[:,0] - phi[:,1])*(1 - phi[:,0] - phi[:,1]) ) / ( 1 - phi[:,1])
+        # noise_correction = 1/( .75 + 0.09*l )  # original equation
+        noise_correction = np.ones(number_levels)
+        noise_factor = noise_correction*np.sqrt(noise_variance)
+        
+        # output buffers for the cascade decompositions
+        cascadeEngine = self.cascadeEngine
+        cascadeBuffer = np.zeros((nlags*nbatch, dim_y, dim_x, number_levels))
+        noiseCascadeBuffer = np.zeros((nbatch, dim_y, dim_x, number_levels))
+        
+        xn = np.zeros((N, dim_y, dim_x))
+        for i0 in xrange(0, N, nbatch):
+            i1 = np.min((i0 + nbatch, N))
+            nb = i1 - i0
             
-            # apply extrapolation(lag0 is most recent image)
-            motion_pert = self.motion_pert[i]
-            for lag in xrange(nlags):
-                x[lag,:,:] = self.fx(x[lag,:,:],motion_pert,net)                   
-            x_rainrates = self.fx(x_rainrates,motion_pert,net)
+            # cascade decomposition of the rainfall fields of all lags and members
+            cascade, cascadeMean, cascadeStd = cascadeEngine.decompose((x[:,i0:i1,:,:] - minDBZ).reshape((nlags*nb, dim_y, dim_x)), out = cascadeBuffer[:nlags*nb])
+            cascade = cascade.reshape((nlags, nb, dim_y, dim_x, number_levels))
+            cascadeMean = cascadeMean.reshape((nlags, nb, number_levels))
+            cascadeStd = cascadeStd.reshape((nlags, nb, number_levels))
             
-            # advect radar mask too
-            mask = self.fx(mask,motion_pert,net)
-            mask[mask>=0.5] = 1; mask[mask<0.5] = 0
-            mask = mask.astype(bool)
+            # cascade decomposition of the noise fields
+            noisecascade, _, _ = cascadeEngine.decompose(noiseFields[i0:i1], out = noiseCascadeBuffer[:nb])
             
-            # build a precipitation mask
-            n=20
-            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (n,n))   
-            precipmask = (x_rainrates > 0.3 ).astype('uint8')
-            precipmask = cv2.dilate(precipmask,kernel).astype(bool)
+            # AR(nlags) plus noise on all levels, rescaled with the lag0 statistics and summed over the levels
+            xn[i0:i1,:,:] = np.einsum('kiyxl,lk,il->iyx', cascade, phi_levels, cascadeStd[0]) \
+                + np.einsum('iyxl,l,il->iyx', noisecascade, noise_factor, cascadeStd[0]) \
+                + np.sum(cascadeMean[0], axis=1)[:,None,None]
             
-            # cascade decomposition of rainfall field
-            cascade, cascadeMean, cascadeStd = nw.get_cascade_from_array(x - minDBZ, number_levels, bandpassFilter2D, centreWaveLengths, zeroPadding = zero_padding, zerothr = None, squeeze=False)
+        # growth and decay
+        if (growthdecay is not None and
+            growthdecay.shape[0] == self.dim_yx[0] and
+            growthdecay.shape[1] == self.dim_yx[1]):   
+                
+            xn += growthdecay[None,:,:]
             
-            # cascade decomposition of noise field
-            noisecascade, _, _ = nw.get_cascade_from_array(noiseFields[i], number_levels, bandpassFilter2D, centreWaveLengths, zeroPadding = zero_padding)
+        xn += minDBZ    
+                               
+        # update stack
+        x[1:,:,:,:] = x[:-1,:,:,:].copy()
+        x[0,:,:,:] = xn   
+        
+        # store this version in the global stack
+        self.xlag_fields = x
             
-            # add noise level by level
-            xn = np.zeros(dim_yx)
-            for l in xrange(number_levels):
-                
-                # fetch the AR(1) parameter for this cascade level
-                phi_level = phi[l,:].copy()      
-                # derive the noise variance (Yule-Walker eq)
-                noise_variance = ( (1 + phi_level[1]) * (1 + phi_level[0] - phi_level[1])*(1 - phi_level[0] - phi_level[1]) ) / ( 1 - phi_level[1])
-                
-                if number_levels>1:
-                    # noise_correction = 1/( .75 + 0.09*l )  # original equation
-                    noise_correction = 1
-                else:
-                    noise_correction = 1  
-                    
-                # AR(nlags)
-                xn_l = np.zeros(dim_yx)
-                for lag in xrange(nlags):
-                    xn_l += phi_level[lag]*cascade[lag,:,:,l]
-                xn += ( xn_l + noise_correction*np.sqrt(noise_variance)*noisecascade[:,:,l] )*cascadeStd[0,l] + cascadeMean[0,l]
-                
-            # growth and decay
-            if (growthdecay is not None and
-                growthdecay.shape[0] == self.dim_yx[0] and
-                growthdecay.shape[1] == self.dim_yx[1]):   
-                    
-                xn += growthdecay
-                
-            xn += minDBZ    
-                                   
-            # update stack
-            for lag in xrange(nlags-1,0,-1):
-                x[lag,:,:] = x[lag-1,:,:]
-            x[0,:,:] = xn   
+        # then apply the masks
+        xn = np.where(precipmask, xn, xn.reshape((N,-1)).min(axis=1)[:,None,None])
             
-            # store this version in the global stack
-            self.xlag_fields[:,i,:,:] = x.copy()
-                
-            # then apply the masks
-            # x[~mask] = x.min()
-            xn[~precipmask] = xn.min()         
-                
-            # probability matching
-            if self.probability_matching and (self.transformation=='dBZ' or self.transformation=='dBR'):
-                x_rainrates = self.do_probability_matching(xn.ravel(),x_rainrates.ravel()).reshape(dim_yx)
-                
-            elif self.probability_matching and not self.transformation:
-                x_rainrates = self.do_probability_matching(xn.ravel(),x_rainrates.ravel()).reshape(dim_yx)   
-            elif not self.probability_matching and (self.transformation=='dBZ' or self.transformation=='dBR'):
-                x_rainrates = self.toRainrates(xn.copy())
-            else:
-                print('Warning: did not fully consider this combination of options (predict -> probability matching)')
-                x_rainrates = xn
-               
-            # back to global stacks
-            x_rainrates[x_rainrates<=min_rainrate] = 0
-            self.x_rainrates_fields[i,:,:] = x_rainrates.copy()  
-            self.mask[i,:,:] = mask.copy().astype(bool) 
+        # probability matching
+        if self.probability_matching and (self.transformation=='dBZ' or self.transformation=='dBR' or not self.transformation):
+            rankedTargets = ssft.rank_target(x_rainrates, perfield=True)
+            x_rainrates = ssft.quantile_transformation_batch(xn, rankedTargets, zerovalue=None)
+        elif not self.probability_matching and (self.transformation=='dBZ' or self.transformation=='dBR'):
+            x_rainrates = self.toRainrates(xn.copy())
+        else:
+            print('Warning: did not fully consider this combination of options (predict -> probability matching)')
+            x_rainrates = xn
+           
+        # back to global stacks
+        x_rainrates[x_rainrates<=min_rainrate] = 0
+        self.x_rainrates_fields = x_rainrates  
+        self.mask = mask
             
         self.xlag_matrix = self.xlag_fields.reshape((nlags,N,-1))    
         self.x_rainrates_matrix = self.x_rainrates_fields.reshape((N,-1))    
@@ -314,7 +472,7 @@ class Nowcasting:
         offset_r = 0
         
         # apply mask to z
-        z_rainrates_fields[z_rainrates_fields<min_rainrate] = 0
+        z_rainrates_fields = np.where(z_rainrates_fields<min_rainrate, 0, z_rainrates_fields) # on a copy, the data arrays are read-only
         mask_fields = self.mask
         # z_rainrates_fields[~mask_fields] = 0
         
@@ -359,14 +517,23 @@ class Nowcasting:
         x_all = np.concatenate((x, z), axis=0)
 
         # transform all points into new space (PCA)
-        x_all_h, model = self.hx(x_all)
+        reduced = isinstance(self.hx, PCA_operator)
+        if reduced:
+            # fitted on the wet pixels only
+            model = self.hx
+            x_all_h = model.fit_transform(x_all, idx = idxWet if wet_thr>0 else None)
+        else:
+            x_all_h, model = self.hx(x_all)
         x_h = x_all_h[:N,:]
         z_h = x_all_h[N:,:]
         self.pca = model
         n_components = x_h.shape[1]
         
         # only with wet pixels
-        if wet_thr>0:
+        if reduced:
+            x_h_wet = x_h
+            z_h_wet = z_h
+        elif wet_thr>0:
             h_components = model.components_.copy()
             x_all_h_wet = ( x_all[:,idxWet] - model.mean_[idxWet] ).dot( h_components[:,idxWet].T ) 
             if model.whiten:
@@ -378,8 +545,12 @@ class Nowcasting:
             z_h_wet = z_h
             
         # trasnform-back to estimate reconstruction residuals
-        x_reconstr = model.inverse_transform(x_h)
-        z_reconstr = model.inverse_transform(z_h)
+        if not reduced:
+            x_reconstr = model.inverse_transform(x_h)
+            z_reconstr = model.inverse_transform(z_h)
+        else:
+            # only the sum over the members is needed
+            zx_increment = model.inverse_increment((z_h - x_h).sum(axis=0)[None,:])[0]
         
         # tapering function
         if tapering is None:
@@ -395,78 +566,67 @@ class Nowcasting:
         kmethod = 0
         if kmethod==0:
         
-            P = 0 # radar
-            x_h_wet_mean = x_h_wet.mean(axis=0)
-            for i in xrange(N):
-                x_e = ( x_h_wet[i,:] - x_h_wet_mean ) * inflation_factor_p
-                P += outer(x_e, x_e)
-            P = ( P / (N-1) + offset_p ) * tpring
+            # anomalies (N, n_components)
+            X_e = ( x_h_wet - x_h_wet.mean(axis=0) ) * inflation_factor_p # radar
+            Z_e = ( z_h_wet - z_h_wet.mean(axis=0) ) * inflation_factor_r # cosmo
+            
+            P = ( dot(X_e.T, X_e) / (N-1) + offset_p ) * tpring
             P[P<1e-3] = 0
             
-            R = 0 # cosmo
-            z_h_wet_mean = z_h_wet.mean(axis=0)
-            for i in xrange(N):
-                z_e = ( z_h_wet[i,:] - z_h_wet_mean ) * inflation_factor_r
-                R += outer(z_e, z_e)
-            R = ( R / (N-1) + offset_r ) * tpring
+            R = ( dot(Z_e.T, Z_e) / (N-1) + offset_r ) * tpring
             R[R<1e-3] = 0
             
             # Kalman gain
-            K_h = dot(P, pinv(P + R))
+            K_h = gain_matrix(P, P + R)
             K_h[K_h<1e-3] = 0
             print('K_h shape = ',K_h.shape)
             
         if kmethod==1:
-            x_h_wet_mean = x_h_wet.mean(axis=0)
-            z_h_wet_mean = z_h_wet.mean(axis=0)
-            xz_h_wet_mean = (x_h_wet - z_h_wet).mean(axis=0)
-            C1 = 0
-            C2 = 0
-            for i in xrange(N):
-                x_e = x_h_wet[i,:] - x_h_wet_mean
-                xz_e = x_h_wet[i,:] - z_h_wet[i,:] - xz_h_wet_mean
-                C1 += outer(x_e, xz_e)
-                C2 += outer(xz_e, xz_e)
-            C1 = C1 / (N - 1)
-            C2 = C2 / (N - 1)
+            X_e = x_h_wet - x_h_wet.mean(axis=0)
+            XZ_e = (x_h_wet - z_h_wet) - (x_h_wet - z_h_wet).mean(axis=0)
+            C1 = dot(X_e.T, XZ_e) / (N - 1)
+            C2 = dot(XZ_e.T, XZ_e) / (N - 1)
             C1 *= tpring
             C2 *= tpring
             
             # Kalman gain
-            K_h = dot(C1, pinv(C2))
+            K_h = gain_matrix(C1, C2)
             K_h[K_h<1e-3] = 0
             print('K_h shape = ',K_h.shape)
         
         # pair members that are close
         if pairing:
-            dist = cdist(x_h,z_h)
-            idxMember = np.zeros(x_h.shape[0],dtype=int)
-            for i in xrange(z_h.shape[0]):
-                rmin,cmin = np.unravel_index(np.nanargmin(dist),dist.shape)
-                idxMember[rmin] = cmin
-                dist[rmin,:] = np.nan
-                dist[:,cmin] = np.nan
-            self.idxMember = idxMember
-            print(idxMember)
-            z_h = z_h[idxMember,:] 
+            self.idxMember, self.pairingCost = self.pair_members(x_h, z_h)
+            print(self.idxMember, 'pairing cost = %.3f' % self.pairingCost)
+            z_h = z_h[self.idxMember,:] 
         else:
             self.idxMember = np.arange(N)
+            self.pairingCost = np.nan
          
         #
         x_h_prior = x_h.copy()
         prior_rainrates = x_rainrates.copy()
         
-        # update   
-        for i in range(N):
-            x_h[i,:] += dot(K_h, z_h[i,:] - x_h[i,:])
+        # update all members at once
+        x_h_increment = dot(z_h - x_h, K_h.T)
+        x_h += x_h_increment
             
         # trasform the analysis back to original (transformed) space
-        x = model.inverse_transform(x_h)
+        if not reduced:
+            x = model.inverse_transform(x_h)
+        else:
+            # add the analysis increment to the wet pixels only
+            x_increment = model.inverse_increment(x_h_increment)
+            x[:,model.idx_] += x_increment
         
         # compute a global K
         if self.probability_matching:
-            K1 = (x.sum(axis=0) - x_reconstr.sum(axis=0)) 
-            K2 = (z_reconstr.sum(axis=0) - x_reconstr.sum(axis=0))
+            if not reduced:
+                K1 = (x.sum(axis=0) - x_reconstr.sum(axis=0)) 
+                K2 = (z_reconstr.sum(axis=0) - x_reconstr.sum(axis=0))
+            else:
+                K1 = x_increment.sum(axis=0)
+                K2 = zx_increment
             K = K1 / K2
             K[K>1] = 1
             K[K<0] = 0
@@ -481,9 +641,11 @@ class Nowcasting:
             
         # probability matching
         if self.probability_matching:
+            merged_arrays = np.zeros(x_rainrates.shape)
             for i in xrange(N):
-                merged_array = self.resample_distributions(x_rainrates[i,:],z_rainrates[self.idxMember[i],:], 1-Kglob)
-                x_rainrates[i,:] = self.do_probability_matching(x[i,:],merged_array)
+                merged_arrays[i,:] = self.resample_distributions(x_rainrates[i,:],z_rainrates[self.idxMember[i],:], 1-Kglob)
+            # merged arrays are sorted in descending order, match all members at once
+            x_rainrates = ssft.quantile_transformation_batch(x,merged_arrays[:,::-1],zerovalue=None)
             x_rainrates[x_rainrates<min_rainrate] = 0
         elif not self.probability_matching and (self.transformation=='dBZ' or self.transformation=='dBR'):
             x_rainrates = self.toRainrates(x.copy())
@@ -498,6 +660,27 @@ class Nowcasting:
         self.xlag_fields[0,:,:,:] = self.xlag_matrix[0,:,:].reshape((N,dim_y,dim_x)) # only needed for lag0 fields
         self.x_rainrates_fields = self.x_rainrates_matrix.reshape((N,dim_y,dim_x))         
             
+    def pair_members(self, x_h, z_h):
+        '''
+        Pair each member of x_h with a member of z_h, minimizing the sum of the 
+        distances between the pairs (linear assignment). Returns the permutation 
+        idxMember (x_h[i] is paired with z_h[idxMember[i]]) and the total distance.
+        Without scipy.optimize.linear_sum_assignment the closest pairs are taken greedily.
+        '''
+        dist = cdist(x_h,z_h)
+        if linear_sum_assignment is not None:
+            rows, idxMember = linear_sum_assignment(dist)
+        else:
+            idxMember = np.zeros(x_h.shape[0],dtype=int)
+            distGreedy = dist.copy()
+            for i in xrange(z_h.shape[0]):
+                rmin,cmin = np.unravel_index(np.nanargmin(distGreedy),distGreedy.shape)
+                idxMember[rmin] = cmin
+                distGreedy[rmin,:] = np.nan
+                distGreedy[:,cmin] = np.nan
+        pairingCost = dist[np.arange(x_h.shape[0]),idxMember].sum()
+        return idxMember, pairingCost
+        
     def transform(self, arrayin, doplot=False):
         if self.transformation == 'dBZ':
             return self.todBZ(arrayin)
@@ -643,32 +826,11 @@ class Nowcasting:
         
         assert initialarray.size == targetarray.size
         
-        # zeros in initial image
-        zvalue = initialarray.min()
-        idxzeros = initialarray == zvalue
-
-        # flatten the arrays
-        arrayshape = initialarray.shape
-        target = targetarray.flatten()
-        array = initialarray.flatten()
-        
         # rank target values
-        order = target.argsort()
-        ranked = target[order]
-
-        # rank initial values order
-        orderin = array.argsort()
-        ranks = np.empty(len(array), int)
-        ranks[orderin] = np.arange(len(array))
-
-        # get ranked values from target and rearrange with inital order
-        outputarray = ranked[ranks]
-
-        # reshape as original array
-        outputarray = outputarray.reshape(arrayshape)
+        rankedTarget = ssft.rank_target(targetarray)
         
-        # readding original zeros
-        outputarray[idxzeros] = zvalue
+        # map the initial values onto the ranked target values, keeping the original zeros (minimum)
+        outputarray = ssft.quantile_transformation_batch(initialarray[None,...],rankedTarget,zerovalue=None)[0]
 
         return outputarray
  
@@ -684,11 +846,19 @@ class Nowcasting:
         return mask
  
  
+# in-memory cache of the Datamanager arrays, keyed by (group, product, startStr, endStr, upscaleKm, min_rainrate, N)
+datamanagerCache = {}
+
 class Datamanager:
-    """ ... 
+    """ 
+    Observations and forecasts of a period, upscaled to upscaleKm. 
+    The arrays are kept in memory (shared by all the instances with the same period, 
+    products, upscaleKm and min_rainrate) and, if cacheDir is given, also stored on disk 
+    as .npy files that are memory-mapped by the next runs. 
+    The accessors return read-only views, not copies.
     """
 
-    def __init__(self, startStr =  '201706272200', endStr = '201706280400', upscaleKm = 1, min_rainrate = 0.01):
+    def __init__(self, startStr =  '201706272200', endStr = '201706280400', upscaleKm = 1, min_rainrate = 0.01, cacheDir = None):
     
         startTime = ti.timestring2datetime(startStr)
         endTime = ti.timestring2datetime(endStr)
@@ -699,14 +869,65 @@ class Datamanager:
         self.endTime = endTime
         self.upscaleKm = upscaleKm
         self.min_rainrate = min_rainrate
+        self.cacheDir = cacheDir
         self._DATA = {}
         
         self.load_observation()
         
+    def get_cache_key(self, group, product, N=0):
+        return (group, product, self.startStr, self.endStr, self.upscaleKm, self.min_rainrate, N)
+        
+    def get_filename_cache(self, key, name):
+        fileName = 'datamanager_%s_%s_%s-%s_%skm_minR%s_N%i_%s.npy' % (key[0], key[1], key[2], key[3], str(key[4]), str(key[5]), key[6], name)
+        return os.path.join(self.cacheDir, fileName)
+        
+    def read_cache(self, key, names):
+        ''' Arrays (dict) of a cache key from memory or from the .npy files of cacheDir (memory-mapped), None if not cached. '''
+        if key in datamanagerCache:
+            return datamanagerCache[key]
+        if self.cacheDir is None:
+            return None
+        fileNames = [self.get_filename_cache(key, name) for name in names]
+        if not all([os.path.isfile(fileName) for fileName in fileNames]):
+            return None
+        arrays = {}
+        for name,fileName in zip(names,fileNames):
+            arrays[name] = np.load(fileName, mmap_mode='r')
+        datamanagerCache[key] = arrays
+        return arrays
+        
+    def write_cache(self, key, arrays):
+        ''' Store the arrays (dict) of a cache key in memory (read-only) and in cacheDir. '''
+        for name in arrays:
+            arrays[name] = np.ascontiguousarray(arrays[name])
+            arrays[name].setflags(write=False)
+        datamanagerCache[key] = arrays
+        if self.cacheDir is None:
+            return
+        for name in arrays:
+            io.save_atomic(self.get_filename_cache(key, name), lambda fileNameTmp: np.save(fileNameTmp, arrays[name]))
+        
     def load_observation(self,product='AQC'):
         # silence numpy's invalid warnings 
         np.seterr(invalid='ignore') 
         
+        names = ['observations', 'observations_before', 'mask', 'mask_before', 'timestamps', 'timestamps_before']
+        key = self.get_cache_key('obs', product)
+        arrays = self.read_cache(key, names)
+        if arrays is None:
+            arrays = self.produce_observation(product)
+            self.write_cache(key, arrays)
+        
+        self._DATA[product] = arrays['observations']
+        self._DATA[product + '_before'] = arrays['observations_before']
+        self._observations_name = product
+        self._DATA['mask'] = arrays['mask']
+        self._DATA['mask_before'] = arrays['mask_before']
+        self.timestamps = np.asarray(arrays['timestamps']).astype(datetime).tolist()
+        self.timestamps_before = np.asarray(arrays['timestamps_before']).astype(datetime).tolist()
+        
+    def produce_observation(self,product='AQC'):
+        ''' Read and upscale the observations of the period and of one hour before. '''
         # from start time to end time
         observations,_,timestamps = lf.produce_radar_observation_with_accumulation(self.startStr,self.endStr,newAccumulationMin=10,product=product,rainThreshold=self.min_rainrate)
         mask = np.ones((observations.shape[1],observations.shape[2]),int)
@@ -738,17 +959,31 @@ class Datamanager:
         mask_before[mask_before>=0.5] = 1
 
         
-        self._DATA[product] =  observations
-        self._DATA[product + '_before'] =  observations_before
-        self._observations_name = product
-        self._DATA['mask'] = mask.squeeze()
-        self._DATA['mask_before'] = mask_before.squeeze()
-        self.timestamps = timestamps
-        self.timestamps_before = timestamps_before
+        arrays = {}
+        arrays['observations'] = observations
+        arrays['observations_before'] = observations_before
+        arrays['mask'] = mask.squeeze().astype(float)
+        arrays['mask_before'] = mask_before.squeeze().astype(float)
+        arrays['timestamps'] = np.array(timestamps, dtype='datetime64[s]')
+        arrays['timestamps_before'] = np.array(timestamps_before, dtype='datetime64[s]')
+        return arrays
         
     def load_forecast(self, product, N=0):
         # silence numpy's invalid warnings 
         np.seterr(invalid='ignore') 
+        
+        key = self.get_cache_key('fx', product, N)
+        arrays = self.read_cache(key, ['forecasts'])
+        if arrays is None:
+            arrays = {'forecasts': self.produce_forecast(product, N)}
+            self.write_cache(key, arrays)
+            
+        if product=='COSMO-E':
+            product = 'COSMO'
+        self._DATA[product] = arrays['forecasts']
+        
+    def produce_forecast(self, product, N=0):
+        ''' Read and upscale the forecasts of the period. '''
         if product=='COSMO':
             # COSMO ensemble
             membersCE = 'all'
@@ -777,7 +1012,6 @@ class Datamanager:
                     N = forecasts.shape[1]
             forecasts[np.isnan(forecasts)] = 0
             forecasts = forecasts[:,:N,:,:]
-            product = 'COSMO'
         elif product=='lagrangian':
             if N==0:
                 forecasts, _, _, _ = lf.get_radar_extrapolation(self.startStr,self.endStr,newAccumulationMin=10,product='AQC',rainThreshold=self.min_rainrate)
@@ -790,7 +1024,7 @@ class Datamanager:
         forecasts = self.upscale_wavelets(forecasts,self.upscaleKm)
         forecasts[forecasts<self.min_rainrate] = 0
                 
-        self._DATA[product] =  forecasts    
+        return forecasts    
     
     def upscale_wavelets(self, fieldsin, upscaleKm, resolution_km = 1, wavelet = 'haar'):
         '''
@@ -830,20 +1064,21 @@ class Datamanager:
                     
         return fieldsout    
 
+    # read-only views (copy them before modifying)
     def n_last_obs(self,n):
         # max is 1 hour before
-        return np.array(self._DATA[self._observations_name + '_before'][-n:,0,:,:].copy()) 
+        return self._DATA[self._observations_name + '_before'][-n:,0,:,:]
         
     @property
     def obs(self):  
-        return np.array(self._DATA[self._observations_name].copy())
+        return self._DATA[self._observations_name]
     @property
     def mask(self):  
-        return np.array(self._DATA['mask'].copy(),dtype=float) 
+        return self._DATA['mask']
     @property    
     def cosmo(self):
-        return np.array(self._DATA['COSMO'].copy())  
+        return self._DATA['COSMO']
     @property    
     def lagrangian(self):
-        return np.array(self._DATA['lagrangian'].copy())
+        return self._DATA['lagrangian']
 
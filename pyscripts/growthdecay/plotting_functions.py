@@ -77,7 +77,7 @@ def plot_frames_paper(startStr,t,r0,data,f,g,minR=0.01, plotmember=[0], gd_field
     # OBS
     a = plt.subplot(nrRows, nrCols, 1)
     axes_stack.append(a)
-    fplot = data.obs[t,0,:,:]
+    fplot = data.obs[t,0,:,:].copy()
     fplot[fplot<=minR]=np.nan
     obsmask = np.ones(fplot.shape)
     obsmask[data.mask==1] = np.nan
@@ -332,6 +332,12 @@ def fx(x, rf=[1,1], net=1):
         Vres = V
     return maple_ree.ree_epol_slio(xin, Vres*rf[0], Ures*rf[1], net)[:,:,-1]
 
+def fxlevels(x, rf=[1,1], net=1):
+    # same as fx for a block of fields (dim_y, dim_x, nfields) advected with a single call
+    fr = 0.5
+    Ures,Vres = nw.resize_motion_field(U,V,f=fr)
+    return nw.compute_advection_levels(x, Ures*rf[1], Vres*rf[0], net)
+
 #+++++++++++++++++++++++++++++++++++ Define random noise function
 
 domsize = int(domain_size/upscale_km)
@@ -380,10 +386,12 @@ def ux(fieldin, upscale_km, resKm = 1, wavelet = 'haar'):
 hx = []
 
 f = Nowcasting(data, N, hx, fx, rx, phi, AR_order=AR_order, number_levels=number_levels, transformation=transformation, \
-probability_matching=probability_matching, resolution_km=upscale_km, label='with growthdecay', min_rainrate=min_rainrate, zero_padding=zero_padding)
+probability_matching=probability_matching, resolution_km=upscale_km, label='with growthdecay', min_rainrate=min_rainrate, zero_padding=zero_padding, \
+fxlevels=fxlevels)
 
 g = Nowcasting(data, N, hx, fx, rx, phi, AR_order=AR_order, number_levels=number_levels, transformation=transformation, \
-probability_matching=probability_matching, resolution_km=upscale_km, label='without growthdecay', min_rainrate=min_rainrate, zero_padding=zero_padding)
+probability_matching=probability_matching, resolution_km=upscale_km, label='without growthdecay', min_rainrate=min_rainrate, zero_padding=zero_padding, \
+fxlevels=fxlevels)
 
 #+++++++++++++++++++++++++++++++++++ Start nowcasting
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+from __future__ import division
+from __future__ import print_function
+
+import os
+import datetime
+import time
+import argparse
+import sys
+
+import getpass
+username = getpass.getuser()
+
+import time_tools_attractor as ti
+import io_tools_attractor as io
+
+################################
+inBaseDir = '/scratch/' + username + '/data/'
+outBaseDir = '/store/msrad/radar/precip_attractor/radar_cubes/'
+
+########GET ARGUMENTS FROM CMD LINE####
+parser = argparse.ArgumentParser(description='Pack the radar images of a period into monthly chunked radar cubes (8-bit codes + lookup table).')
+parser.add_argument('-start', default='201601010000', type=str,help='Start time of the period: YYYYMMDDHHmmSS')
+parser.add_argument('-end', default='201601312355', type=str,help='End time of the period: YYYYMMDDHHmmSS')
+parser.add_argument('-product', default='AQC', type=str,help='Which radar rainfall product to use (AQC, CPC, RZC).')
+parser.add_argument('-accum', default=5, type=int,help='Accumulation time of the product [minutes].')
+parser.add_argument('-temp', default=5, type=int,help='Temporal sampling of the products [minutes].')
+parser.add_argument('-inDir', default=inBaseDir, type=str,help='Directory of the radar archive (unzipped).')
+parser.add_argument('-outDir', default=outBaseDir, type=str,help='Directory of the radar cubes.')
+parser.add_argument('-nworkers', default=2, type=int,help='Number of threads reading the radar images ahead.')
+
+args = parser.parse_args()
+
+if (int(args.start) < 198001010000) or (int(args.start) > 203001010000) or (int(args.start) > int(args.end)):
+    print('Invalid -start or -end time arguments.')
+    sys.exit(1)
+else:
+    timeStartStr = args.start
+    timeEndStr = args.end
+
+product = args.product
+timeAccumMin = args.accum
+timeSampMin = args.temp
+################################
+
+timeStart = ti.timestring2datetime(timeStartStr)
+timeEnd = ti.timestring2datetime(timeEndStr)
+
+##### LOOP OVER MONTHS #############
+tic = time.clock()
+timeLocal = timeStart
+while timeLocal <= timeEnd:
+    # Last time stamp of the month (or of the period)
+    if timeLocal.month == 12:
+        nextMonth = datetime.datetime(timeLocal.year+1, 1, 1)
+    else:
+        nextMonth = datetime.datetime(timeLocal.year, timeLocal.month+1, 1)
+    timeLastMonth = min(nextMonth - datetime.timedelta(minutes=timeSampMin), timeEnd)
+
+    fileName = io.get_filename_radar_cube(args.outDir, timeLocal, product, timeAccumMin)
+    cmd = 'mkdir -p ' + os.path.dirname(fileName)
+    os.system(cmd)
+
+    print('Packing', ti.datetime2timestring(timeLocal), '-', ti.datetime2timestring(timeLastMonth), 'into', fileName)
+    missingFiles = io.write_radar_cube(fileName, ti.datetime2timestring(timeLocal), ti.datetime2timestring(timeLastMonth), \
+        product=product, timeStepMin=timeSampMin, timeAccumMin=timeAccumMin, inBaseDir=args.inDir, nworkers=args.nworkers)
+    print(fileName, 'saved,', len(missingFiles), 'missing files.')
+
+    timeLocal = nextMonth
+
+toc = time.clock()
+print('Total elapsed time: ', toc-tic, ' seconds.')
@@ -19,6 +19,8 @@ import shutil
 import datetime
 import time
 import warnings
+import subprocess
+import multiprocessing.pool
 from collections import OrderedDict
 
 import pyfftw
@@ -77,6 +79,8 @@ parser.add_argument('-minR', default=0.08, type=float,help='Minimum rainfall rat
 parser.add_argument('-format', default="netcdf", type=str,help='File format for output statistics (netcdf or csv).')
 parser.add_argument('-accum', default=5, type=int,help='Accumulation time of the product [minutes].')
 parser.add_argument('-temp', default=5, type=int,help='Temporal sampling of the products [minutes].')
+parser.add_argument('-nworkers', default=2, type=int,help='Number of threads reading the radar images ahead (0 to read them when needed).')
+parser.add_argument('-nproc', default=1, type=int,help='Number of days processed in parallel (>1 splits the period into days and skips the days already written).')
 
 args = parser.parse_args()
 
@@ -143,6 +147,48 @@ timeEnd = ti.timestring2datetime(timeEndStr)
 timeAccumMinStr = '%05i' % timeAccumMin
 timeAccum24hStr = '%05i' % (24*60)
 
+# Marker of a day (00:05 -> 00:00 of next day) completely processed, also written when 
+# the day has not enough samples to write the statistics, so that resumed runs skip it
+def get_filename_day_done(timeDay):
+    fileNameStats,_,_ = io.get_filename_stats(inBaseDir, 'STATS', timeDay, product, timeAccumMin=timeAccumMin,\
+    quality=0, minR=args.minR, wols=weightedOLS, variableBreak = variableBreak, format=args.format)
+    return fileNameStats + '.done'
+
+##### PARALLEL DRIVER OVER DAYS ################################################
+# Each day (00:05 -> 00:00 of next day) is processed by a separate run of this script
+if args.nproc > 1:
+    dayArgs = ['-product', product, '-plot', str(boolPlotting), '-analysis'] + analysis + \
+    ['-wols', str(weightedOLS), '-minR', str(args.minR), '-format', args.format, '-accum', str(timeAccumMin), \
+    '-temp', str(args.temp), '-nworkers', str(args.nworkers), '-nproc', '1']
+    
+    days = []
+    nrDaysWritten = 0
+    timeDay = datetime.datetime(timeStart.year, timeStart.month, timeStart.day)
+    while timeDay < timeEnd:
+        # Skip the days already completely processed (to resume a period)
+        if os.path.isfile(get_filename_day_done(timeDay)):
+            nrDaysWritten += 1
+        else:
+            timeDayStart = max(timeDay + datetime.timedelta(minutes = timeSampMin), timeStart)
+            timeDayEnd = min(timeDay + datetime.timedelta(days = 1), timeEnd)
+            days.append((ti.datetime2timestring(timeDayStart), ti.datetime2timestring(timeDayEnd)))
+        timeDay = timeDay + datetime.timedelta(days = 1)
+    print(nrDaysWritten, 'days already written,', len(days), 'days to process with', args.nproc, 'processes.')
+    
+    def run_day(day):
+        cmd = [sys.executable, os.path.abspath(__file__), '-start', day[0], '-end', day[1]] + dayArgs
+        return subprocess.call(cmd)
+    
+    pool = multiprocessing.pool.ThreadPool(args.nproc)
+    returnCodes = pool.map(run_day, days, chunksize=1)
+    pool.close()
+    
+    failedDays = [day[0] for day,returnCode in zip(days, returnCodes) if returnCode != 0]
+    if len(failedDays) > 0:
+        print('Failed days: ', failedDays)
+        sys.exit(1)
+    sys.exit(0)
+
 ## COLORMAPS
 color_list, clevs, clevsStr = dt.get_colorlist('MeteoSwiss') #'STEPS' or 'MeteoSwiss'
 cmap = colors.ListedColormap(color_list)
@@ -188,7 +234,9 @@ nrFilesDay = 24*(60/timeAccumMin)
 # Rainfall stack
 nrValidFields = 0
 stackSize = 12
-rainfallStack = np.zeros((stackSize,fftDomainSize,fftDomainSize))
+# ring buffer of the last valid rainfall fields (rainfallStack[0] is the last one)
+rainfallStack = io.Radar_stack(stackSize, product='AQC', field='dBZFourier', minR = args.minR, fftDomainSize = 512, \
+    resKm = 1, timeAccumMin = 5, inBaseDir = '/scratch/lforesti/data/', noData = -999.0, cmaptype = 'MeteoSwiss', domain = 'CCS4')
 waveletStack = [None] * stackSize
 
 # Flow stack
@@ -210,14 +258,18 @@ dailyTimesWavelets = []
 
 tic = time.clock()
 
+# Radar images read ahead while computing the statistics
+missingFiles = []
+radarImages = io.read_radar_images(timeStartStr, timeEndStr, timeSampMin, product='AQC', nworkers=args.nworkers, \
+    missingFiles=missingFiles, **rainfallStack.readArgs)
+
 timeLocal = timeStart
 while timeLocal <= timeEnd:
     ticOneImg = time.clock()
     
     # Read in radar image into object
     timeLocalStr = ti.datetime2timestring(timeLocal)
-    r = io.read_gif_image(timeLocalStr, product='AQC', minR = args.minR, fftDomainSize = 512, \
-    resKm = 1, timeAccumMin = 5, inBaseDir = '/scratch/lforesti/data/', noData = -999.0, cmaptype = 'MeteoSwiss', domain = 'CCS4')
+    r = next(radarImages)
     
     hourminStr = ti.get_HHmm_str(timeLocal.hour, timeLocal.minute) # Used to write out data also when there is no valid radar file
     minWAR = 0.1
@@ -228,11 +280,8 @@ while timeLocal <= timeEnd:
         Ymin = r.extent[2]
         Ymax = r.extent[3]
         
-        # Move older rainfall fields down the stack
-        for s in range(0, rainfallStack.shape[0]-1):
-            rainfallStack[s+1,:] = rainfallStack[s,:]
-        # Add last rainfall field on top
-        rainfallStack[0,:] = r.dBZFourier
+        # Add last rainfall field on top (older rainfall fields move down the stack)
+        rainfallStack.push(r)
         
         # Increment nr of consecutive valid rainfall fields (war >= 0.01)
         nrValidFields += 1
@@ -582,20 +631,16 @@ while timeLocal <= timeEnd:
         #print('FFT time: ', tocFFT-ticFFT, ' seconds.')
         
         ##################### COMPUTE SUMMARY STATS #####################################
-        # Compute field statistics in rainfall units
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-
-            rainmean = np.nanmean(r.rainrate.ravel())
-            rainstd = np.nanstd(r.rainrate.ravel())
-            raincondmean = np.nanmean(r.rainrateNans.ravel())
-            raincondstd = np.nanstd(r.rainrateNans.ravel())
-            
-            # Compute field statistics in dBZ units
-            dBZmean = np.nanmean(r.dBZ.ravel())
-            dBZstd = np.nanstd(r.dBZ.ravel())
-            dBZcondmean = np.nanmean(r.dBZNans.ravel())
-            dBZcondstd = np.nanstd(r.dBZNans.ravel())
+        # Compute field statistics in rainfall and dBZ units (from the histogram of the codes)
+        imageStats = io.compute_radar_image_statistics(r)
+        rainmean = imageStats['r_mean']
+        rainstd = imageStats['r_std']
+        raincondmean = imageStats['r_cmean']
+        raincondstd = imageStats['r_cstd']
+        dBZmean = imageStats['dBZ_mean']
+        dBZstd = imageStats['dBZ_std']
+        dBZcondmean = imageStats['dBZ_cmean']
+        dBZcondstd = imageStats['dBZ_cstd']
         
         # Compute Eulerian Auto-correlation 
         if (nrValidFields >= 2) and ('of' in analysis):
@@ -1213,6 +1258,8 @@ while timeLocal <= timeEnd:
     minNrDailySamples = 2
     try:
         conditionForWriting = (len(dailyStats) >= minNrDailySamples) and ((hourminStr == '0000') or (timeLocal == timeEnd))
+        # Whether the day ending at this midnight was processed from its first time stamp (00:05)
+        isFullDay = (hourminStr == '0000') and (timeStart <= timeLocal - datetime.timedelta(days = 1) + datetime.timedelta(minutes = timeSampMin))
     except:
         print(dir(r))
         sys.exit(1)
@@ -1224,24 +1271,37 @@ while timeLocal <= timeEnd:
         # Write stats in the directory of previous day if last time stamp (midnight of next day) 
         timePreviousDay = timeLocal - datetime.timedelta(days = 1) 
                   
-        # Generate filenames 
+        # Generate filenames (partial days at the start or end of the period are named after their first or last time stamp)
         analysisType = 'STATS' 
-        if hourminStr == '0000': 
+        if isFullDay: 
             fileNameStats,_,_ = io.get_filename_stats(inBaseDir, analysisType, timePreviousDay, product, timeAccumMin=timeAccumMin,\
             quality=0, minR=args.minR, wols=weightedOLS, variableBreak = variableBreak, format=args.format) 
+        elif hourminStr == '0000': 
+            fileNameStats,_,_ = io.get_filename_stats(inBaseDir, analysisType, timeStart, product, timeAccumMin=timeAccumMin,\
+            quality=0, minR=args.minR, wols=weightedOLS, variableBreak = variableBreak, format=args.format) 
         else: 
             fileNameStats,_,_ = io.get_filename_stats(inBaseDir, analysisType, timeLocal, product, timeAccumMin=timeAccumMin,\
             quality=0, minR=args.minR, wols=weightedOLS, variableBreak = variableBreak, format=args.format) 
         
-        # Write out files 
+        # Write out files (to a temporary file renamed at the end, so that only complete days are found when resuming)
         spectralSlopeLims = [largeScalesLims_best[0], largeScalesLims_best[1], smallScalesLims_best[1]]
         if (boolPlotting == False): 
+            fileNameTmp = fileNameStats + '.tmp'
             if args.format == 'csv': 
                 # Write out CSV file 
-                io.write_csv_globalstats(fileNameStats, headers, dailyStats) 
+                io.write_csv_globalstats(fileNameTmp, headers, dailyStats) 
             elif args.format == 'netcdf': 
                 # Write out NETCDF file 
-                io.write_netcdf_globalstats(fileNameStats, headers, dailyStats, str(args.minR), str(weightedOLS), spectralSlopeLims) 
+                io.write_netcdf_globalstats(fileNameTmp, headers, dailyStats, str(args.minR), str(weightedOLS), spectralSlopeLims) 
+            os.rename(fileNameTmp, fileNameStats)
+            
+            # Update the statistics store with the daily stats
+            storeDir = io.get_dirname_stats_store(inBaseDir, analysisType, product, timeAccumMin=timeAccumMin, \
+            quality=0, minR=args.minR, wols=weightedOLS, variableBreak = variableBreak)
+            statsStore = io.Stats_store(storeDir)
+            statsStore.append(headers, dailyStats)
+            if isFullDay:
+                statsStore.add_days([timePreviousDay])
         
         print(fileNameStats, ' saved.') 
         
@@ -1287,6 +1347,13 @@ while timeLocal <= timeEnd:
         dailyStats = []
         dailyWavelets = []
         dailyTimesWavelets = []
+    
+    # Record the complete days, with or without enough samples
+    if isFullDay and (boolPlotting == False):
+        fileNameDone = get_filename_day_done(timeLocal - datetime.timedelta(days = 1))
+        if not os.path.isdir(os.path.dirname(fileNameDone)):
+            os.makedirs(os.path.dirname(fileNameDone))
+        open(fileNameDone, 'w').close()
 
     ############ WRITE OUT DAILY VELOCITY FIELDS ###########################
     if conditionForWriting and ('of' in analysis):
@@ -1312,5 +1379,7 @@ while timeLocal <= timeEnd:
 
 toc = time.clock()
 print('Total archive elapsed time: ', toc-tic, ' seconds.')
+if len(missingFiles) > 0:
+    print('Missing radar files: ', missingFiles)
 
 
@@ -6,7 +6,6 @@ import argparse
 import numpy as np
 import pandas as pd
 import sys
-import os
 
 import matplotlib as mpl
 #mpl.use('Agg')
@@ -50,7 +49,7 @@ parser.add_argument('-minCorrBeta', default=0.95, type=float,help='Minimum corre
 parser.add_argument('-accum', default=5, type=int,help='Accumulation time of the product [minutes].')
 parser.add_argument('-temp', default=5, type=int,help='Temporal sampling of the products [minutes].')
 parser.add_argument('-format', default='netcdf', type=str,help='Format of the file containing the statistics [csv,netcdf].')
-parser.add_argument('-refresh', default=0, type=int,help='Whether to refresh the binary .npy archive or not.')
+parser.add_argument('-refresh', default=0, type=int,help='Whether to rebuild the statistics store from the daily files of the period or not.')
 
 args = parser.parse_args()
 
@@ -83,40 +82,32 @@ else:
     variableBreak = 0
     
 ############### OPEN FILES WITH STATS
-## Open single binary python file with stats to speed up (if it exists)
-tmpArchiveFileName = tmpBaseDir + timeStartStr + '-' + timeEndStr + '_temporaryAttractor.npy'
-tmpArchiveFileNameVariables = tmpBaseDir + timeStartStr + '-' + timeEndStr + '_temporaryAttractor_varNames.npy'
-if (os.path.isfile(tmpArchiveFileName) == True) and (refreshArchive == False):
-    arrayStats = np.load(tmpArchiveFileName)
-    arrayStats = arrayStats.tolist()
-    variableNames = np.load(tmpArchiveFileNameVariables)
-    print('Loaded:', tmpArchiveFileName)
+## Statistics store updated by radar_statistics.py (the days of the period not in the store yet are read from the daily files, all of them with -refresh)
+storeDir = io.get_dirname_stats_store(inBaseDir, 'STATS', product, timeAccumMin=timeAccumMin, minR=args.minR, \
+wols=args.wols, variableBreak=variableBreak)
+statsStore = io.Stats_store(storeDir)
+if args.format == 'csv':
+    # csv files are named with the sampling time
+    nrDaysRead = statsStore.load_daily_files(timeStart, timeEnd, inBaseDir, format=args.format, refresh=refreshArchive, analysisType='STATS', \
+    product = product, timeAccumMin = timeSampMin, minR=args.minR, wols=args.wols, variableBreak=variableBreak)
 else:
-    if args.format == 'csv':
-        arrayStats, variableNames = io.csv_list2array(timeStart, timeEnd, inBaseDir, analysisType='STATS', \
-        product = product, timeAccumMin = timeSampMin, minR=args.minR, wols=args.wols, variableBreak=variableBreak)
-    elif args.format == 'netcdf':
-        arrayStats, variableNames = io.netcdf_list2array(timeStart, timeEnd, inBaseDir, analysisType='STATS', \
-        product = product, timeAccumMin = timeAccumMin, minR=args.minR, wols=args.wols, variableBreak=variableBreak)
-    else:
-        print('Please provide a valid file format.')
-        sys.exit(1)
-
-    # Check if there are enough data
-    if (len(arrayStats) == 100) & (args.format == 'csv'):
-        print("Not enough data found in CSV files.")
-        sys.exit(1)
-    if (len(arrayStats) < 100) & (args.format == 'netcdf'):
-        print("No enough data found in NETCDF files.")
-        sys.exit(1)
-
-## Save data into a single binary python file to speed up further analysis with same dataset
-arrayData = []
-if refreshArchive == True:
-    np.save(tmpArchiveFileName, arrayStats)
-    np.save(tmpArchiveFileNameVariables, variableNames)
-    print('Saved:',tmpArchiveFileName)
-    
+    nrDaysRead = statsStore.load_daily_files(timeStart, timeEnd, inBaseDir, format=args.format, refresh=refreshArchive, analysisType='STATS', \
+    product = product, timeAccumMin = timeAccumMin, minR=args.minR, wols=args.wols, variableBreak=variableBreak)
+if nrDaysRead > 0:
+    print('Saved', nrDaysRead, 'days:', storeDir)
+
+## Read only the period from the store
+arrayStats, variableNames = statsStore.read(timeStart, timeEnd)
+print('Loaded:', storeDir)
+
+# Check if there are enough data
+if (len(arrayStats) == 100) & (args.format == 'csv'):
+    print("Not enough data found in CSV files.")
+    sys.exit(1)
+if (len(arrayStats) < 100) & (args.format == 'netcdf'):
+    print("No enough data found in NETCDF files.")
+    sys.exit(1)
+
 # Generate list of datetime objects
 timeIntList = dt.get_column_list(arrayStats, 0)
 timeStampsDt = ti.timestring_array2datetime_array(timeIntList)
@@ -4,7 +4,7 @@
 outDir=/scratch/$USER/job_out # directory for printout
 partition=postproc #postproc or normal
 
-resourcesPerJob="--nodes=1 --ntasks=1 --cpus-per-task=1 --ntasks-per-node=1 --mem-per-cpu=26g --time=2:00:00 \
+resourcesPerJob="--nodes=1 --ntasks=1 --cpus-per-task=2 --ntasks-per-node=1 --mem-per-cpu=13g --time=2:00:00 \
 --partition=$partition --account=msrad"
 
 ###### Arguments of python script ./radar_statistics.py
@@ -14,6 +14,7 @@ wols=0 # Whether to use the weighted ordinary least squares
 minR=0.08 # Minimum rainfall rate
 accumMin=5 # Accumulation time of the product
 fmt='netcdf'
+nworkers=2 # Number of threads reading the radar images ahead (should match --cpus-per-task)
 
 ###### Setting of separate time periods for multiproc
 readarray periodsTimes < /users/$USER/precipattractor/shscripts/timePeriods.txt
@@ -36,7 +37,7 @@ for period in $(seq 0 $[$nrPeriods-1]); do
 	jobName=$(printf precip_attractor_%10i-%10i $startTime $endTime)
     
 	srun --job-name=$jobName --output=$outDir/$jobName.out --error=$outDir/$jobName.err $resourcesPerJob \
-	$pyDir/radar_statistics.py -start $startTime -end $endTime -wols $wols -minR $minR -accum $accumMin -format $fmt -plt autocorr&
+	$pyDir/radar_statistics.py -start $startTime -end $endTime -wols $wols -minR $minR -accum $accumMin -format $fmt -nworkers $nworkers -plt autocorr&
 	
 	echo "Job submitted:"
 	echo "srun --job-name=$jobName --output=$outDir/$jobName.out --error=$outDir/$jobName.err $resourcesPerJob \